@@ -1,21 +1,125 @@
-import customtkinter as ctk
-from openai import OpenAI
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-import ollama
 import os
+import sys
 import pickle
 import threading
-import requests
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import importlib
+import argparse
+import asyncio
+import contextvars
 import json
 import base64
+import codecs
+import hashlib
 import time
-from datetime import datetime
-import tkinter as tk
-from tkinter import messagebox
+from datetime import datetime, timedelta, timezone
 import re
+import itertools
+import functools
+import unicodedata
+from itertools import islice
+from collections import deque
+import sqlite3
+import uuid
+import atexit
+import logging
+import logging.handlers
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qs
+from html.parser import HTMLParser
+
+# 起動計測の基準時刻
+_PROCESS_STARTED = time.perf_counter()
+
+# 起動時間の計測
+class StartupProfiler:
+    """モジュールの読み込み時間と初回描画までの時間を記録する"""
+    def __init__(self):
+        self.imports = []
+        self.marks = []
+        self._lock = threading.Lock()
+    
+    def record_import(self, name, seconds):
+        with self._lock:
+            self.imports.append((name, seconds, threading.current_thread().name))
+    
+    def mark(self, name):
+        """起動からの経過時間を記録する"""
+        with self._lock:
+            self.marks.append((name, time.perf_counter() - _PROCESS_STARTED))
+    
+    def report(self, path=None):
+        """計測結果を表示し、path指定時はJSONで保存する"""
+        with self._lock:
+            imports = list(self.imports)
+            marks = list(self.marks)
+        print("=== 起動時間 ===")
+        for name, elapsed in marks:
+            print(f"{name:<24} {elapsed * 1000:8.1f} ms")
+        print("=== モジュール読み込み ===")
+        for name, seconds, thread_name in imports:
+            print(f"{name:<32} {seconds * 1000:8.1f} ms  ({thread_name})")
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'marks': {name: elapsed for name, elapsed in marks},
+                    'imports': [{'module': name, 'seconds': seconds, 'thread': thread_name}
+                                for name, seconds, thread_name in imports]
+                }, f, ensure_ascii=False, indent=2)
+
+startup_profiler = StartupProfiler()
+
+# 遅延インポート
+class LazyModule:
+    """初回の属性アクセス時にモジュールを読み込む（重いSDKの読み込みで起動を遅らせないため）"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+    
+    def ensure_loaded(self):
+        """モジュールを読み込んでおく（事前読み込みや、使えるかどうかの確認に使う）"""
+        self._import()
+    
+    def _import(self):
+        """モジュールを読み込んで返す（読み込み済みならそのまま返す）"""
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    startup_profiler.record_import(self._name, time.perf_counter() - started)
+                    self._module = module
+        return self._module
+    
+    def __getattr__(self, attr):
+        return getattr(self._import(), attr)
+
+# GUIを使わない実行（CLI）ではtkinterがない環境でも動くよう、GUI関連も遅延させる
+tk = LazyModule('tkinter')
+messagebox = LazyModule('tkinter.messagebox')
+ctk = LazyModule('customtkinter')
+openai = LazyModule('openai')
+google_discovery = LazyModule('googleapiclient.discovery')
+google_http = LazyModule('googleapiclient.http')
+google_errors = LazyModule('googleapiclient.errors')
+google_oauth_flow = LazyModule('google_auth_oauthlib.flow')
+google_auth_requests = LazyModule('google.auth.transport.requests')
+google_auth_exceptions = LazyModule('google.auth.exceptions')
+google_auth_httplib2 = LazyModule('google_auth_httplib2')
+httplib2 = LazyModule('httplib2')
+ollama = LazyModule('ollama')
+requests = LazyModule('requests')
+httpx = LazyModule('httpx')
+numpy = LazyModule('numpy')
+
+# ウィンドウ表示後に裏で読み込んでおくモジュール（初回操作時の待ち時間を減らす）
+WARMUP_MODULES = (
+    requests, openai, httplib2, google_auth_httplib2,
+    google_discovery, google_http, google_errors, ollama
+)
 
 # スコープ設定
 SCOPES = [
@@ -24,99 +128,2431 @@ SCOPES = [
     'https://www.googleapis.com/auth/tasks'
 ]
 
-# クライアント設定
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# キャッシュ保存先
+CACHE_DIR = 'cache'
+
+# Google API設定
+CREDENTIAL_REFRESH_MARGIN = 300  # 有効期限の何秒前に認証情報を更新するか
+DISCOVERY_CACHE_TTL = 7 * 24 * 3600  # Discoveryドキュメントの保持期間（秒）
+GOOGLE_HTTP_TIMEOUT = 30
+
+# Gmail取得設定
+EMAIL_MAX_RESULTS = 20  # 1回の処理で扱う未読メールの最大件数
+GMAIL_LIST_PAGE_SIZE = 500  # messages.listの1ページあたりの最大件数（API上限）
+GMAIL_BATCH_SIZE = 50  # 1回のバッチリクエストに含めるメッセージ数（Gmailの推奨上限）
+MAIL_STORE_PATH = os.path.join(CACHE_DIR, 'mail_store.sqlite3')
+# 件名・差出人・本文の抽出に必要なフィールドのみ取得する
+GMAIL_MESSAGE_FIELDS = (
+    "id,threadId,historyId,internalDate,labelIds,"
+    "payload(mimeType,filename,headers(name,value),body(data,size,attachmentId),"
+    "parts(mimeType,filename,headers(name,value),body(data,size,attachmentId),"
+    "parts(mimeType,filename,headers(name,value),body(data,size,attachmentId),parts)))"
+)
+EMAIL_DECODE_MAX_BYTES = 256 * 1024  # 本文パートをデコードするバイト数の上限（超えた分は読まない）
+EMAIL_DECODE_CHUNK = 64 * 1024  # 一度にデコードするbase64の文字数（4の倍数）
+EMAIL_MIME_MAX_DEPTH = 10  # MIMEツリーをたどる深さの上限
+EMAIL_SIGNATURE_MAX_LINES = 6  # 最後の区切り線のあとに何行までなら署名とみなすか
+EMAIL_SIGNATURE_LINE_CHARS = 40  # 署名とみなす行の長さの上限
+EMAIL_EMPTY_BODY_MESSAGE = "本文がないため、返信提案は生成していません。"
+
+# 埋め込み索引設定（ドライブ本文の意味検索）
+EMBEDDING_INDEX_PATH = os.path.join(CACHE_DIR, 'embeddings.sqlite3')
+EMBEDDING_VECTORS_PATH = os.path.join(CACHE_DIR, 'embeddings.f32')  # float32の行列をメモリマップで読み書きする
+EMBEDDING_BACKEND = 'openai'  # 'ollama'にするとローカルで計算する（オフラインでも検索できる）
+EMBEDDING_MODELS = {'openai': 'text-embedding-3-small', 'ollama': 'nomic-embed-text'}
+EMBEDDING_DIMENSIONS = 512  # OpenAIで出力する次元数（小さいほど索引が軽い）
+EMBEDDING_CHUNK_CHARS = 800  # 1チャンクの文字数
+EMBEDDING_CHUNK_OVERLAP = 100  # 長い段落を分けるときに前のチャンクと重ねる文字数
+EMBEDDING_MAX_CHUNKS_PER_FILE = 50
+EMBEDDING_FILES_PER_SYNC = 50  # 1回の同期で埋め込みを作るファイル数の上限
+EMBEDDING_BATCH_SIZE = 64  # 1回のリクエストで埋め込むチャンク数
+EMBEDDING_CONCURRENCY = 4
+EMBEDDING_INITIAL_CAPACITY = 1024  # ベクトルファイルの初期行数（足りなくなったら倍にする）
+EMBEDDING_SEARCH_BLOCK = 65536  # 類似度を一度に計算する行数（メモリ使用量を抑える）
+EMBEDDING_PASSAGES_PER_FILE = 2  # 検索結果に含める1ファイルあたりのチャンク数
+OPENAI_EMBEDDING_REQUESTS_PER_MINUTE = 500
+OPENAI_EMBEDDING_TOKENS_PER_MINUTE = 1000000
+
+# Googleタスク設定
+TASK_STORE_PATH = os.path.join(CACHE_DIR, 'tasks.sqlite3')
+TASK_LIST_TITLE = 'AIアシスタント'  # タスクリストがない場合に作成する名前
+TASKS_PAGE_SIZE = 100  # tasks.listの1ページあたりの件数（API上限）
+TASKS_BATCH_SIZE = 100  # 1回のバッチリクエストに含める追加件数
+TASK_PRIORITIES = ("高", "中", "低")
+# タスク抽出の出力形式（OpenAIのstrictモードに合わせ、全項目を必須にする）
+TASK_LIST_SCHEMA = {
+    "title": "task_list",
+    "type": "object",
+    "properties": {
+        "tasks": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "title": {"type": "string"},
+                    "notes": {"type": "string"},
+                    "due": {"type": "string", "description": "YYYY-MM-DD形式。不明な場合は空文字"},
+                    "priority": {"type": "string", "enum": list(TASK_PRIORITIES)}
+                },
+                "required": ["title", "notes", "due", "priority"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["tasks"],
+    "additionalProperties": False
+}
+
+# Googleドライブ索引設定
+DRIVE_INDEX_PATH = os.path.join(CACHE_DIR, 'drive_index.sqlite3')
+DRIVE_SYNC_INTERVAL = 120  # 索引を差分同期する間隔（秒）
+DRIVE_LIST_PAGE_SIZE = 1000  # files.list / changes.list の1ページあたりの件数（API上限）
+DRIVE_CONTENT_BATCH = 100  # 1回の同期で本文を取り込むファイル数の上限
+DRIVE_CONTENT_MAX_BYTES = 1024 * 1024  # 本文を取り込む通常ファイルのサイズ上限
+DRIVE_CONTENT_MAX_CHARS = 100000  # 1ファイルあたりに保存する本文の文字数上限
+DRIVE_FILE_FIELDS = "id,name,mimeType,webViewLink,description,createdTime,modifiedTime,trashed,size"
+DRIVE_SEARCH_FIELDS = "id,name,mimeType,webViewLink,description,modifiedTime"  # 検索結果で使うフィールド
+DRIVE_SEARCH_PAGE_SIZE = 50  # APIで直接検索する場合の1ページあたりの件数
+DRIVE_SEARCH_CANDIDATES = 3  # 並べ替え用に表示件数の何倍まで候補を集めるか
+# プロンプトに載せるときの表示名
+DRIVE_MIME_LABELS = {
+    'application/vnd.google-apps.document': 'ドキュメント',
+    'application/vnd.google-apps.spreadsheet': 'スプレッドシート',
+    'application/vnd.google-apps.presentation': 'スライド',
+    'application/vnd.google-apps.folder': 'フォルダ',
+    'application/pdf': 'PDF',
+}
+DRIVE_FIELD_LABELS = {
+    'mimeType': '種類',
+    'modifiedTime': '更新日',
+    'webViewLink': 'リンク',
+    'description': '説明',
+    'snippet': '抜粋',
+}
+# Googleドキュメント類はテキストに変換して取り込む
+DRIVE_EXPORT_MIME_TYPES = {
+    'application/vnd.google-apps.document': 'text/plain',
+    'application/vnd.google-apps.presentation': 'text/plain',
+    'application/vnd.google-apps.spreadsheet': 'text/csv',
+}
+
+# 接続状態の監視設定
+CONNECTIVITY_PROBE_URL = "https://www.google.com/generate_204"
+CONNECTIVITY_PROBE_TIMEOUT = 3
+CONNECTIVITY_TTL = 60  # オンライン時の再確認間隔（秒）
+CONNECTIVITY_OFFLINE_TTL = 10  # オフライン時の再確認間隔（秒）
+
+# LLM設定
+OPENAI_MODEL = "gpt-4o"
+LOCAL_MODEL = "gemma:1b"
+DEFAULT_SYSTEM_MESSAGE = "あなたは役立つAIアシスタントです。"
+OPENAI_REQUESTS_PER_MINUTE = 60
+OPENAI_TOKENS_PER_MINUTE = 30000
+OPENAI_COMPLETION_RESERVE = 800  # レート制限の見積もりに加える応答トークン数
+OPENAI_RATE_LIMIT_RETRIES = 3
+EMAIL_REPLY_CONCURRENCY = 4  # 返信提案を同時に生成する数
+LLM_UNAVAILABLE_MESSAGE = "申し訳ありません。AIサービスに接続できませんでした。インターネット接続とLLMの状態を確認してください。"
+FALLBACK_NOTICE = "\n\n（OpenAIへの接続が途切れたため、ローカルLLMで生成し直します）\n\n"
+LLM_MAX_CONNECTIONS = 100  # バックエンドごとに同時に張るHTTP接続の上限
+LLM_MAX_KEEPALIVE_CONNECTIONS = 20  # 再利用のために保持する接続数
+LLM_TIMEOUT = 600  # 1回の呼び出しの制限時間（秒）
+LLM_CONNECT_TIMEOUT = 5.0  # 接続の制限時間（秒）。届かない場合は早く諦めてフォールバックする
+LLM_HEALTH_WINDOW = 50  # 遅延と成否を記録する直近の呼び出し数
+LLM_BREAKER_FAILURES = 3  # 連続してこの回数失敗したら遮断する
+LLM_BREAKER_ERROR_RATE = 0.5  # 直近の失敗率がこれ以上でも遮断する
+LLM_BREAKER_MIN_CALLS = 10  # 失敗率で判断するのに必要な呼び出し数
+LLM_BREAKER_COOLDOWN = 30  # 遮断してから試しに1件だけ通すまでの秒数
+LLM_HEDGE_ENABLED = True  # OpenAIが遅いときにローカルLLMにも並行して問い合わせる
+LLM_HEDGE_PERCENTILE = 95  # 直近の遅延のこの百分位を超えたらヘッジする
+LLM_HEDGE_MIN_SAMPLES = 10  # ヘッジの判断に必要な計測数
+LLM_HEDGE_MIN_DELAY = 1.0  # ヘッジを始めるまでの最短の待ち時間（秒）
+# ローカルモデルをメモリに残す時間（Ollamaのkeep_alive）
+OLLAMA_KEEP_ALIVE_OFFLINE = '60m'  # オフライン中はすべてローカルLLMで処理するため長く残す
+OLLAMA_KEEP_ALIVE_ACTIVE = '30m'  # 直近によく使われている場合
+OLLAMA_KEEP_ALIVE_IDLE = '5m'  # Ollamaの既定値と同じ
+OLLAMA_ACTIVE_WINDOW = 600  # 利用回数を数える期間（秒）
+OLLAMA_ACTIVE_USES = 3  # この期間にこの回数以上使われていれば「よく使われている」とみなす
+# ワークフローごとのモデル（バックエンドごとに指定し、指定がなければdefaultを使う）
+LLM_MODELS = {
+    'default': {'openai': OPENAI_MODEL, 'ollama': LOCAL_MODEL},
+    'drive_search': {'openai': OPENAI_MODEL, 'ollama': LOCAL_MODEL},
+    'email_reply': {'openai': OPENAI_MODEL, 'ollama': LOCAL_MODEL},
+    'task_extract': {'openai': OPENAI_MODEL, 'ollama': LOCAL_MODEL},
+    'web_report': {'openai': OPENAI_MODEL, 'ollama': LOCAL_MODEL},
+    'summary': {'openai': OPENAI_MODEL, 'ollama': LOCAL_MODEL},
+}
+
+# プロンプトのトークン予算設定
+MODEL_CONTEXT_TOKENS = {
+    OPENAI_MODEL: 128000,
+    'gpt-4o-mini': 128000,
+    LOCAL_MODEL: 8192,  # Ollamaにはnum_ctxとして指定する
+}
+MODEL_OUTPUT_RESERVE = {
+    OPENAI_MODEL: 4096,
+    'gpt-4o-mini': 4096,
+    LOCAL_MODEL: 1024,
+}
+PROMPT_TEMPLATE_RESERVE = 600  # 指示文とシステムメッセージの分として差し引くトークン数
+# ワークフローごとの入力の上限（コンテキストに収まる場合でも、遅延と費用を一定に保つため抑える）
+PROMPT_BUDGETS = {
+    'drive_search': 3000,
+    'email_reply': 2000,
+    'web_report': 12000,
+    'summary': 3000,
+    'default': 4000,
+}
+REPORT_SOURCE_WEIGHTS = {'web_search': 3, 'drive': 2}  # レポートの入力予算の配分比
+SUMMARY_MAX_CHUNKS = 8  # 要約するチャンク数の上限（超えた分は切り捨てる）
+SUMMARY_CONCURRENCY = 4
+SUMMARY_SYSTEM_MESSAGE = "あなたは文書を正確に要約するアシスタントです。固有名詞・数値・日付・依頼事項は省略せずに残してください。"
+EMAIL_BODY_MAX_CHARS = 50000  # ローカルストアに保存するメール本文の上限
+
+# レポート生成の各ステージの制限時間（秒）
+REPORT_STAGE_TIMEOUTS = {
+    'web_search': 120,
+    'drive': 30,
+    'report': 600,
+}
+
+# ジョブ実行設定
+JOB_WORKERS = 3  # 同時に実行するジョブ数の上限
+JOB_HISTORY_LIMIT = 8  # 一覧に残す終了済みジョブの数
+# 優先度（小さいほど先に実行する）: 対話的な検索を長時間のレポートより優先する
+JOB_PRIORITIES = {
+    'drive_search': 0,
+    'task_add': 1,
+    'email': 1,
+    'report': 2,
+}
+
+# ローカルAPIサーバー設定
+SERVER_HOST = '127.0.0.1'  # 既定では同じPCからの接続だけを受け付ける
+SERVER_PORT = 8765
+SERVER_JOB_WORKERS = 6  # サーバーで同時に実行するジョブ数の上限
+SERVER_JOB_HISTORY = 200  # 結果を問い合わせられる終了済みジョブの数
+SERVER_JOB_RETENTION = 3600  # 終了済みジョブの結果を保持する時間（秒）
+SERVER_MAX_BODY_BYTES = 1024 * 1024
+SERVER_KEEPALIVE_TIMEOUT = 60  # 次のリクエストを待つ時間（秒）
+SERVER_STATUS_TEXTS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large'}
+
+# GUI設定
+UI_FRAME_INTERVAL_MS = 33  # GUI更新をまとめて反映する間隔（約30fps）
+
+# LLMレスポンスキャッシュ設定
+LLM_CACHE_PATH = os.path.join(CACHE_DIR, 'llm_cache.sqlite3')
+LLM_CACHE_MAX_BYTES = 50 * 1024 * 1024
+LLM_CACHE_TTLS = {
+    'drive_search': 60 * 60,
+    'email_reply': 7 * 24 * 3600,  # メッセージIDで引くため長めに保持
+    'task_extract': 24 * 3600,
+    'web_report': 30 * 60,  # Web情報は鮮度が重要なため短めに保持
+    'summary': 24 * 3600,
+    'embedding': 7 * 24 * 3600,  # 検索クエリの埋め込み
+    'default': 60 * 60,
+}
+
+# トレースとメトリクスの設定
+TRACE_PATH = os.path.join(CACHE_DIR, 'traces.jsonl')
+TRACE_MAX_BYTES = 5 * 1024 * 1024  # これを超えたらローテーションする
+TRACE_BACKUP_COUNT = 3
+METRICS_PATH = os.path.join(CACHE_DIR, 'metrics.prom')
+METRICS_FLUSH_INTERVAL = 15  # メトリクスファイルを書き出す最短間隔（秒）
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# メトリクスのラベルにする属性（値の種類が少ないものに限る）
+METRICS_LABELS = ('workflow', 'backend', 'model', 'api', 'method', 'service', 'stage', 'action', 'cached', 'hedged', 'status')
+
+# 処理区間
+class Span:
+    """トレースの1区間（名前・属性・所要時間）を表す"""
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+    
+    def set(self, **attributes):
+        """属性を追加・更新する"""
+        self.attributes.update(attributes)
+    
+    def elapsed(self):
+        return time.perf_counter() - self._started
+    
+    def mark_first_token(self):
+        """最初のトークンを受け取った時刻を記録する（2回目以降は無視する）"""
+        self.attributes.setdefault('ttft_ms', round(self.elapsed() * 1000, 1))
+
+# トレースとメトリクスの記録
+class Tracer:
+    """処理区間をJSONLファイルに記録し、所要時間やトークン数をPrometheus形式で集計する"""
+    def __init__(self, trace_path=TRACE_PATH, metrics_path=METRICS_PATH):
+        self.trace_path = trace_path
+        self.metrics_path = metrics_path
+        # スレッドごと・非同期タスクごとに実行中の区間を保持する
+        self._stack = contextvars.ContextVar('trace_stack', default=())
+        self._logger = None
+        self._lock = threading.Lock()
+        self._histograms = {}  # (メトリクス名, ラベル) -> [バケットごとの件数, 合計, 件数]
+        self._counters = {}  # (メトリクス名, ラベル) -> 値
+        self._flushed_at = time.monotonic()
+    
+    def current(self):
+        """現在のスレッド（非同期タスク）で実行中の区間を返す（なければNone）"""
+        stack = self._stack.get()
+        return stack[-1] if stack else None
+    
+    @contextmanager
+    def span(self, name, parent=None, **attributes):
+        """処理区間を記録する（parent省略時は同じスレッド・非同期タスクで実行中の区間を親にする）"""
+        parent = parent or self.current()
+        if parent is not None and 'workflow' in parent.attributes:
+            # どのワークフローの処理かを子の区間にも引き継ぐ
+            attributes.setdefault('workflow', parent.attributes['workflow'])
+        span = Span(
+            name,
+            parent.trace_id if parent is not None else uuid.uuid4().hex,
+            parent.span_id if parent is not None else None,
+            attributes
+        )
+        token = self._stack.set(self._stack.get() + (span,))
+        try:
+            yield span
+        except Exception as e:
+            span.set(status='error', error=f"{type(e).__name__}: {e}")
+            raise
+        except BaseException:
+            span.set(status='cancelled')
+            raise
+        finally:
+            self._stack.reset(token)
+            self._finish(span)
+    
+    def traced(self, name, **attributes):
+        """関数全体を処理区間として記録するデコレーター"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name, **attributes):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+    
+    def _trace_logger(self):
+        if self._logger is None:
+            os.makedirs(os.path.dirname(self.trace_path) or '.', exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                self.trace_path, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUP_COUNT,
+                encoding='utf-8', delay=True
+            )
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger = logging.getLogger('ai_agent.trace')
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(handler)
+            self._logger = logger
+        return self._logger
+    
+    def _finish(self, span):
+        duration = span.elapsed()
+        attributes = span.attributes
+        attributes.setdefault('status', 'ok')
+        try:
+            self._trace_logger().info(json.dumps({
+                'trace_id': span.trace_id,
+                'span_id': span.span_id,
+                'parent_id': span.parent_id,
+                'name': span.name,
+                'start': datetime.fromtimestamp(span.started_at, timezone.utc).isoformat(timespec='milliseconds'),
+                'duration_ms': round(duration * 1000, 1),
+                'thread': threading.current_thread().name,
+                'attributes': attributes,
+            }, ensure_ascii=False, default=str))
+        except (OSError, ValueError) as e:
+            print(f"トレース書き込みエラー: {e}")
+        
+        labels = (('span', span.name),) + tuple(
+            (key, str(attributes[key])) for key in METRICS_LABELS if attributes.get(key) is not None
+        )
+        with self._lock:
+            self._observe('ai_agent_span_duration_seconds', labels, duration)
+            if 'ttft_ms' in attributes:
+                self._observe('ai_agent_llm_time_to_first_token_seconds', labels, attributes['ttft_ms'] / 1000)
+            for kind in ('prompt', 'completion'):
+                if attributes.get(f'{kind}_tokens'):
+                    self._add('ai_agent_llm_tokens_total', labels + (('kind', kind),), attributes[f'{kind}_tokens'])
+            if attributes.get('bytes'):
+                self._add('ai_agent_response_bytes_total', labels, attributes['bytes'])
+            flush = time.monotonic() - self._flushed_at >= METRICS_FLUSH_INTERVAL
+        if flush:
+            self.flush_metrics()
+    
+    def _observe(self, name, labels, value):
+        entry = self._histograms.get((name, labels))
+        if entry is None:
+            entry = self._histograms[(name, labels)] = [[0] * len(METRICS_BUCKETS), 0.0, 0]
+        for index, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+    
+    def _add(self, name, labels, value):
+        self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+    
+    @staticmethod
+    def _format_labels(labels):
+        escaped = (
+            (key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in labels
+        )
+        return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+    
+    def render_metrics(self):
+        """集計結果をPrometheusのテキスト形式で返す"""
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        declared = set()
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            for bound, bucket_count in zip(METRICS_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{self._format_labels(labels + (('le', str(bound)),))} {bucket_count}")
+            lines.append(f"{name}_bucket{self._format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        for (name, labels), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+    
+    def flush_metrics(self):
+        """集計結果をメトリクスファイルに書き出す（一時ファイル経由で置き換える）"""
+        with self._lock:
+            self._flushed_at = time.monotonic()
+        try:
+            os.makedirs(os.path.dirname(self.metrics_path) or '.', exist_ok=True)
+            tmp_path = f"{self.metrics_path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.render_metrics())
+            os.replace(tmp_path, self.metrics_path)
+        except OSError as e:
+            print(f"メトリクス書き込みエラー: {e}")
+
+tracer = Tracer()
+atexit.register(tracer.flush_metrics)
+
+# Discoveryドキュメントのディスクキャッシュ
+class DiscoveryFileCache:
+    """googleapiclientのDiscoveryドキュメントをローカルディスクに保存する"""
+    def __init__(self, directory, ttl=DISCOVERY_CACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+    
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+    
+    def get(self, url):
+        """キャッシュ済みのドキュメントを返す（期限切れや未保存ならNone）"""
+        path = self._path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                self.misses += 1
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return content
+    
+    def set(self, url, content):
+        """ドキュメントを保存する（一時ファイル経由で置き換える）"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(url)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Discoveryキャッシュ保存エラー: {e}")
+
+# Google API通信量の集計（スレッドごと）
+_transport_local = threading.local()
+
+def transport_snapshot():
+    """現在のスレッドでのGoogle API往復回数と受信バイト数を返す"""
+    return (getattr(_transport_local, 'round_trips', 0), getattr(_transport_local, 'bytes', 0))
+
+# Google APIの種類の判定
+def google_api_name(uri):
+    """リクエスト先のURLから (API名, バッチかどうか) を返す（トレースのラベル用）"""
+    parts = urlsplit(uri)
+    segments = [segment for segment in parts.path.split('/') if segment]
+    batch = bool(segments) and segments[0] == 'batch'
+    if batch:
+        segments = segments[1:]
+    host = (parts.hostname or '').split('.')[0]
+    if host and host != 'www':
+        return host, batch
+    return (segments[0] if segments else host), batch
+
+# Google API用HTTPトランスポート
+class MonitoredHttp:
+    """httplib2.Httpを包み、Google APIの通信結果を接続状態の監視と通信量の集計に反映する"""
+    def __init__(self, timeout=GOOGLE_HTTP_TIMEOUT):
+        self.http = httplib2.Http(timeout=timeout)
+    
+    def request(self, uri, method='GET', *args, **kwargs):
+        api, batch = google_api_name(uri)
+        with tracer.span('google.http', api=api, method=method, batch=batch) as span:
+            try:
+                response, content = self.http.request(uri, method, *args, **kwargs)
+            except Exception as e:
+                if is_network_error(e):
+                    connectivity.report_failure('google', e)
+                raise
+            span.set(http_status=response.status, bytes=len(content or b''))
+        connectivity.report_success('google')
+        _transport_local.round_trips = getattr(_transport_local, 'round_trips', 0) + 1
+        _transport_local.bytes = getattr(_transport_local, 'bytes', 0) + len(content or b'')
+        return response, content
+    
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+# Google APIサービスレジストリ
+class GoogleServiceRegistry:
+    """認証情報とAPIクライアントをプロセス全体で共有する"""
+    def __init__(self, token_path='token.pickle', secrets_path='credentials.json'):
+        self.token_path = token_path
+        self.secrets_path = secrets_path
+        self.discovery_cache = DiscoveryFileCache(os.path.join(CACHE_DIR, 'discovery'))
+        self._creds = None
+        self._creds_generation = 0
+        self._services = {}
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._stats = {
+            'credential_loads': 0,
+            'credential_refreshes': 0,
+            'service_hits': 0,
+            'service_builds': 0,
+            'invalidations': 0,
+        }
+    
+    def _save_credentials(self, creds):
+        with open(self.token_path, 'wb') as token:
+            pickle.dump(creds, token)
+    
+    def _expires_soon(self, creds):
+        if not creds.expiry:
+            return False
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return creds.expiry - now < timedelta(seconds=CREDENTIAL_REFRESH_MARGIN)
+    
+    def get_credentials(self):
+        """認証情報を返す（初回のみ読み込み、期限が近ければ事前に更新する）"""
+        with self._lock:
+            creds = self._creds
+            if creds is None:
+                # token.pickleからの認証情報の読み込み
+                with tracer.span('google.credentials', action='load'):
+                    if os.path.exists(self.token_path):
+                        with open(self.token_path, 'rb') as token:
+                            creds = pickle.load(token)
+                self._stats['credential_loads'] += 1
+            
+            if creds and creds.refresh_token and (not creds.valid or self._expires_soon(creds)):
+                # 期限切れ前に更新しておき、API呼び出し中の401を避ける
+                try:
+                    with tracer.span('google.credentials', action='refresh'):
+                        creds.refresh(google_auth_requests.Request())
+                except google_auth_exceptions.RefreshError as e:
+                    # 更新トークンが失効・取り消しされた場合は、認証情報とクライアントを破棄して認可し直す
+                    print(f"認証情報の更新エラー（再認証します）: {e}")
+                    self.invalidate()
+                    creds = None
+                else:
+                    self._stats['credential_refreshes'] += 1
+                    self._save_credentials(creds)
+            if not creds or not creds.valid:
+                with tracer.span('google.credentials', action='authorize'):
+                    flow = google_oauth_flow.InstalledAppFlow.from_client_secrets_file(
+                        self.secrets_path, SCOPES)
+                    creds = flow.run_local_server(port=0)
+                self._save_credentials(creds)
+            
+            if creds is not self._creds:
+                # 認証情報が入れ替わった場合は構築済みクライアントを破棄する
+                self._creds = creds
+                self._creds_generation += 1
+                self._services.clear()
+            return creds
+    
+    def _thread_http(self):
+        """スレッドごとのHTTPトランスポートを返す（httplib2はスレッドセーフでないため）"""
+        local = self._local
+        if getattr(local, 'generation', None) != self._creds_generation:
+            local.http = google_auth_httplib2.AuthorizedHttp(
+                self._creds, http=MonitoredHttp())
+            local.generation = self._creds_generation
+        return local.http
+    
+    def _build_request(self, http, *args, **kwargs):
+        # 構築時のhttpではなく、実行スレッドのトランスポートを使用する
+        return google_http.HttpRequest(self._thread_http(), *args, **kwargs)
+    
+    def _build(self, service_name, version):
+        http = self._thread_http()
+        try:
+            return google_discovery.build(
+                service_name, version,
+                http=http,
+                requestBuilder=self._build_request,
+                cache_discovery=True,
+                cache=self.discovery_cache,
+                static_discovery=False
+            )
+        except Exception as e:
+            # Discoveryドキュメントを取得できない場合はライブラリ同梱版を使用
+            print(f"Discoveryドキュメント取得エラー（同梱版を使用）: {e}")
+            return google_discovery.build(
+                service_name, version,
+                http=http,
+                requestBuilder=self._build_request,
+                static_discovery=True
+            )
+    
+    def get_service(self, service_name, version):
+        """構築済みのサービスクライアントを返す（未構築なら構築してキャッシュする）"""
+        with self._lock:
+            self.get_credentials()
+            key = (service_name, version)
+            service = self._services.get(key)
+            if service is not None:
+                self._stats['service_hits'] += 1
+                return service
+            with tracer.span('google.build', service=service_name, version=version):
+                service = self._build(service_name, version)
+            self._services[key] = service
+            self._stats['service_builds'] += 1
+            return service
+    
+    def invalidate(self):
+        """キャッシュした認証情報とクライアントを破棄する"""
+        with self._lock:
+            self._creds = None
+            self._creds_generation += 1
+            self._services.clear()
+            self._stats['invalidations'] += 1
+    
+    def get_stats(self):
+        """キャッシュヒット数と再構築数を返す"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['discovery_hits'] = self.discovery_cache.hits
+        stats['discovery_misses'] = self.discovery_cache.misses
+        return stats
+
+service_registry = GoogleServiceRegistry()
+
+# Google APIクライアントの統計の出力
+def log_service_stats():
+    """終了時にクライアントの再利用と再構築の回数を出力する（Google APIを使っていなければ何もしない）"""
+    stats = service_registry.get_stats()
+    if not (stats['service_hits'] or stats['service_builds']):
+        return
+    print(
+        f"Google APIクライアント: 再利用{stats['service_hits']}回 / 構築{stats['service_builds']}回"
+        f" / 認証情報の読み込み{stats['credential_loads']}回・更新{stats['credential_refreshes']}回・破棄{stats['invalidations']}回"
+        f" / Discoveryキャッシュ ヒット{stats['discovery_hits']}回・ミス{stats['discovery_misses']}回",
+        file=sys.stderr
+    )
+
+atexit.register(log_service_stats)
 
 # Google APIクライアント取得
 def get_google_service(service_name, version):
     """Google APIサービスのクライアントを取得する"""
-    creds = None
-    # token.pickleからの認証情報の読み込み
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-    
-    # 認証情報が無効か存在しない場合は更新または作成
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        
-        # 次回のために認証情報を保存
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
+    return service_registry.get_service(service_name, version)
+
+# 接続障害の判定
+# モジュールごとの接続障害を表す例外クラス（読み込み済みのモジュールだけを確認する）
+NETWORK_ERROR_CLASSES = (
+    ('openai', ('APIConnectionError',)),
+    ('requests', ('ConnectionError', 'Timeout')),
+    ('httplib2', ('ServerNotFoundError',)),
+    ('httpx', ('TransportError',)),
+)
+
+def is_network_error(error):
+    """接続障害（DNS失敗・タイムアウト・接続拒否など）による例外かどうかを判定する"""
+    if isinstance(error, OSError):
+        return True
+    for module_name, class_names in NETWORK_ERROR_CLASSES:
+        # 読み込まれていないモジュールの例外が送出されることはない
+        module = sys.modules.get(module_name)
+        if module is None:
+            continue
+        for class_name in class_names:
+            error_class = getattr(module, class_name, None)
+            if error_class is not None and isinstance(error, error_class):
+                return True
+    return False
+
+# 接続状態の監視
+class ConnectivityMonitor:
+    """接続状態をバックグラウンドで確認し、呼び出し側には即座に返す"""
+    def __init__(self, probe_url=CONNECTIVITY_PROBE_URL):
+        self.probe_url = probe_url
+        self._online = None  # None は未確認
+        self._checked_at = 0.0
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
     
-    # サービスクライアントを構築して返す
-    return build(service_name, version, credentials=creds)
+    def start(self):
+        """監視スレッドを開始する（開始済みなら何もしない）"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='connectivity-monitor', daemon=True)
+            self._thread.start()
+    
+    def _run(self):
+        while True:
+            with self._lock:
+                ttl = CONNECTIVITY_TTL if self._online else CONNECTIVITY_OFFLINE_TTL
+                remaining = ttl - (time.monotonic() - self._checked_at)
+            if remaining <= 0:
+                self.probe()
+                continue
+            self._wake.wait(remaining)
+            self._wake.clear()
+    
+    def probe(self):
+        """軽量なHTTPリクエストで接続を確認し、結果を状態に反映する"""
+        with tracer.span('connectivity.probe') as span:
+            try:
+                requests.head(self.probe_url, timeout=CONNECTIVITY_PROBE_TIMEOUT)
+                online = True
+            except requests.RequestException:
+                online = False
+            span.set(online=online)
+        self._set_state(online)
+        return online
+    
+    def _set_state(self, online):
+        with self._lock:
+            changed = self._online != online
+            self._online = online
+            self._checked_at = time.monotonic()
+            listeners = list(self._listeners)
+        if changed:
+            for listener in listeners:
+                try:
+                    listener(online)
+                except Exception as e:
+                    print(f"接続状態通知エラー: {e}")
+    
+    def report_success(self, source):
+        """実際のAPI呼び出しが成功したことを記録する"""
+        self._set_state(True)
+    
+    def report_failure(self, source, error):
+        """実際のAPI呼び出しが接続障害で失敗したことを記録し、再確認を早める"""
+        print(f"接続障害を検知しました（{source}）: {error}")
+        self._set_state(False)
+        self._wake.set()
+    
+    def is_online(self):
+        """現在の接続状態を待たずに返す（未確認の場合はオンラインとみなす）"""
+        self.start()
+        with self._lock:
+            return self._online is not False
+    
+    def add_listener(self, callback):
+        """状態が変化したときに callback(online) を呼び出すよう登録する"""
+        with self._lock:
+            self._listeners.append(callback)
+
+connectivity = ConnectivityMonitor()
 
 # オフラインチェック
 def is_online():
     """インターネット接続を確認する"""
+    return connectivity.is_online()
+
+# SQLiteストアの共通処理
+class SQLiteStore:
+    """スレッド間で共有するSQLite接続と状態テーブルを管理する"""
+    SCHEMA = ""
+    
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.RLock()
+    
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+            conn.executescript(self.SCHEMA)
+            self._conn = conn
+        return self._conn
+    
+    def get_state(self, key, default=None):
+        """状態テーブルから値を読み込む"""
+        with self._lock:
+            row = self._connect().execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+    
+    def set_state(self, key, value):
+        """状態テーブルに値を保存する"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, value))
+            conn.commit()
+
+# LLMレスポンスキャッシュ
+class ResponseCache(SQLiteStore):
+    """LLMの応答をSQLiteに保存し、同じ入力への再問い合わせを省く"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            workflow TEXT,
+            response TEXT,
+            size INTEGER,
+            created_at REAL,
+            expires_at REAL,
+            accessed_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at);
+    """
+    
+    def __init__(self, path=LLM_CACHE_PATH, max_bytes=LLM_CACHE_MAX_BYTES):
+        super().__init__(path)
+        self.max_bytes = max_bytes
+        self._stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+    
+    @staticmethod
+    def make_key(backend, model, system_message, content):
+        """バックエンド・モデル・システムメッセージ・入力からキーを作成する"""
+        payload = json.dumps([backend, model, system_message, content], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def get(self, *keys):
+        """キャッシュ済みの応答を返す（複数のキーは順に引き、最初に見つかったものを返す。未保存・期限切れならNone）"""
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                try:
+                    conn = self._connect()
+                    row = conn.execute(
+                        "SELECT response, expires_at FROM responses WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row is None or row[1] < now:
+                        if row is not None:
+                            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                            conn.commit()
+                        continue
+                    conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                    conn.commit()
+                except sqlite3.Error as e:
+                    print(f"LLMキャッシュ読み込みエラー: {e}")
+                    break
+                self._stats['hits'] += 1
+                return row[0]
+            # 複数のキーを引いても、1回の問い合わせとして数える
+            self._stats['misses'] += 1
+            return None
+    
+    def set(self, key, response, workflow='default'):
+        """応答を保存し、上限を超えた分を古い順に削除する"""
+        now = time.time()
+        ttl = LLM_CACHE_TTLS.get(workflow, LLM_CACHE_TTLS['default'])
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, workflow, response, size, now, now + ttl, now)
+                )
+                self._stats['writes'] += 1
+                self._evict(conn, now)
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"LLMキャッシュ書き込みエラー: {e}")
+    
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # 最終アクセスが古いものから上限に収まるまで削除（LRU）
+        for key, size in conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            self._stats['evictions'] += 1
+    
+    def clear(self):
+        """保存済みの応答をすべて削除する"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM responses")
+            conn.commit()
+    
+    def get_stats(self):
+        """ヒット・ミスなどの統計を返す"""
+        with self._lock:
+            stats = dict(self._stats)
+            try:
+                row = self._connect().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+                ).fetchone()
+                stats['entries'], stats['bytes'] = row
+            except sqlite3.Error:
+                pass
+        return stats
+
+response_cache = ResponseCache()
+
+# LLMキャッシュの統計の出力
+def log_response_cache_stats():
+    """終了時にキャッシュのヒット率と保存量を出力する（問い合わせがなければ何もしない）"""
+    stats = response_cache.get_stats()
+    lookups = stats['hits'] + stats['misses']
+    if not lookups:
+        return
+    print(
+        f"LLMキャッシュ: ヒット{stats['hits']}回 / ミス{stats['misses']}回（ヒット率{stats['hits'] / lookups:.0%}）"
+        f" / 保存{stats['writes']}回・削除{stats['evictions']}回"
+        f" / {stats.get('entries', 0)}件・{stats.get('bytes', 0) / 1024:.1f}KB",
+        file=sys.stderr
+    )
+
+atexit.register(log_response_cache_stats)
+
+# トークン数の見積もり
+def estimate_tokens(text):
+    """おおよそのトークン数を見積もる（英数字は約4文字、それ以外は約1文字で1トークン）"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+# トークナイザー（tiktokenは任意。未インストールの場合は見積もりを使う）
+tiktoken = LazyModule('tiktoken')
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+def _tokenizer(model):
+    """モデルに対応するtiktokenのエンコーディングを返す（使えない場合はNone）"""
+    with _encodings_lock:
+        if model not in _encodings:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except Exception:
+                # 未インストール・非対応モデル（Gemmaなど）・BPEファイルを取得できない場合
+                _encodings[model] = None
+        return _encodings[model]
+
+def count_tokens(text, model=OPENAI_MODEL):
+    """モデルのトークナイザーでトークン数を数える（使えない場合は見積もる）"""
+    encoding = _tokenizer(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text, max_tokens, model=OPENAI_MODEL):
+    """テキストを先頭からmax_tokensトークン以内に切り詰める"""
+    if max_tokens <= 0:
+        return ""
+    encoding = _tokenizer(model)
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    # estimate_tokensと同じ重みで数える
+    cost = 1.0
+    for index, ch in enumerate(text):
+        cost += 0.25 if ord(ch) < 128 else 1
+        if cost > max_tokens:
+            return text[:index]
+    return text
+
+def workflow_model(backend, workflow='default'):
+    """ワークフローでそのバックエンドに使うモデルを返す"""
+    return LLM_MODELS.get(workflow, {}).get(backend) or LLM_MODELS['default'][backend]
+
+def model_backend(model):
+    """モデルを提供するバックエンドの名前を返す"""
+    local_models = {models.get('ollama') for models in LLM_MODELS.values()}
+    return 'ollama' if model in local_models else 'openai'
+
+def current_model(workflow='default'):
+    """次のLLM呼び出しで使われるモデルを返す"""
+    return workflow_model('openai' if is_online() else 'ollama', workflow)
+
+def prompt_budget(workflow, model):
+    """入力に使えるトークン数を返す（モデルのコンテキストとワークフローの上限の小さい方）"""
+    available = (
+        MODEL_CONTEXT_TOKENS.get(model, MODEL_CONTEXT_TOKENS[LOCAL_MODEL])
+        - MODEL_OUTPUT_RESERVE.get(model, MODEL_OUTPUT_RESERVE[LOCAL_MODEL])
+        - PROMPT_TEMPLATE_RESERVE
+    )
+    return max(0, min(PROMPT_BUDGETS.get(workflow, PROMPT_BUDGETS['default']), available))
+
+def call_budget(workflow):
+    """次のLLM呼び出しを受けうるどのモデルにも収まる入力のトークン数を返す（オンライン時もヘッジ・遮断・フォールバックでGemmaが応答しうる）"""
+    backends = ('openai', 'ollama') if is_online() else ('ollama',)
+    return min(prompt_budget(workflow, workflow_model(backend, workflow)) for backend in backends)
+
+def allocate_budget(total, sizes, weights=None):
+    """予算をソースごとに重みで配分する（必要量が配分より少ないソースの余りは他に回す）"""
+    weights = weights or {}
+    allocation = {}
+    remaining = dict(sizes)
+    while remaining:
+        weight_sum = sum(weights.get(name, 1) for name in remaining)
+        shares = {name: total * weights.get(name, 1) / weight_sum for name in remaining}
+        satisfied = [name for name, size in remaining.items() if size <= shares[name]]
+        if not satisfied:
+            for name in remaining:
+                allocation[name] = int(shares[name])
+            break
+        for name in satisfied:
+            allocation[name] = remaining.pop(name)
+            total -= allocation[name]
+    return allocation
+
+# APIレート制限
+class RateLimiter:
+    """1分あたりのリクエスト数とトークン数を制限する"""
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._cond = threading.Condition()
+    
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+    
+    def _reserve(self, tokens):
+        """枠があれば消費して0を、なければ空くまでの秒数を返す（_condを保持して呼ぶ）"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = self._blocked_until - now
+        if wait > 0:
+            return wait
+        if self._requests >= 1 and self._tokens >= tokens:
+            self._requests -= 1
+            self._tokens -= tokens
+            return 0
+        return max(
+            (1 - self._requests) * 60 / self.requests_per_minute,
+            (tokens - self._tokens) * 60 / self.tokens_per_minute
+        )
+    
+    def acquire(self, tokens=1):
+        """枠が空くまで待ってからリクエスト1件分とトークンを消費する"""
+        tokens = min(tokens, self.tokens_per_minute)
+        with self._cond:
+            while True:
+                wait = self._reserve(tokens)
+                if wait <= 0:
+                    return
+                self._cond.wait(wait)
+    
+    async def acquire_async(self, tokens=1):
+        """acquireの非同期版（待つ間もイベントループを止めない）"""
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._cond:
+                wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+    
+    def penalize(self, seconds):
+        """429応答を受けたときに、全スレッドの送信を指定秒数止める"""
+        with self._cond:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+openai_rate_limiter = RateLimiter(OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE)
+openai_embedding_limiter = RateLimiter(OPENAI_EMBEDDING_REQUESTS_PER_MINUTE, OPENAI_EMBEDDING_TOKENS_PER_MINUTE)
+
+def _retry_after_seconds(error, attempt):
+    """429応答のヘッダーから待機秒数を取得する（なければ指数バックオフ）"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
     try:
-        requests.get("https://www.google.com", timeout=5)
-        return True
-    except requests.ConnectionError:
-        return False
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass
+    return 2 ** attempt
+
+# LLMバックエンド
+class LLMBackend:
+    """LLMバックエンドの共通インターフェース（chatはコルーチンとして実装し、失敗時は例外を送出する）"""
+    name = None
+    
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+    
+    def client(self):
+        """接続をプールする非同期クライアントを初回使用時に作成する"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self.create_client()
+        return self._client
+    
+    def create_client(self):
+        raise NotImplementedError
+    
+    def http_limits(self):
+        return httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS)
+    
+    def http_timeout(self):
+        # 生成の待ち時間は長く取り、接続の失敗はすぐに検知する
+        return httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+    
+    async def chat(self, model, prompt, system_message, on_chunk=None, json_schema=None, parent=None):
+        """応答を取得する（on_chunk指定時はストリーミング。parentはトレースの親区間）"""
+        raise NotImplementedError
+    
+    async def embed(self, model, texts, parent=None):
+        """テキストごとの埋め込みベクトルをリストで返す"""
+        raise NotImplementedError
+
+# OpenAI APIへの問い合わせ
+class OpenAIBackend(LLMBackend):
+    """AsyncOpenAIで問い合わせる（429応答は全体の送信を止めてから再試行する）"""
+    name = 'openai'
+    
+    def create_client(self):
+        return openai.AsyncOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            timeout=self.http_timeout(),
+            http_client=openai.DefaultAsyncHttpxClient(limits=self.http_limits())
+        )
+    
+    async def chat(self, model, prompt, system_message, on_chunk=None, json_schema=None, parent=None):
+        messages = [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": prompt}
+        ]
+        options = {}
+        if json_schema is not None:
+            # スキーマに沿ったJSONのみを出力させる
+            options['response_format'] = {
+                "type": "json_schema",
+                "json_schema": {"name": json_schema.get('title', 'response'), "schema": json_schema, "strict": True}
+            }
+        prompt_tokens = estimate_tokens(system_message) + estimate_tokens(prompt)
+        estimated_tokens = prompt_tokens + OPENAI_COMPLETION_RESERVE
+        attempt = 0
+        while True:
+            await openai_rate_limiter.acquire_async(estimated_tokens)
+            with tracer.span('llm.call', parent=parent, backend='openai', model=model, stream=on_chunk is not None,
+                             attempt=attempt) as span:
+                usage = None
+                try:
+                    if on_chunk is None:
+                        response = await self.client().chat.completions.create(model=model, messages=messages, **options)
+                        text = response.choices[0].message.content
+                        usage = response.usage
+                    else:
+                        parts = []
+                        stream = await self.client().chat.completions.create(
+                            model=model, messages=messages, stream=True,
+                            stream_options={"include_usage": True}, **options)
+                        async with stream:
+                            async for chunk in stream:
+                                if not chunk.choices:
+                                    # 最後のチャンクにはトークン数だけが含まれる
+                                    usage = chunk.usage or usage
+                                    continue
+                                delta = chunk.choices[0].delta.content
+                                if delta:
+                                    span.mark_first_token()
+                                    parts.append(delta)
+                                    on_chunk(delta)
+                        text = "".join(parts)
+                except openai.RateLimitError as e:
+                    span.set(status='rate_limited')
+                    retry = e
+                except Exception as e:
+                    if is_network_error(e):
+                        connectivity.report_failure('openai', e)
+                    raise
+                else:
+                    retry = None
+                    if usage is not None:
+                        span.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+                    else:
+                        span.set(prompt_tokens=prompt_tokens, completion_tokens=estimate_tokens(text), tokens_estimated=True)
+            if retry is not None:
+                # 他の呼び出しも含めて送信を止め、指定時間後に再試行する
+                openai_rate_limiter.penalize(_retry_after_seconds(retry, attempt))
+                attempt += 1
+                if attempt > OPENAI_RATE_LIMIT_RETRIES:
+                    raise retry
+                continue
+            connectivity.report_success('openai')
+            return text
+    
+    async def embed(self, model, texts, parent=None):
+        await openai_embedding_limiter.acquire_async(sum(estimate_tokens(text) for text in texts))
+        options = {'dimensions': EMBEDDING_DIMENSIONS} if EMBEDDING_DIMENSIONS else {}
+        with tracer.span('llm.embed', parent=parent, backend='openai', model=model, inputs=len(texts)) as span:
+            try:
+                response = await self.client().embeddings.create(model=model, input=texts, **options)
+            except Exception as e:
+                if is_network_error(e):
+                    connectivity.report_failure('openai', e)
+                raise
+            span.set(prompt_tokens=response.usage.prompt_tokens)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+# ローカルLLMへの問い合わせ
+class OllamaBackend(LLMBackend):
+    """ollama.AsyncClientでローカルLLMに問い合わせる（接続先は環境変数OLLAMA_HOST。モデルの読み込みと保持時間も管理する）"""
+    name = 'ollama'
+    
+    def __init__(self):
+        super().__init__()
+        self._uses = {}  # モデル -> 直近の利用時刻
+        self._loads = {}  # モデル -> 最後の読み込み・解放の記録
+    
+    def create_client(self):
+        return ollama.AsyncClient(timeout=self.http_timeout(), limits=self.http_limits())
+    
+    def _model_options(self, model):
+        # 予算の計算と同じコンテキスト長を使わせる（Ollamaの既定値は短い。値が変わるとモデルが読み直される）
+        return {'num_ctx': MODEL_CONTEXT_TOKENS.get(model, MODEL_CONTEXT_TOKENS[LOCAL_MODEL])}
+    
+    def keep_alive(self, model):
+        """直近の利用状況・接続状態・ヘッジの有無から、モデルをメモリに残す時間を返す"""
+        if not is_online():
+            return OLLAMA_KEEP_ALIVE_OFFLINE
+        # ヘッジ中はOpenAIが遅れたときにすぐ応答できるよう、利用頻度にかかわらず残す
+        if LLM_HEDGE_ENABLED and model in local_models():
+            return OLLAMA_KEEP_ALIVE_ACTIVE
+        now = time.monotonic()
+        with self._lock:
+            uses = self._uses.setdefault(model, deque(maxlen=OLLAMA_ACTIVE_USES))
+            recent = sum(1 for used in uses if now - used <= OLLAMA_ACTIVE_WINDOW)
+        return OLLAMA_KEEP_ALIVE_ACTIVE if recent >= OLLAMA_ACTIVE_USES else OLLAMA_KEEP_ALIVE_IDLE
+    
+    def _record_load(self, model, event, span, response=None):
+        # load_durationはナノ秒（読み込み済みならほぼ0）
+        load_duration = response.get('load_duration') if response is not None else None
+        record = {'event': event, 'at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                  'elapsed_ms': round(span.elapsed() * 1000, 1)}
+        if load_duration is not None:
+            record['load_ms'] = round(load_duration / 1e6, 1)
+            span.set(load_ms=record['load_ms'])
+        with self._lock:
+            self._loads[model] = record
+    
+    async def preload(self, model, parent=None):
+        """モデルを読み込んでおく（応答は生成しない。読み込み済みなら保持時間を延ばすだけ）"""
+        keep_alive = self.keep_alive(model)
+        with tracer.span('llm.load', parent=parent, backend='ollama', model=model, keep_alive=keep_alive) as span:
+            response = await self.client().generate(
+                model=model, prompt='', keep_alive=keep_alive, options=self._model_options(model))
+            self._record_load(model, 'load', span, response)
+    
+    async def unload(self, model, parent=None):
+        """モデルをメモリから解放する"""
+        with tracer.span('llm.unload', parent=parent, backend='ollama', model=model) as span:
+            await self.client().generate(model=model, prompt='', keep_alive=0)
+            self._record_load(model, 'unload', span)
+    
+    def snapshot(self):
+        """モデルごとの直近の読み込み・解放と保持時間を返す"""
+        with self._lock:
+            models = set(self._uses) | set(self._loads)
+            loads = dict(self._loads)
+        return {model: dict(loads.get(model, {}), keep_alive=self.keep_alive(model)) for model in sorted(models)}
+    
+    async def chat(self, model, prompt, system_message, on_chunk=None, json_schema=None, parent=None):
+        messages = [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": prompt}
+        ]
+        options = {'options': self._model_options(model), 'keep_alive': self.keep_alive(model)}
+        with self._lock:
+            self._uses.setdefault(model, deque(maxlen=OLLAMA_ACTIVE_USES)).append(time.monotonic())
+        if json_schema is not None:
+            options['format'] = json_schema
+        with tracer.span('llm.call', parent=parent, backend='ollama', model=model, stream=on_chunk is not None,
+                         keep_alive=options['keep_alive']) as span:
+            if on_chunk is None:
+                response = await self.client().chat(model=model, messages=messages, **options)
+                text = response['message']['content']
+            else:
+                parts = []
+                async for response in await self.client().chat(model=model, messages=messages, stream=True, **options):
+                    delta = response['message']['content']
+                    if delta:
+                        span.mark_first_token()
+                        parts.append(delta)
+                        on_chunk(delta)
+                text = "".join(parts)
+            # 読み込み時間とトークン数は最後の応答に含まれる（古いサーバーでは含まれない）
+            if response.get('load_duration') is not None:
+                span.set(load_ms=round(response['load_duration'] / 1e6, 1))
+            prompt_tokens = response.get('prompt_eval_count')
+            completion_tokens = response.get('eval_count')
+            if prompt_tokens is None or completion_tokens is None:
+                span.set(prompt_tokens=estimate_tokens(system_message) + estimate_tokens(prompt),
+                         completion_tokens=estimate_tokens(text), tokens_estimated=True)
+            else:
+                span.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        return text
+    
+    async def embed(self, model, texts, parent=None):
+        with tracer.span('llm.embed', parent=parent, backend='ollama', model=model, inputs=len(texts)) as span:
+            response = await self.client().embed(model=model, input=texts)
+            if response.get('prompt_eval_count') is not None:
+                span.set(prompt_tokens=response['prompt_eval_count'])
+        return response['embeddings']
+
+# LLM呼び出し用のイベントループ
+class LLMRuntime:
+    """専用スレッドの1つのイベントループで全バックエンドの呼び出しを多重化し、同期関数からの呼び出しを仲介する"""
+    _STREAM_END = object()
+    
+    def __init__(self, backends):
+        self.backends = {backend.name: backend for backend in backends}
+        self._loop = None
+        self._lock = threading.Lock()
+    
+    def loop(self):
+        """イベントループを返す（初回はスレッドを起動する）"""
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name='llm-loop', daemon=True).start()
+                    self._loop = loop
+        return self._loop
+    
+    def submit(self, coro):
+        """コルーチンをイベントループで実行し、concurrent.futures.Futureを返す（cancel()で呼び出しを中断できる）"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop())
+    
+    def call(self, make_coro, on_chunk=None):
+        """make_coro(emit, parent)で作ったコルーチンを実行して結果を返す（同期関数から呼ぶ。on_chunkは呼び出し元のスレッドで呼び、例外を送出したら中断する）"""
+        chunks = queue.Queue() if on_chunk is not None else None
+        future = self.submit(make_coro(chunks.put if chunks is not None else None, tracer.current()))
+        try:
+            if chunks is not None:
+                future.add_done_callback(lambda _: chunks.put(self._STREAM_END))
+                while True:
+                    chunk = chunks.get()
+                    if chunk is self._STREAM_END:
+                        break
+                    on_chunk(chunk)
+            return future.result()
+        except BaseException:
+            # ジョブのキャンセルなどで呼び出し元が抜ける場合は、通信も打ち切る
+            future.cancel()
+            raise
+    
+    def chat(self, backend, model, prompt, system_message=DEFAULT_SYSTEM_MESSAGE, on_chunk=None, json_schema=None):
+        """1つのバックエンドに問い合わせる（同期関数から呼ぶ）"""
+        return self.call(
+            lambda emit, parent: self.backends[backend].chat(model, prompt, system_message, emit, json_schema, parent),
+            on_chunk
+        )
+
+llm_runtime = LLMRuntime([OpenAIBackend(), OllamaBackend()])
+
+# 遮断中のバックエンドを呼ぼうとしたときの例外
+class CircuitOpen(Exception):
+    pass
+
+# バックエンドの状態
+class BackendHealth:
+    """直近の遅延と成否を記録し、失敗が続いたら一定時間遮断する（サーキットブレーカー）"""
+    def __init__(self, name):
+        self.name = name
+        self._latencies = {True: deque(maxlen=LLM_HEALTH_WINDOW), False: deque(maxlen=LLM_HEALTH_WINDOW)}
+        self._results = deque(maxlen=LLM_HEALTH_WINDOW)
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+    
+    def allow(self):
+        """呼び出してよいかを返す（遮断から一定時間たったら、試しに1件だけ通す）"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < LLM_BREAKER_COOLDOWN:
+                return False
+            self._probing = True
+            return True
+    
+    def record_success(self, latency, stream):
+        """成功と遅延（ストリーミングなら最初の出力まで、それ以外は全体）を記録する"""
+        with self._lock:
+            self._latencies[stream].append(latency)
+            self._results.append(True)
+            self._consecutive_failures = 0
+            closed = self._opened_at is not None
+            self._opened_at = None
+            self._probing = False
+        if closed:
+            print(f"LLMバックエンドの遮断を解除しました: {self.name}")
+    
+    def record_failure(self):
+        with self._lock:
+            self._results.append(False)
+            self._consecutive_failures += 1
+            failures = self._results.count(False)
+            trip = (
+                self._probing
+                or self._consecutive_failures >= LLM_BREAKER_FAILURES
+                or (len(self._results) >= LLM_BREAKER_MIN_CALLS and failures / len(self._results) >= LLM_BREAKER_ERROR_RATE)
+            )
+            opened = trip and (self._opened_at is None or self._probing)
+            if trip:
+                self._opened_at = time.monotonic()
+            self._probing = False
+        if opened:
+            print(f"LLMバックエンドを{LLM_BREAKER_COOLDOWN}秒間遮断します: {self.name}")
+    
+    def release(self):
+        """試しに通した呼び出しが結果を出さずに終わったときに、次の呼び出しを通せるようにする"""
+        with self._lock:
+            self._probing = False
+    
+    def hedge_delay(self, stream):
+        """ヘッジを始めるまでの秒数を返す（計測が足りなければNone）"""
+        with self._lock:
+            latencies = sorted(self._latencies[stream])
+        if len(latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * LLM_HEDGE_PERCENTILE / 100))
+        return max(LLM_HEDGE_MIN_DELAY, latencies[index])
+    
+    def snapshot(self):
+        with self._lock:
+            results = list(self._results)
+            state = 'closed' if self._opened_at is None else ('half_open' if self._probing else 'open')
+        return {
+            'state': state,
+            'calls': len(results),
+            'error_rate': round(results.count(False) / len(results), 3) if results else 0.0,
+            'hedge_delay_seconds': {'stream': self.hedge_delay(True), 'complete': self.hedge_delay(False)},
+        }
+
+# LLMルーター
+class LLMRouter:
+    """バックエンドごとの遅延と失敗を記録し、OpenAIが遅いときはローカルLLMにヘッジし、失敗が続くときは遮断する"""
+    def __init__(self, runtime, primary='openai', secondary='ollama'):
+        self.runtime = runtime
+        self.primary = primary
+        self.secondary = secondary
+        self.health = {name: BackendHealth(name) for name in runtime.backends}
+    
+    async def _timed(self, backend, model, prompt, system_message, emit, json_schema, parent):
+        """バックエンドを呼び出し、遅延と成否を記録する"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        first_output = []
+        
+        def on_chunk(chunk):
+            if not first_output:
+                first_output.append(loop.time())
+            emit(chunk)
+        
+        try:
+            text = await self.runtime.backends[backend].chat(
+                model, prompt, system_message, on_chunk if emit is not None else None, json_schema, parent)
+        except asyncio.CancelledError:
+            self.health[backend].release()
+            raise
+        except Exception:
+            self.health[backend].record_failure()
+            raise
+        finished = first_output[0] if first_output else loop.time()
+        self.health[backend].record_success(finished - started, emit is not None)
+        return text
+    
+    def chat(self, backend, model, prompt, system_message=DEFAULT_SYSTEM_MESSAGE, on_chunk=None, json_schema=None):
+        """1つのバックエンドに問い合わせる（遮断中ならCircuitOpenを送出する）"""
+        if not self.health[backend].allow():
+            raise CircuitOpen(f"{backend}は遮断中です")
+        return self.runtime.call(
+            lambda emit, parent: self._timed(backend, model, prompt, system_message, emit, json_schema, parent),
+            on_chunk
+        )
+    
+    def respond(self, workflow, prompt, system_message=DEFAULT_SYSTEM_MESSAGE, cache_key=None, on_chunk=None, json_schema=None):
+        """OpenAIに問い合わせ、遅ければローカルLLMにも問い合わせて先に応答したほうを返す（副バックエンドが答えた応答はヘッジ専用のキーでキャッシュする）"""
+        model = workflow_model(self.primary, workflow)
+        content = _cache_content(prompt, cache_key, json_schema)
+        with tracer.span('llm.request', backend=self.primary, model=model, purpose=workflow) as span:
+            # ヘッジでローカルLLMが答えた応答も使い回す（オフライン時やフォールバックの応答は使わない）
+            keys = [response_cache.make_key(self.primary, model, system_message, content)]
+            if LLM_HEDGE_ENABLED:
+                keys.append(self._hedge_key(workflow, system_message, content))
+            cached = response_cache.get(*keys)
+            span.set(cached=cached is not None)
+            if cached is not None:
+                if on_chunk is not None:
+                    on_chunk(cached)
+                return cached
+            if not self.health[self.primary].allow():
+                raise CircuitOpen(f"{self.primary}は遮断中です")
+            text, backend, used_model = self.runtime.call(
+                lambda emit, parent: self._race(workflow, prompt, system_message, emit, json_schema, parent, span),
+                on_chunk
+            )
+            span.set(backend=backend, model=used_model)
+            if backend == self.primary:
+                key = response_cache.make_key(backend, used_model, system_message, content)
+            else:
+                key = self._hedge_key(workflow, system_message, content)
+            response_cache.set(key, text, workflow)
+            return text
+    
+    def _hedge_key(self, workflow, system_message, content):
+        # ヘッジで副バックエンドが答えた応答は専用のキーで保存し、オンライン時に使い回してよいものと区別する
+        return response_cache.make_key(f"{self.secondary}:hedge", workflow_model(self.secondary, workflow), system_message, content)
+    
+    async def _race(self, workflow, prompt, system_message, emit, json_schema, parent, span):
+        """主バックエンドが遅延の百分位を超えても応答しなければ、副バックエンドにも問い合わせる"""
+        winner = []
+        first_output = asyncio.Event()
+        tasks = {}
+        
+        def emitter(backend):
+            def on_chunk(chunk):
+                # ストリーミングでは最初に出力したほうに決め、もう一方は打ち切る
+                if not winner:
+                    winner.append(backend)
+                    first_output.set()
+                    for name, task in tasks.items():
+                        if name != backend:
+                            task.cancel()
+                if winner[0] == backend:
+                    emit(chunk)
+            return on_chunk if emit is not None else None
+        
+        def start(backend):
+            model = workflow_model(backend, workflow)
+            task = asyncio.ensure_future(self._timed(
+                backend, model, prompt, system_message, emitter(backend), json_schema, parent))
+            # 打ち切ったほうの例外が未処理として報告されないようにする
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            tasks[backend] = task
+            return model
+        
+        models = {self.primary: start(self.primary)}
+        span.set(hedged=False)
+        delay = self.health[self.primary].hedge_delay(emit is not None)
+        if LLM_HEDGE_ENABLED and delay is not None:
+            waiter = asyncio.ensure_future(first_output.wait())
+            try:
+                await asyncio.wait({tasks[self.primary], waiter}, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+            if not tasks[self.primary].done() and not first_output.is_set() and self.health[self.secondary].allow():
+                span.set(hedged=True, hedge_delay_ms=round(delay * 1000, 1))
+                models[self.secondary] = start(self.secondary)
+        
+        try:
+            pending = set(tasks.values())
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for backend, task in tasks.items():
+                    if task not in done or task.cancelled():
+                        continue
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    if winner and winner[0] != backend:
+                        continue
+                    span.set(winner=backend)
+                    return task.result(), backend, models[backend]
+            raise error
+        finally:
+            for task in tasks.values():
+                task.cancel()
+    
+    def snapshot(self):
+        """バックエンドごとの状態を返す"""
+        return {name: health.snapshot() for name, health in self.health.items()}
+
+llm_router = LLMRouter(llm_runtime)
+
+# ローカルモデルの管理
+def local_models():
+    """ワークフローで使うローカルモデルの一覧を返す"""
+    return sorted({models['ollama'] for models in LLM_MODELS.values() if models.get('ollama')})
+
+def _report_model_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"ローカルモデルの読み込みエラー: {future.exception()}")
+
+def preload_local_models():
+    """ローカルモデルを裏で読み込む（最初の呼び出しで読み込みを待たないようにする）"""
+    backend = llm_runtime.backends['ollama']
+    for model in local_models():
+        llm_runtime.submit(backend.preload(model)).add_done_callback(_report_model_error)
+
+def on_connectivity_change_for_local_models(online):
+    """オフラインになったらローカルモデルを読み込み、オンラインに戻ってヘッジもしない場合は解放する"""
+    backend = llm_runtime.backends['ollama']
+    if not online:
+        preload_local_models()
+    elif not LLM_HEDGE_ENABLED:
+        for model in local_models():
+            llm_runtime.submit(backend.unload(model)).add_done_callback(_report_model_error)
+
+def start_local_model_manager():
+    """起動時にローカルモデルを裏で読み込み、以後は接続状態に合わせて読み込み・解放する"""
+    connectivity.add_listener(on_connectivity_change_for_local_models)
+    # ヘッジではオンライン中もローカルLLMを使うため、起動時から読み込んでおく
+    if LLM_HEDGE_ENABLED or not is_online():
+        preload_local_models()
+
+# キャッシュ経由のLLM呼び出し
+def _cache_content(prompt, cache_key, json_schema):
+    content = cache_key or prompt
+    return content if json_schema is None else [content, json_schema]
+
+def cached_llm_call(backend, model, prompt, system_message, call, workflow='default', cache_key=None, on_chunk=None, json_schema=None):
+    """キャッシュに応答があれば返し、なければ call() の結果を保存して返す"""
+    with tracer.span('llm.request', backend=backend, model=model, purpose=workflow) as span:
+        key = response_cache.make_key(backend, model, system_message, _cache_content(prompt, cache_key, json_schema))
+        cached = response_cache.get(key)
+        span.set(cached=cached is not None)
+        if cached is not None:
+            if on_chunk is not None:
+                on_chunk(cached)
+            return cached
+        text = call()
+        response_cache.set(key, text, workflow)
+        return text
+
+# ストリーミングの出力状況を記録
+class _ChunkTracker:
+    """on_chunkを中継し、出力済みかどうかを記録する"""
+    def __init__(self, on_chunk):
+        self.on_chunk = on_chunk
+        self.emitted = False
+    
+    def __call__(self, text):
+        self.emitted = True
+        self.on_chunk(text)
 
 # OpenAI APIまたはローカルLLMを使用して応答を生成
-def get_ai_response(prompt, system_message="あなたは役立つAIアシスタントです。"):
+def get_ai_response(prompt, system_message=DEFAULT_SYSTEM_MESSAGE, workflow='default', cache_key=None, on_chunk=None, json_schema=None):
     """AIからの応答を取得する（オンラインならOpenAI、オフラインならGemma）"""
+    model = workflow_model('openai', workflow)
     if is_online():
+        tracker = _ChunkTracker(on_chunk) if on_chunk is not None else None
         try:
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": prompt}
-                ]
-            )
-            return response.choices[0].message.content
+            return llm_router.respond(workflow, prompt, system_message, cache_key, tracker, json_schema)
+        except CircuitOpen:
+            # 失敗が続いている間はOpenAIを待たずにGemmaを使う
+            return get_local_llm_response(prompt, system_message, workflow, cache_key, on_chunk, json_schema)
         except Exception as e:
             print(f"OpenAI API エラー: {e}")
+            if tracker is not None and tracker.emitted:
+                # 途中まで表示した内容と区別できるようにする
+                on_chunk(FALLBACK_NOTICE)
             # OpenAI APIでエラーが発生した場合はGemmaにフォールバック
-            return get_local_llm_response(prompt, system_message)
+            return get_local_llm_response(prompt, system_message, workflow, cache_key, on_chunk, json_schema)
     else:
-        return get_local_llm_response(prompt, system_message)
+        # オフラインでも以前のOpenAIの応答が残っていればそちらを優先する
+        cached = response_cache.get(response_cache.make_key(
+            'openai', model, system_message, _cache_content(prompt, cache_key, json_schema)))
+        if cached is not None:
+            if on_chunk is not None:
+                on_chunk(cached)
+            return cached
+        return get_local_llm_response(prompt, system_message, workflow, cache_key, on_chunk, json_schema)
 
 # ローカルLLM（Gemma）からの応答を取得
-def get_local_llm_response(prompt, system_message="あなたは役立つAIアシスタントです。"):
+def get_local_llm_response(prompt, system_message=DEFAULT_SYSTEM_MESSAGE, workflow='default', cache_key=None, on_chunk=None, json_schema=None):
     """ローカルLLM（Gemma）からの応答を取得する"""
+    model = workflow_model('ollama', workflow)
     try:
-        response = ollama.chat(
-            model='gemma:1b',
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": prompt}
-            ]
+        return cached_llm_call(
+            'ollama', model, prompt, system_message,
+            lambda: llm_router.chat('ollama', model, prompt, system_message, on_chunk, json_schema),
+            workflow, cache_key, on_chunk, json_schema
         )
-        return response['message']['content']
     except Exception as e:
         print(f"ローカルLLMエラー: {e}")
-        return "申し訳ありません。AIサービスに接続できませんでした。インターネット接続とLLMの状態を確認してください。"
+        return LLM_UNAVAILABLE_MESSAGE
+
+# 長い入力の分割
+def split_into_chunks(text, chunk_tokens, model=OPENAI_MODEL):
+    """行の区切りを優先して、1つあたりchunk_tokens以内のチャンクに分割する"""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for line in text.splitlines(keepends=True):
+        pieces = [line]
+        if count_tokens(line, model) > chunk_tokens:
+            # 1行で上限を超える場合は途中で切る
+            pieces = []
+            while line:
+                head = truncate_to_tokens(line, chunk_tokens, model) or line[:1]
+                pieces.append(head)
+                line = line[len(head):]
+        for piece in pieces:
+            piece_tokens = count_tokens(piece, model)
+            if current and current_tokens + piece_tokens > chunk_tokens:
+                chunks.append("".join(current))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+# 一覧の切り詰め
+def fit_lines_to_budget(text, budget, model=OPENAI_MODEL):
+    """関連度順の一覧を、先頭の行から予算に収まるだけ残す"""
+    lines = []
+    used = 0
+    for line in text.splitlines():
+        line_tokens = count_tokens(line, model) + 1
+        if used + line_tokens > budget:
+            break
+        lines.append(line)
+        used += line_tokens
+    return "\n".join(lines)
+
+# 予算に合わせた要約（map-reduce）
+def _summarize_chunk(chunk, target_tokens, model):
+    prompt = f"""
+    以下の文章を、{target_tokens}トークン程度に収まるように要約してください。
+    固有名詞・数値・日付・依頼事項や質問は省略しないでください。
+    
+    {chunk}
+    """
+    if model_backend(model) == 'ollama':
+        summary = get_local_llm_response(prompt, SUMMARY_SYSTEM_MESSAGE, workflow='summary')
+    else:
+        summary = get_ai_response(prompt, SUMMARY_SYSTEM_MESSAGE, workflow='summary')
+    if summary == LLM_UNAVAILABLE_MESSAGE:
+        # 要約できない場合は先頭部分だけを使う
+        return truncate_to_tokens(chunk, target_tokens, model)
+    return summary
+
+def fit_to_budget(text, budget, model=OPENAI_MODEL, purpose='default', depth=0, check_cancelled=None):
+    """予算を超えるテキストはチャンクごとに並行して要約し、結合して予算内に収める（超えなければそのまま返す。check_cancelledはLLM呼び出しの前に呼ぶ）"""
+    tokens = count_tokens(text, model)
+    if tokens <= budget:
+        return text
+    if budget <= 0:
+        return ""
+    with tracer.span('prompt.summarize', model=model, purpose=purpose, input_tokens=tokens, budget=budget) as span:
+        chunk_tokens = prompt_budget('summary', model)
+        # 上限を超える部分は要約せずに切り捨て、処理時間と費用を一定に保つ
+        chunks = split_into_chunks(
+            truncate_to_tokens(text, chunk_tokens * SUMMARY_MAX_CHUNKS, model), chunk_tokens, model)
+        target_tokens = max(100, budget // len(chunks))
+        
+        def summarize(chunk):
+            if check_cancelled is not None:
+                check_cancelled()
+            with tracer.span('prompt.summarize.chunk', parent=span):
+                return _summarize_chunk(chunk, target_tokens, model)
+        
+        executor = ThreadPoolExecutor(max_workers=min(SUMMARY_CONCURRENCY, len(chunks)), thread_name_prefix='summary')
+        try:
+            summary = "\n\n".join(executor.map(summarize, chunks))
+        finally:
+            # キャンセルや例外で抜けた場合は、まだ始まっていない要約を取り消す
+            executor.shutdown(wait=False, cancel_futures=True)
+        span.set(chunks=len(chunks), output_tokens=count_tokens(summary, model))
+    
+    if count_tokens(summary, model) <= budget:
+        return summary
+    if depth == 0 and len(chunks) > 1:
+        # 要約を結合してもまだ長い場合は、もう1段だけ要約する
+        return fit_to_budget(summary, budget, model, purpose, depth + 1, check_cancelled)
+    return truncate_to_tokens(summary, budget, model)
+
+# Googleドライブのローカル索引
+class DriveIndex(SQLiteStore):
+    """ドライブのメタデータと本文テキストを全文検索用に保存する"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            mime_type TEXT,
+            description TEXT,
+            web_view_link TEXT,
+            created_time TEXT,
+            modified_time TEXT,
+            size INTEGER,
+            content TEXT,
+            content_version TEXT
+        );
+        CREATE INDEX IF NOT EXISTS files_modified ON files (modified_time);
+    """
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+            name, description, content,
+            content='files', content_rowid='rowid', tokenize='{tokenizer}'
+        );
+        CREATE TRIGGER IF NOT EXISTS files_ai AFTER INSERT ON files BEGIN
+            INSERT INTO files_fts(rowid, name, description, content)
+            VALUES (new.rowid, new.name, new.description, new.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_ad AFTER DELETE ON files BEGIN
+            INSERT INTO files_fts(files_fts, rowid, name, description, content)
+            VALUES ('delete', old.rowid, old.name, old.description, old.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_au AFTER UPDATE ON files BEGIN
+            INSERT INTO files_fts(files_fts, rowid, name, description, content)
+            VALUES ('delete', old.rowid, old.name, old.description, old.content);
+            INSERT INTO files_fts(rowid, name, description, content)
+            VALUES (new.rowid, new.name, new.description, new.content);
+        END;
+    """
+    
+    def __init__(self, path=DRIVE_INDEX_PATH):
+        super().__init__(path)
+        self.tokenizer = None
+        self._sync_lock = threading.Lock()
+        self._last_sync = 0.0
+    
+    def _connect(self):
+        if self._conn is None:
+            conn = super()._connect()
+            row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'files_fts'").fetchone()
+            if row:
+                self.tokenizer = 'trigram' if 'trigram' in row[0] else 'unicode61'
+            else:
+                # 日本語は単語区切りがないため、部分一致できるtrigramを優先する
+                try:
+                    conn.executescript(self.FTS_SCHEMA.format(tokenizer='trigram'))
+                    self.tokenizer = 'trigram'
+                except sqlite3.OperationalError:
+                    conn.executescript(self.FTS_SCHEMA.format(tokenizer='unicode61'))
+                    self.tokenizer = 'unicode61'
+        return self._conn
+    
+    def is_ready(self):
+        """初回同期が完了しているかどうかを返す"""
+        return self.get_state('page_token') is not None
+    
+    def apply_files(self, files):
+        """Drive APIのファイル情報を反映する（ゴミ箱のファイルは削除する）"""
+        with self._lock:
+            conn = self._connect()
+            for item in files:
+                if item.get('trashed'):
+                    conn.execute("DELETE FROM files WHERE id = ?", (item['id'],))
+                    continue
+                conn.execute(
+                    """
+                    INSERT INTO files (id, name, mime_type, description, web_view_link,
+                                       created_time, modified_time, size)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        name = excluded.name,
+                        mime_type = excluded.mime_type,
+                        description = excluded.description,
+                        web_view_link = excluded.web_view_link,
+                        created_time = excluded.created_time,
+                        modified_time = excluded.modified_time,
+                        size = excluded.size
+                    """,
+                    (
+                        item['id'], item.get('name', ''), item.get('mimeType', ''),
+                        item.get('description'), item.get('webViewLink'),
+                        item.get('createdTime'), item.get('modifiedTime'),
+                        int(item['size']) if item.get('size') else None
+                    )
+                )
+            conn.commit()
+    
+    def remove_files(self, file_ids):
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("DELETE FROM files WHERE id = ?", [(file_id,) for file_id in file_ids])
+            conn.commit()
+    
+    def pending_content(self, limit):
+        """本文の取り込みが必要なファイル（新規または更新済み）を新しい順に返す"""
+        placeholders = ",".join("?" * len(DRIVE_EXPORT_MIME_TYPES))
+        with self._lock:
+            return self._connect().execute(
+                f"""
+                SELECT id, mime_type, modified_time FROM files
+                WHERE (content_version IS NULL OR content_version != modified_time)
+                  AND (mime_type IN ({placeholders})
+                       OR (mime_type LIKE 'text/%' AND COALESCE(size, 0) <= ?))
+                ORDER BY modified_time DESC LIMIT ?
+                """,
+                (*DRIVE_EXPORT_MIME_TYPES, DRIVE_CONTENT_MAX_BYTES, limit)
+            ).fetchall()
+    
+    def embeddable_files(self):
+        """本文を取り込み済みのファイルを (ID, 名前, リンク, 本文の版) で新しい順に返す"""
+        with self._lock:
+            return self._connect().execute(
+                """
+                SELECT id, name, web_view_link, content_version FROM files
+                WHERE content IS NOT NULL AND content != ''
+                ORDER BY modified_time DESC
+                """
+            ).fetchall()
+    
+    def get_content(self, file_id):
+        with self._lock:
+            row = self._connect().execute("SELECT content FROM files WHERE id = ?", (file_id,)).fetchone()
+        return row[0] if row else None
+    
+    def set_content(self, file_id, content, version):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "UPDATE files SET content = ?, content_version = ? WHERE id = ?",
+                (content, version, file_id)
+            )
+            conn.commit()
+    
+    def _full_sync(self, drive_service):
+        # 一覧取得中の変更を取りこぼさないよう、先に変更フィードの開始位置を控える
+        start_token = drive_service.changes().getStartPageToken().execute()['startPageToken']
+        page_token = None
+        while True:
+            results = drive_service.files().list(
+                q="trashed=false",
+                spaces='drive',
+                pageSize=DRIVE_LIST_PAGE_SIZE,
+                pageToken=page_token,
+                fields=f"nextPageToken,files({DRIVE_FILE_FIELDS})"
+            ).execute()
+            self.apply_files(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+        self.set_state('page_token', start_token)
+    
+    def _incremental_sync(self, drive_service, page_token):
+        while True:
+            results = drive_service.changes().list(
+                pageToken=page_token,
+                spaces='drive',
+                pageSize=DRIVE_LIST_PAGE_SIZE,
+                includeRemoved=True,
+                fields=f"nextPageToken,newStartPageToken,changes(fileId,removed,file({DRIVE_FILE_FIELDS}))"
+            ).execute()
+            changes = results.get('changes', [])
+            self.remove_files([change['fileId'] for change in changes if change.get('removed')])
+            self.apply_files([change['file'] for change in changes if not change.get('removed') and 'file' in change])
+            if 'newStartPageToken' in results:
+                self.set_state('page_token', results['newStartPageToken'])
+                return
+            page_token = results['nextPageToken']
+            # 途中まで反映した位置を保存し、中断しても続きから再開できるようにする
+            self.set_state('page_token', page_token)
+    
+    def _sync_content(self, drive_service):
+        for file_id, mime_type, version in self.pending_content(DRIVE_CONTENT_BATCH):
+            try:
+                if mime_type in DRIVE_EXPORT_MIME_TYPES:
+                    data = drive_service.files().export(
+                        fileId=file_id, mimeType=DRIVE_EXPORT_MIME_TYPES[mime_type]).execute()
+                else:
+                    data = drive_service.files().get_media(fileId=file_id).execute()
+                content = data.decode('utf-8', errors='replace')[:DRIVE_CONTENT_MAX_CHARS]
+            except google_errors.HttpError as e:
+                # 変換できないファイルは空として記録し、更新されるまで再試行しない
+                print(f"ドライブ本文取得エラー（{file_id}）: {e}")
+                content = ""
+            self.set_content(file_id, content, version)
+    
+    def sync(self, drive_service):
+        """変更フィードで索引を最新にし、本文を取り込む（同期中なら何もしない）"""
+        if not self._sync_lock.acquire(blocking=False):
+            return False
+        try:
+            page_token = self.get_state('page_token')
+            with tracer.span('drive_index.sync', mode='full' if page_token is None else 'incremental'):
+                if page_token is None:
+                    self._full_sync(drive_service)
+                else:
+                    self._incremental_sync(drive_service, page_token)
+                self._sync_content(drive_service)
+                embedding_index.update(self)
+            self._last_sync = time.monotonic()
+            return True
+        finally:
+            self._sync_lock.release()
+    
+    def ensure_fresh(self):
+        """前回の同期から一定時間経っていれば、バックグラウンドで同期を開始する"""
+        if time.monotonic() - self._last_sync < DRIVE_SYNC_INTERVAL or self._sync_lock.locked():
+            return
+        
+        def run():
+            try:
+                self.sync(get_google_service('drive', 'v3'))
+            except Exception as e:
+                print(f"ドライブ索引の同期エラー: {e}")
+        
+        threading.Thread(target=run, name='drive-index-sync', daemon=True).start()
+    
+    def search(self, query, limit=10):
+        """索引を全文検索し、関連度の高い順にDrive APIと同じ形式で返す"""
+        terms = [term for term in query.split() if term]
+        if not terms:
+            return []
+        columns = """
+            f.id, f.name, f.mime_type, f.web_view_link, f.description,
+            f.created_time, f.modified_time
+        """
+        with self._lock:
+            conn = self._connect()
+            if self.tokenizer != 'trigram' or all(len(term) >= 3 for term in terms):
+                match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+                rows = conn.execute(
+                    f"""
+                    SELECT {columns}, snippet(files_fts, 2, '', '', '…', 32)
+                    FROM files_fts JOIN files f ON f.rowid = files_fts.rowid
+                    WHERE files_fts MATCH ?
+                    ORDER BY bm25(files_fts, 10.0, 5.0, 1.0) LIMIT ?
+                    """,
+                    (match, limit)
+                ).fetchall()
+            else:
+                # trigramは3文字未満の語を検索できないため、部分一致で絞り込む
+                conditions = " AND ".join(
+                    "(f.name LIKE ? OR f.description LIKE ? OR f.content LIKE ?)" for _ in terms)
+                params = [f"%{term}%" for term in terms for _ in range(3)]
+                rows = conn.execute(
+                    f"""
+                    SELECT {columns}, substr(COALESCE(f.content, ''), 1, 120)
+                    FROM files f WHERE {conditions}
+                    ORDER BY (f.name LIKE ?) DESC, f.modified_time DESC LIMIT ?
+                    """,
+                    (*params, f"%{terms[0]}%", limit)
+                ).fetchall()
+        keys = ('id', 'name', 'mimeType', 'webViewLink', 'description', 'createdTime', 'modifiedTime', 'snippet')
+        return [{key: value for key, value in zip(keys, row) if value not in (None, '')} for row in rows]
+
+drive_index = DriveIndex()
+
+# 埋め込みの計算
+def embed_texts(texts):
+    """テキストを正規化済みの埋め込みベクトル（float32の行列）に変換する（バッチに分けて並行して問い合わせる）"""
+    backend = llm_runtime.backends[EMBEDDING_BACKEND]
+    model = EMBEDDING_MODELS[EMBEDDING_BACKEND]
+    
+    async def run(emit, parent):
+        semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        
+        async def embed_batch(batch):
+            async with semaphore:
+                return await backend.embed(model, batch, parent)
+        
+        batches = [texts[start:start + EMBEDDING_BATCH_SIZE] for start in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+        results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+        return [vector for result in results for vector in result]
+    
+    vectors = numpy.asarray(llm_runtime.call(run), dtype=numpy.float32)
+    norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+def embed_query(query):
+    """検索クエリを埋め込む（同じクエリはキャッシュを使う）"""
+    key = response_cache.make_key(EMBEDDING_BACKEND, EMBEDDING_MODELS[EMBEDDING_BACKEND], f'embedding:{EMBEDDING_DIMENSIONS}', query)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return numpy.asarray(json.loads(cached), dtype=numpy.float32)
+    vector = embed_texts([query])[0]
+    response_cache.set(key, json.dumps(vector.tolist()), 'embedding')
+    return vector
+
+# 本文のチャンク分割
+def split_passages(text, size=EMBEDDING_CHUNK_CHARS, overlap=EMBEDDING_CHUNK_OVERLAP):
+    """本文を段落の区切りでsize文字程度のチャンクに分ける（長い段落は重なりを持たせて分ける）"""
+    paragraphs = [" ".join(paragraph.split()) for paragraph in re.split(r'\n\s*\n', text)]
+    passages = []
+    current = ""
+    for paragraph in filter(None, paragraphs):
+        if current and len(current) + len(paragraph) + 1 > size:
+            passages.append(current)
+            current = ""
+        while len(paragraph) > size:
+            passages.append(paragraph[:size])
+            paragraph = paragraph[size - overlap:]
+        current = f"{current}\n{paragraph}" if current else paragraph
+    if current:
+        passages.append(current)
+    return passages[:EMBEDDING_MAX_CHUNKS_PER_FILE]
+
+# ドライブ本文の埋め込み索引
+class EmbeddingIndex(SQLiteStore):
+    """ドライブ本文のチャンクの埋め込みをメモリマップしたNumPy配列に保存し、類似度の高いチャンクを検索する"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chunks (
+            row INTEGER PRIMARY KEY,  -- ベクトルファイルの行番号（file_idがNULLの行は空き）
+            file_id TEXT,
+            chunk_no INTEGER,
+            text TEXT
+        );
+        CREATE INDEX IF NOT EXISTS chunks_file ON chunks (file_id);
+        CREATE TABLE IF NOT EXISTS embedded_files (
+            file_id TEXT PRIMARY KEY,
+            name TEXT,
+            web_view_link TEXT,
+            version TEXT
+        );
+    """
+    
+    def __init__(self, path=EMBEDDING_INDEX_PATH, vectors_path=EMBEDDING_VECTORS_PATH):
+        super().__init__(path)
+        self.vectors_path = vectors_path
+        self._vectors = None
+        self._valid = None  # 行ごとに有効なチャンクかどうか
+        self._rows = 0  # 使用済みの行数
+        self._update_lock = threading.Lock()
+        self._unavailable = False
+    
+    def available(self):
+        """NumPyが使えるかどうかを返す（使えない場合は意味検索を行わない）"""
+        if self._unavailable:
+            return False
+        try:
+            numpy.ensure_loaded()
+        except ImportError as e:
+            print(f"埋め込み索引を無効にします（NumPyがありません）: {e}")
+            self._unavailable = True
+            return False
+        return True
+    
+    def _signature(self):
+        return f"{EMBEDDING_BACKEND}:{EMBEDDING_MODELS[EMBEDDING_BACKEND]}:{EMBEDDING_DIMENSIONS}"
+    
+    def _open(self, dimensions=None):
+        """ベクトルファイルを開く（モデルや次元数が変わっていれば作り直す。_lockを保持して呼ぶ）"""
+        if self._vectors is not None:
+            return self._vectors
+        conn = self._connect()
+        if self.get_state('signature') != self._signature():
+            conn.execute("DELETE FROM chunks")
+            conn.execute("DELETE FROM embedded_files")
+            conn.commit()
+            if os.path.exists(self.vectors_path):
+                os.remove(self.vectors_path)
+            self.set_state('signature', self._signature())
+            self.set_state('dimensions', None)
+        stored = self.get_state('dimensions')
+        if stored is None and dimensions is None:
+            return None
+        dimensions = int(stored or dimensions)
+        self.set_state('dimensions', str(dimensions))
+        self._rows = conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM chunks").fetchone()[0]
+        capacity = max(self._rows, EMBEDDING_INITIAL_CAPACITY)
+        if os.path.exists(self.vectors_path):
+            capacity = max(capacity, os.path.getsize(self.vectors_path) // (4 * dimensions))
+        self._vectors = self._map(capacity, dimensions)
+        self._valid = numpy.zeros(capacity, dtype=bool)
+        rows = [row for (row,) in conn.execute("SELECT row FROM chunks WHERE file_id IS NOT NULL")]
+        self._valid[rows] = True
+        return self._vectors
+    
+    def _map(self, capacity, dimensions):
+        os.makedirs(os.path.dirname(self.vectors_path) or '.', exist_ok=True)
+        with open(self.vectors_path, 'ab') as f:
+            if f.tell() < capacity * dimensions * 4:
+                f.truncate(capacity * dimensions * 4)
+        return numpy.memmap(self.vectors_path, dtype=numpy.float32, mode='r+', shape=(capacity, dimensions))
+    
+    def _ensure_capacity(self, rows):
+        capacity, dimensions = self._vectors.shape
+        if rows <= capacity:
+            return
+        new_capacity = max(rows, capacity * 2)
+        self._vectors.flush()
+        self._vectors = None
+        self._vectors = self._map(new_capacity, dimensions)
+        valid = numpy.zeros(new_capacity, dtype=bool)
+        valid[:capacity] = self._valid
+        self._valid = valid
+    
+    def _free_rows(self, conn, file_ids):
+        for file_id in file_ids:
+            rows = [row for (row,) in conn.execute("SELECT row FROM chunks WHERE file_id = ?", (file_id,))]
+            self._valid[rows] = False
+            conn.execute("UPDATE chunks SET file_id = NULL, chunk_no = NULL, text = NULL WHERE file_id = ?", (file_id,))
+            conn.execute("DELETE FROM embedded_files WHERE file_id = ?", (file_id,))
+    
+    def _store(self, file_id, name, link, version, passages, vectors):
+        with self._lock:
+            conn = self._connect()
+            # ベクトルファイルがまだない（次元数が未定の）間に本文が空のファイルが来た場合は、記録だけする
+            if self._open(None if vectors is None else vectors.shape[1]) is not None:
+                self._free_rows(conn, [file_id])
+                # 空いた行を先に使い、足りない分を末尾に追加する
+                rows = [row for (row,) in conn.execute(
+                    "SELECT row FROM chunks WHERE file_id IS NULL ORDER BY row LIMIT ?", (len(passages),))]
+                rows += list(range(self._rows, self._rows + len(passages) - len(rows)))
+                self._ensure_capacity(max(rows, default=-1) + 1)
+                self._rows = max(self._rows, max(rows, default=-1) + 1)
+                if rows:
+                    self._vectors[rows] = vectors
+                    self._vectors.flush()
+                    self._valid[rows] = True
+                conn.executemany(
+                    "INSERT OR REPLACE INTO chunks (row, file_id, chunk_no, text) VALUES (?, ?, ?, ?)",
+                    [(row, file_id, number, text) for number, (row, text) in enumerate(zip(rows, passages))]
+                )
+            # 本文が空のファイルも記録し、同期のたびに読み直さないようにする
+            conn.execute(
+                "INSERT OR REPLACE INTO embedded_files (file_id, name, web_view_link, version) VALUES (?, ?, ?, ?)",
+                (file_id, name, link, version)
+            )
+            conn.commit()
+    
+    def update(self, drive_index):
+        """本文が追加・更新されたファイルのチャンクを埋め込み、削除されたファイルのチャンクを除く"""
+        if not self.available() or (EMBEDDING_BACKEND == 'openai' and not is_online()):
+            return
+        if not self._update_lock.acquire(blocking=False):
+            return
+        try:
+            with tracer.span('embedding_index.update') as span:
+                files = {file_id: (name, link, version) for file_id, name, link, version in drive_index.embeddable_files()}
+                with self._lock:
+                    conn = self._connect()
+                    self._open()
+                    embedded = dict(conn.execute("SELECT file_id, version FROM embedded_files").fetchall())
+                    removed = [file_id for file_id in embedded if file_id not in files]
+                    if removed and self._valid is not None:
+                        self._free_rows(conn, removed)
+                        conn.commit()
+                pending = [file_id for file_id in files if embedded.get(file_id) != files[file_id][2]]
+                span.set(removed=len(removed), pending=len(pending))
+                # 複数ファイルのチャンクをまとめてバッチにし、リクエスト数を減らす
+                batch = [
+                    (file_id, split_passages(drive_index.get_content(file_id) or ""))
+                    for file_id in pending[:EMBEDDING_FILES_PER_SYNC]
+                ]
+                # ファイル名も含めて埋め込み、名前に表れる主題も検索できるようにする
+                texts = [f"{files[file_id][0]}\n{passage}" for file_id, passages in batch for passage in passages]
+                vectors = embed_texts(texts) if texts else None
+                offset = 0
+                for file_id, passages in batch:
+                    name, link, version = files[file_id]
+                    self._store(file_id, name, link, version, passages, vectors[offset:offset + len(passages)] if passages else None)
+                    offset += len(passages)
+        except Exception as e:
+            print(f"埋め込み索引の更新エラー: {e}")
+        finally:
+            self._update_lock.release()
+    
+    def search_many(self, queries, limit=5):
+        """複数のクエリをまとめて類似度検索し、クエリごとに関連度の高いチャンクを返す"""
+        results = [[] for _ in queries]
+        if not queries or not self.available() or (EMBEDDING_BACKEND == 'openai' and not is_online()):
+            return results
+        with self._lock:
+            if self._open() is None or not self._valid[:self._rows].any():
+                return results
+        try:
+            query_vectors = numpy.stack([embed_query(query) for query in queries])
+        except Exception as e:
+            print(f"検索クエリの埋め込みエラー: {e}")
+            return results
+        
+        with tracer.span('embedding_index.search', queries=len(queries)) as span:
+            candidates = limit * EMBEDDING_PASSAGES_PER_FILE * 2
+            best_scores = numpy.full((len(queries), 0), -numpy.inf, dtype=numpy.float32)
+            best_rows = numpy.zeros((len(queries), 0), dtype=numpy.int64)
+            with self._lock:
+                rows = self._rows
+                # 大きな索引でもメモリに載せきらないよう、ブロックごとに計算して上位だけを残す
+                for start in range(0, rows, EMBEDDING_SEARCH_BLOCK):
+                    end = min(rows, start + EMBEDDING_SEARCH_BLOCK)
+                    scores = query_vectors @ numpy.asarray(self._vectors[start:end]).T
+                    scores[:, ~self._valid[start:end]] = -numpy.inf
+                    scores = numpy.concatenate([best_scores, scores], axis=1)
+                    block_rows = numpy.concatenate(
+                        [best_rows, numpy.broadcast_to(numpy.arange(start, end), (len(queries), end - start))], axis=1)
+                    keep = min(candidates, scores.shape[1])
+                    top = numpy.argpartition(-scores, keep - 1, axis=1)[:, :keep]
+                    best_scores = numpy.take_along_axis(scores, top, axis=1)
+                    best_rows = numpy.take_along_axis(block_rows, top, axis=1)
+                conn = self._connect()
+                for index in range(len(queries)):
+                    order = numpy.argsort(-best_scores[index])
+                    per_file = {}
+                    for position in order:
+                        score = float(best_scores[index][position])
+                        if score == -numpy.inf:
+                            break
+                        row = conn.execute(
+                            """
+                            SELECT c.file_id, c.text, f.name, f.web_view_link
+                            FROM chunks c JOIN embedded_files f ON f.file_id = c.file_id
+                            WHERE c.row = ?
+                            """,
+                            (int(best_rows[index][position]),)
+                        ).fetchone()
+                        if row is None or per_file.get(row[0], 0) >= EMBEDDING_PASSAGES_PER_FILE:
+                            continue
+                        per_file[row[0]] = per_file.get(row[0], 0) + 1
+                        results[index].append({
+                            'id': row[0], 'name': row[2], 'webViewLink': row[3], 'text': row[1], 'score': round(score, 4)
+                        })
+                        if len(results[index]) >= limit:
+                            break
+            span.set(rows=rows, results=sum(len(result) for result in results))
+        return results
+    
+    def search(self, query, limit=5):
+        """クエリと意味の近いチャンクを関連度の高い順に返す"""
+        return self.search_many([query], limit)[0]
+
+embedding_index = EmbeddingIndex()
+
+# 抜粋のプロンプト用整形
+def format_passages_for_prompt(passages):
+    """意味検索で見つかった抜粋を1件1行の形式に変換する"""
+    return "\n".join(
+        f"{number}. [{passage['name']}] " + " ".join(passage['text'].split())
+        for number, passage in enumerate(passages, start=1)
+    )
+
+# ドライブ検索クエリのエスケープ
+def escape_drive_query(value):
+    """Drive APIの検索クエリ内の文字列リテラル用にエスケープする"""
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+# ドライブ検索結果の逐次取得
+def iter_drive_search(drive_service, query, fields=DRIVE_SEARCH_FIELDS, page_size=DRIVE_SEARCH_PAGE_SIZE):
+    """Drive APIの全文検索結果を、必要になった時点でページ送りしながら1件ずつ返す"""
+    page_token = None
+    while True:
+        results = drive_service.files().list(
+            q=f"fullText contains '{escape_drive_query(query)}' and trashed=false",
+            spaces='drive',
+            pageSize=page_size,
+            pageToken=page_token,
+            fields=f"nextPageToken,files({fields})"
+        ).execute()
+        yield from results.get('files', [])
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+# ドライブ検索結果の並べ替え
+def rank_drive_files(query, items, limit):
+    """重複（同じIDや同名・同種類のコピー）を除き、クエリとの一致度で並べ替える"""
+    terms = [term.lower() for term in query.split() if term]
+    seen = set()
+    ranked = []
+    for position, item in enumerate(items):
+        duplicate_key = (item.get('name', '').lower(), item.get('mimeType'))
+        if item['id'] in seen or duplicate_key in seen:
+            continue
+        seen.update((item['id'], duplicate_key))
+        name = item.get('name', '').lower()
+        description = (item.get('description') or '').lower()
+        # 名前での一致を重視し、同点なら元の順位（APIや索引の関連度）を保つ
+        score = sum(3 for term in terms if term in name) + sum(1 for term in terms if term in description)
+        ranked.append((-score, position, item))
+    ranked.sort(key=lambda entry: entry[:2])
+    return [item for _, _, item in ranked[:limit]]
+
+# 検索結果のプロンプト用整形
+def format_files_for_prompt(items, fields=('mimeType', 'modifiedTime', 'webViewLink')):
+    """検索結果を1ファイル1行の簡潔な形式に変換する（JSONより少ないトークンで済む）"""
+    lines = ["（" + " | ".join(["名前"] + [DRIVE_FIELD_LABELS[field] for field in fields]) + "）"]
+    for number, item in enumerate(items, start=1):
+        values = [item.get('name', '')]
+        for field in fields:
+            value = item.get(field) or '-'
+            if field == 'mimeType':
+                value = DRIVE_MIME_LABELS.get(value, value)
+            elif field.endswith('Time'):
+                value = value[:10]
+            values.append(" ".join(str(value).split()))
+        lines.append(f"{number}. " + " | ".join(values))
+    return "\n".join(lines)
+
+# ドライブ検索
+def search_drive(query, limit=10):
+    """ローカル索引でファイルを検索する（索引の作成前はDrive APIで検索する）"""
+    if drive_index.is_ready():
+        if is_online():
+            drive_index.ensure_fresh()
+        candidates = drive_index.search(query, limit * DRIVE_SEARCH_CANDIDATES)
+    elif is_online():
+        # 初回同期はバックグラウンドで進め、それまではAPIで直接検索する
+        drive_index.ensure_fresh()
+        drive_service = get_google_service('drive', 'v3')
+        budget = limit * DRIVE_SEARCH_CANDIDATES
+        candidates = list(islice(
+            iter_drive_search(drive_service, query, page_size=min(budget, DRIVE_SEARCH_PAGE_SIZE)),
+            budget
+        ))
+    else:
+        return []
+    return rank_drive_files(query, candidates, limit)
 
 # ドライブ検索と提案
+@tracer.traced('workflow', workflow='drive_search')
 def drive_search_and_suggest(query, app):
     """Googleドライブを検索し、結果に基づいて提案を生成する"""
     app.update_progress(10, "Googleドライブに接続中...")
     
     try:
-        # Googleドライブサービスの取得
-        drive_service = get_google_service('drive', 'v3')
-        
         app.update_progress(30, "ファイルを検索中...")
         
         # ドライブ内のファイルを検索
-        results = drive_service.files().list(
-            q=f"fullText contains '{query}' and trashed=false",
-            spaces='drive',
-            fields="files(id, name, mimeType, webViewLink, description, createdTime, modifiedTime)",
-            pageSize=10
-        ).execute()
-        
-        items = results.get('files', [])
+        items = search_drive(query, 10)
         
         if not items:
             app.update_progress(100, "完了")
@@ -124,26 +2560,35 @@ def drive_search_and_suggest(query, app):
         
         app.update_progress(60, "検索結果を分析中...")
         
-        # 検索結果の整形
-        files_info = []
-        for item in items:
-            file_info = {
-                "名前": item['name'],
-                "タイプ": item['mimeType'],
-                "リンク": item.get('webViewLink', 'リンクなし'),
-                "作成日": item.get('createdTime', '不明'),
-                "更新日": item.get('modifiedTime', '不明')
-            }
-            files_info.append(file_info)
+        # 検索結果と、本文の意味検索で見つかった抜粋を整形し、入力予算を両者に配分する
+        files_info = format_files_for_prompt(items, ('mimeType', 'modifiedTime', 'webViewLink', 'snippet'))
+        passages = format_passages_for_prompt(embedding_index.search(query, 5))
+        model = current_model('drive_search')
+        budgets = allocate_budget(
+            call_budget('drive_search'),
+            {'files': count_tokens(files_info, model), 'passages': count_tokens(passages, model)}
+        )
+        files_info = fit_lines_to_budget(files_info, budgets['files'], model)
+        passages = fit_lines_to_budget(passages, budgets['passages'], model)
+        passages_section = f"""
+        関連する文書の抜粋：
+        
+        {passages}
+        """ if passages else ""
         
         # AIに提案を生成させる
         app.update_progress(80, "AIによる提案を生成中...")
         
+        # 結果のヘッダーを先に表示し、提案は生成されたそばから追記する
+        header = f"### 検索結果: {len(items)}件のファイルが見つかりました\n\n"
+        header += "### AIによる提案:\n"
+        app.begin_stream(header)
+        
         prompt = f"""
         以下はGoogleドライブの検索結果です。キーワード「{query}」に関連するファイルです：
         
-        {json.dumps(files_info, ensure_ascii=False, indent=2)}
-        
+        {files_info}
+        {passages_section}
         これらのファイルについて以下の情報を提供してください：
         1. 最も関連性が高そうなファイル3つとその理由
         2. これらのファイルを使って何ができるか、具体的な提案
@@ -152,111 +2597,539 @@ def drive_search_and_suggest(query, app):
         簡潔かつ具体的に回答してください。
         """
         
-        suggestion = get_ai_response(prompt)
+        suggestion = get_ai_response(prompt, workflow='drive_search', on_chunk=app.append_result)
         
         app.update_progress(100, "完了")
         
         # 結果を返す
-        result = f"### 検索結果: {len(items)}件のファイルが見つかりました\n\n"
-        result += f"### AIによる提案:\n{suggestion}"
-        
-        return result
+        return header + suggestion
     
     except Exception as e:
         app.update_progress(100, "エラーが発生しました")
         return f"エラーが発生しました: {str(e)}"
 
+# 未読メールIDの取得
+def list_unread_message_ids(gmail_service, max_results=EMAIL_MAX_RESULTS):
+    """未読メールのIDを新しい順に最大max_results件取得する（ページングあり）"""
+    message_ids = []
+    page_token = None
+    while len(message_ids) < max_results:
+        results = gmail_service.users().messages().list(
+            userId='me',
+            q='is:unread',
+            maxResults=min(GMAIL_LIST_PAGE_SIZE, max_results - len(message_ids)),
+            pageToken=page_token,
+            fields='messages(id),nextPageToken'
+        ).execute()
+        message_ids.extend(message['id'] for message in results.get('messages', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    return message_ids[:max_results]
+
+# メッセージの一括取得
+def batch_get_messages(gmail_service, message_ids):
+    """バッチリクエストでメッセージを取得し、IDの順序で返す"""
+    messages = {}
+    retry_ids = []
+    
+    def callback(request_id, response, exception):
+        if exception is None:
+            messages[request_id] = response
+        elif getattr(getattr(exception, 'resp', None), 'status', None) == 429:
+            retry_ids.append(request_id)
+        else:
+            print(f"メール取得エラー（{request_id}）: {exception}")
+    
+    def execute(ids):
+        for start in range(0, len(ids), GMAIL_BATCH_SIZE):
+            batch = gmail_service.new_batch_http_request(callback=callback)
+            for message_id in ids[start:start + GMAIL_BATCH_SIZE]:
+                batch.add(
+                    gmail_service.users().messages().get(
+                        userId='me',
+                        id=message_id,
+                        format='full',
+                        fields=GMAIL_MESSAGE_FIELDS
+                    ),
+                    request_id=message_id
+                )
+            batch.execute()
+    
+    execute(message_ids)
+    if retry_ids:
+        # レート制限に掛かった分だけ少し待って再取得する
+        pending, retry_ids[:] = list(retry_ids), []
+        time.sleep(1)
+        execute(pending)
+        for message_id in retry_ids:
+            print(f"メール取得エラー（{message_id}）: レート制限")
+    
+    return [messages[message_id] for message_id in message_ids if message_id in messages]
+
+# HTMLメールのテキスト化
+class _HTMLTextExtractor(HTMLParser):
+    """HTMLから本文のテキストを取り出す（スクリプト・スタイル・引用・署名の要素は除く）"""
+    SKIP_TAGS = {'script', 'style', 'head', 'title', 'blockquote'}
+    SKIP_CLASSES = ('gmail_quote', 'gmail_signature', 'yahoo_quoted', 'moz-cite-prefix', 'divRplyFwdMsg')
+    BLOCK_TAGS = {'p', 'div', 'br', 'li', 'tr', 'table', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'pre', 'section'}
+    VOID_TAGS = {'br', 'hr', 'img', 'meta', 'link', 'input', 'col', 'area', 'base', 'wbr', 'source'}
+    
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._stack = []  # (タグ, この要素から除外が始まったか)
+        self._skip_depth = 0
+    
+    def handle_starttag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS and not self._skip_depth:
+            self.parts.append("\n")
+        if tag in self.VOID_TAGS:
+            return
+        attributes = dict(attrs)
+        classes = (attributes.get('class') or '') + ' ' + (attributes.get('id') or '')
+        skip = tag in self.SKIP_TAGS or any(name in classes for name in self.SKIP_CLASSES)
+        self._stack.append((tag, skip))
+        if skip:
+            self._skip_depth += 1
+    
+    def handle_endtag(self, tag):
+        # 閉じ忘れのある要素は、対応する開始タグまでまとめて閉じる
+        if not any(open_tag == tag for open_tag, _ in self._stack):
+            return
+        while self._stack:
+            open_tag, skip = self._stack.pop()
+            if skip:
+                self._skip_depth -= 1
+            if open_tag == tag:
+                break
+        if tag in self.BLOCK_TAGS and not self._skip_depth:
+            self.parts.append("\n")
+    
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
+
+def html_to_text(html):
+    """HTMLをプレーンテキストに変換する"""
+    parser = _HTMLTextExtractor()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception as e:
+        print(f"HTML解析エラー: {e}")
+    lines = [" ".join(line.split()) for line in "".join(parser.parts).splitlines()]
+    return re.sub(r'\n{3,}', "\n\n", "\n".join(lines)).strip()
+
+# MIMEパートの解析
+def _part_headers(part):
+    return {header['name'].lower(): header['value'] for header in part.get('headers', [])}
+
+def _part_charset(part):
+    match = re.search(r'charset\s*=\s*"?([\w.:-]+)', _part_headers(part).get('content-type', ''), re.IGNORECASE)
+    return match.group(1) if match else 'utf-8'
+
+def _is_attachment(part):
+    headers = _part_headers(part)
+    return bool(
+        part.get('filename')
+        or part.get('body', {}).get('attachmentId')
+        or headers.get('content-disposition', '').lower().startswith('attachment')
+    )
+
+def find_body_parts(part, depth=0):
+    """MIMEツリーをたどり、添付ファイルを除く本文のパートを (text/plainのリスト, text/htmlのリスト) で返す"""
+    plain, html = [], []
+    if depth > EMAIL_MIME_MAX_DEPTH or _is_attachment(part):
+        return plain, html
+    mime_type = part.get('mimeType', '').lower()
+    if mime_type.startswith('multipart/'):
+        for child in part.get('parts', []):
+            child_plain, child_html = find_body_parts(child, depth + 1)
+            plain.extend(child_plain)
+            html.extend(child_html)
+    elif part.get('body', {}).get('data'):
+        if mime_type == 'text/plain':
+            plain.append(part)
+        elif mime_type == 'text/html':
+            html.append(part)
+    return plain, html
+
+def decode_part_body(part, max_bytes=EMAIL_DECODE_MAX_BYTES):
+    """パートの本文（base64url）を先頭から少しずつデコードし、max_bytesを超えた分は読まずに文字列にする"""
+    data = part['body']['data']
+    try:
+        decoder = codecs.getincrementaldecoder(_part_charset(part))(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pieces = []
+    remaining = max_bytes
+    for start in range(0, len(data), EMAIL_DECODE_CHUNK):
+        chunk = data[start:start + EMAIL_DECODE_CHUNK]
+        raw = base64.urlsafe_b64decode(chunk + "=" * (-len(chunk) % 4))[:remaining]
+        remaining -= len(raw)
+        pieces.append(decoder.decode(raw))
+        if remaining <= 0:
+            # 途中で切った場合は、最後の不完全な文字を捨てる
+            return "".join(pieces)
+    pieces.append(decoder.decode(b"", final=True))
+    return "".join(pieces)
+
+# 引用と署名の除去
+_REPLY_HEADER_PATTERNS = (
+    re.compile(r'^On .{5,200} wrote:\s*$'),
+    re.compile(r'^\d{4}年\d{1,2}月\d{1,2}日.{0,200}:\s*$'),
+    re.compile(r'^-{2,}\s*(Original Message|元のメッセージ|オリジナルメッセージ)\s*-{2,}', re.IGNORECASE),
+)
+_OUTLOOK_HEADER = re.compile(r'^(From|差出人)\s*[:：]')
+_OUTLOOK_FOLLOWING = re.compile(r'^(Sent|Date|送信日時|日付)\s*[:：]')
+_SIGNATURE_RULE = re.compile(r'^\s*([-=_*~━─＿－ー])\1{9,}\s*$')
+
+def strip_quotes_and_signature(text):
+    """返信の引用（>で始まる行と、返信ヘッダー以降）と末尾の署名を取り除く（何も残らなければ元のまま返す）"""
+    lines = text.replace("\r\n", "\n").split("\n")
+    kept = []
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if any(pattern.match(stripped) for pattern in _REPLY_HEADER_PATTERNS):
+            break
+        if _OUTLOOK_HEADER.match(stripped) and any(
+                _OUTLOOK_FOLLOWING.match(following.strip()) for following in lines[index + 1:index + 4]):
+            break
+        if stripped.startswith(">"):
+            continue
+        kept.append(line.rstrip())
+    
+    # 署名は「-- 」の区切りから始まるものとみなす
+    for index, line in enumerate(kept):
+        if line in ("--", "-- "):
+            kept = kept[:index]
+            break
+    
+    # 区切り線は本文中の囲みにも使われるため、囲みを閉じる線ではない最後の区切り線のあとに、
+    # 短い行が数行だけ続く場合に限って署名とみなす
+    rules = [index for index, line in enumerate(kept) if _SIGNATURE_RULE.match(line)]
+    if len(rules) % 2 == 1:
+        following = [line.strip() for line in kept[rules[-1] + 1:] if line.strip()]
+        if following and len(following) <= EMAIL_SIGNATURE_MAX_LINES and all(
+                len(line) <= EMAIL_SIGNATURE_LINE_CHARS for line in following):
+            kept = kept[:rules[-1]]
+    
+    result = re.sub(r'\n{3,}', "\n\n", "\n".join(kept)).strip()
+    return result or text.strip()
+
+def extract_body(payload, max_bytes=EMAIL_DECODE_MAX_BYTES):
+    """メッセージの本文をテキストで返す（text/plainを優先し、なければHTMLを変換する）"""
+    plain, html = find_body_parts(payload)
+    if plain:
+        text = decode_part_body(plain[0], max_bytes)
+    elif html:
+        text = html_to_text(decode_part_body(html[0], max_bytes))
+    else:
+        return ""
+    return strip_quotes_and_signature(text)
+
+# メール内容の抽出
+def extract_email(msg):
+    """Gmailのメッセージから件名・差出人・本文を取り出す"""
+    # メールの件名を取得
+    subject = ""
+    sender = ""
+    for header in msg['payload'].get('headers', []):
+        if header['name'] == 'Subject':
+            subject = header['value']
+        if header['name'] == 'From':
+            sender = header['value']
+    
+    # メール本文を取得（入れ子のマルチパートやHTMLのみのメールにも対応し、添付ファイルは読まない）
+    body = extract_body(msg['payload'])
+    
+    return {
+        "id": msg['id'],
+        "thread_id": msg.get('threadId', ''),
+        "internal_date": int(msg.get('internalDate', 0)),
+        "subject": subject,
+        "sender": sender,
+        # 長さの調整は返信生成時にトークン予算に合わせて行う
+        "body": body[:EMAIL_BODY_MAX_CHARS]
+    }
+
+# ローカルメールストア
+class MailStore(SQLiteStore):
+    """同期済みのメールと返信提案をSQLiteに保存する"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id TEXT PRIMARY KEY,
+            thread_id TEXT,
+            internal_date INTEGER,
+            subject TEXT,
+            sender TEXT,
+            body TEXT,
+            unread INTEGER,
+            reply TEXT
+        );
+        CREATE INDEX IF NOT EXISTS messages_unread ON messages (unread, internal_date);
+    """
+    
+    def __init__(self, path=MAIL_STORE_PATH):
+        super().__init__(path)
+    
+    def known_ids(self, message_ids):
+        """保存済みのメッセージIDを返す"""
+        with self._lock:
+            conn = self._connect()
+            return {
+                row[0] for message_id in message_ids
+                for row in conn.execute("SELECT id FROM messages WHERE id = ?", (message_id,))
+            }
+    
+    def save_messages(self, emails):
+        """取得したメールを未読として保存する（返信提案は保持する）"""
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                """
+                INSERT INTO messages (id, thread_id, internal_date, subject, sender, body, unread)
+                VALUES (?, ?, ?, ?, ?, ?, 1)
+                ON CONFLICT(id) DO UPDATE SET unread = 1
+                """,
+                [(e['id'], e['thread_id'], e['internal_date'], e['subject'], e['sender'], e['body']) for e in emails]
+            )
+            conn.commit()
+    
+    def set_unread(self, message_ids, unread):
+        """既読・未読の状態を更新する"""
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "UPDATE messages SET unread = ? WHERE id = ?",
+                [(1 if unread else 0, message_id) for message_id in message_ids]
+            )
+            conn.commit()
+    
+    def mark_all_read(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("UPDATE messages SET unread = 0")
+            conn.commit()
+    
+    def delete_messages(self, message_ids):
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("DELETE FROM messages WHERE id = ?", [(message_id,) for message_id in message_ids])
+            conn.commit()
+    
+    def unread_messages(self, limit):
+        """未読メールを新しい順に返す"""
+        with self._lock:
+            rows = self._connect().execute(
+                """
+                SELECT id, thread_id, internal_date, subject, sender, body, reply
+                FROM messages WHERE unread = 1
+                ORDER BY internal_date DESC LIMIT ?
+                """,
+                (limit,)
+            ).fetchall()
+        keys = ('id', 'thread_id', 'internal_date', 'subject', 'sender', 'body', 'reply')
+        return [dict(zip(keys, row)) for row in rows]
+    
+    def save_reply(self, message_id, reply):
+        """生成した返信提案を保存する"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("UPDATE messages SET reply = ? WHERE id = ?", (reply, message_id))
+            conn.commit()
+
+mail_store = MailStore()
+
+# メールボックスの同期
+def _full_mail_sync(gmail_service, store, max_results):
+    """未読メールを一覧から取り直す（初回またはhistoryId失効時）"""
+    # 一覧取得中の変更を取りこぼさないよう、先にhistoryIdを控える
+    profile = gmail_service.users().getProfile(userId='me', fields='historyId').execute()
+    message_ids = list_unread_message_ids(gmail_service, max_results)
+    known = store.known_ids(message_ids)
+    store.mark_all_read()
+    store.set_unread(known, True)
+    store.set_state('history_id', str(profile['historyId']))
+    return [message_id for message_id in message_ids if message_id not in known]
+
+def _incremental_mail_sync(gmail_service, store, history_id, max_results):
+    """前回以降の変更をhistory APIで取得し、新たに取得すべきメッセージIDを返す（多すぎる場合はNone）"""
+    # メッセージごとの最終状態（True: 未読, False: 既読, None: 削除）
+    changes = {}
+    page_token = None
+    while True:
+        results = gmail_service.users().history().list(
+            userId='me',
+            startHistoryId=history_id,
+            historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+            pageToken=page_token,
+            fields=(
+                'history(messagesAdded/message(id,labelIds),messagesDeleted/message(id),'
+                'labelsAdded/message(id,labelIds),labelsRemoved/message(id,labelIds)),'
+                'historyId,nextPageToken'
+            )
+        ).execute()
+        # 履歴は古い順に返るため、後の変更で上書きする
+        for record in results.get('history', []):
+            for key in ('messagesAdded', 'labelsAdded', 'labelsRemoved'):
+                for change in record.get(key, []):
+                    message = change['message']
+                    labels = message.get('labelIds', [])
+                    # is:unread と同じく、迷惑メールとゴミ箱は対象外にする
+                    changes[message['id']] = (
+                        'UNREAD' in labels and 'SPAM' not in labels and 'TRASH' not in labels
+                    )
+            for change in record.get('messagesDeleted', []):
+                changes[change['message']['id']] = None
+        # 未読が上限を超えるほど溜まっている場合は、履歴を読み進めずに全件同期に任せる
+        if sum(1 for state in changes.values() if state is True) > max_results:
+            return None
+        history_id = results.get('historyId', history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    
+    unread_ids = [message_id for message_id, state in changes.items() if state is True]
+    store.set_unread([message_id for message_id, state in changes.items() if state is False], False)
+    store.delete_messages([message_id for message_id, state in changes.items() if state is None])
+    known = store.known_ids(unread_ids)
+    store.set_unread(known, True)
+    store.set_state('history_id', str(history_id))
+    return [message_id for message_id in unread_ids if message_id not in known]
+
+@tracer.traced('gmail.sync')
+def sync_mailbox(gmail_service, store, max_results=EMAIL_MAX_RESULTS):
+    """ローカルストアをGmailと同期し、新たに取得したメッセージ数を返す"""
+    history_id = store.get_state('history_id')
+    to_fetch = None
+    if history_id is not None:
+        try:
+            to_fetch = _incremental_mail_sync(gmail_service, store, history_id, max_results)
+            if to_fetch is None:
+                print("前回の同期以降の未読メールが多いため、全件同期を行います。")
+        except google_errors.HttpError as e:
+            if e.resp.status != 404:
+                raise
+            # historyIdが古すぎる場合は全件同期に切り替える
+            print("historyIdが失効したため、全件同期を行います。")
+    if to_fetch is None:
+        to_fetch = _full_mail_sync(gmail_service, store, max_results)
+    if to_fetch:
+        messages = batch_get_messages(gmail_service, to_fetch)
+        store.save_messages([extract_email(msg) for msg in messages])
+    return len(to_fetch)
+
 # メール処理
-def process_email(app):
+@tracer.traced('workflow', workflow='email')
+def process_email(app, max_results=EMAIL_MAX_RESULTS, concurrency=EMAIL_REPLY_CONCURRENCY):
     """未読メールを取得し、AIによる返信提案を生成する"""
     app.update_progress(10, "Gmailに接続中...")
     
     try:
-        # Gmailサービスの取得
-        gmail_service = get_google_service('gmail', 'v1')
-        
-        app.update_progress(30, "未読メールを取得中...")
+        sync_note = ""
+        if is_online():
+            try:
+                # Gmailサービスの取得
+                gmail_service = get_google_service('gmail', 'v1')
+                
+                app.update_progress(30, "未読メールを同期中...")
+                
+                # 同期処理の通信量を計測
+                start_round_trips, start_bytes = transport_snapshot()
+                fetched = sync_mailbox(gmail_service, mail_store, max_results)
+                end_round_trips, end_bytes = transport_snapshot()
+                
+                sync_note = (
+                    f"Gmail同期: 新規{fetched}件, {end_round_trips - start_round_trips}往復, "
+                    f"{(end_bytes - start_bytes) / 1024:.1f}KB"
+                )
+                print(sync_note)
+            except Exception as e:
+                if not is_network_error(e):
+                    raise
+                sync_note = "オフライン: 前回同期時点の受信トレイを表示しています"
+        else:
+            sync_note = "オフライン: 前回同期時点の受信トレイを表示しています"
         
-        # 未読メールの取得
-        results = gmail_service.users().messages().list(
-            userId='me',
-            q='is:unread',
-            maxResults=5
-        ).execute()
+        app.update_progress(50, "メール内容を分析中...")
         
-        messages = results.get('messages', [])
+        email_contents = mail_store.unread_messages(max_results)
         
-        if not messages:
+        if not email_contents:
             app.update_progress(100, "完了")
             return "未読メールはありません。"
         
-        app.update_progress(50, "メール内容を分析中...")
-        
-        email_contents = []
-        
-        for message in messages:
-            msg = gmail_service.users().messages().get(
-                userId='me',
-                id=message['id'],
-                format='full'
-            ).execute()
-            
-            # メールの件名を取得
-            subject = ""
-            sender = ""
-            for header in msg['payload']['headers']:
-                if header['name'] == 'Subject':
-                    subject = header['value']
-                if header['name'] == 'From':
-                    sender = header['value']
-            
-            # メール本文を取得
-            body = ""
-            if 'parts' in msg['payload']:
-                for part in msg['payload']['parts']:
-                    if part['mimeType'] == 'text/plain':
-                        body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                        break
-            elif 'body' in msg['payload'] and 'data' in msg['payload']['body']:
-                body = base64.urlsafe_b64decode(msg['payload']['body']['data']).decode('utf-8')
-            
-            email_contents.append({
-                "id": message['id'],
-                "subject": subject,
-                "sender": sender,
-                "body": body[:500] + ("..." if len(body) > 500 else "")  # 長すぎる場合は省略
-            })
-        
         app.update_progress(70, "AIによる返信提案を生成中...")
         
-        # 各メールに対する返信提案を生成
-        email_responses = []
+        # 各メールに対する返信提案を並行して生成（結果は受信順に並べる）
+        email_responses = [None] * len(email_contents)
+        parent = tracer.current()
+        
+        def generate_reply(email):
+            # 以前の実行で生成済みの返信提案は再利用する
+            if email['reply']:
+                return email['reply']
+            # キャンセルされたジョブの分はLLMを呼ばずに終える
+            app.check_cancelled()
+            with tracer.span('email.reply', parent=parent):
+                return generate_new_reply(email)
         
-        for email in email_contents:
+        def generate_new_reply(email):
+            # 本文のないメールにはLLMを呼ばない
+            if not email['body'].strip():
+                return EMAIL_EMPTY_BODY_MESSAGE
+            # 長いメールは要約してから渡し、短いメールはそのまま使う
+            model = current_model('email_reply')
+            body = fit_to_budget(
+                email['body'], call_budget('email_reply'), model, 'email_reply', check_cancelled=app.check_cancelled)
+            app.check_cancelled()
             prompt = f"""
             以下のメールに対する適切な返信を日本語で提案してください：
             
             差出人: {email['sender']}
             件名: {email['subject']}
             本文:
-            {email['body']}
+            {body}
             
             返信内容は簡潔かつ丁寧に、ビジネスメールとして適切な形式で作成してください。
             """
             
-            response = get_ai_response(prompt)
-            
-            email_responses.append({
-                "id": email['id'],
-                "subject": email['subject'],
-                "sender": email['sender'],
-                "response": response
-            })
+            # Gmailのメッセージは不変なので、メッセージIDをキャッシュキーにする
+            reply = get_ai_response(prompt, workflow='email_reply', cache_key=f"gmail:{email['id']}")
+            if reply != LLM_UNAVAILABLE_MESSAGE:
+                mail_store.save_reply(email['id'], reply)
+            return reply
+        
+        executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='email-reply')
+        try:
+            futures = {
+                executor.submit(generate_reply, email): index
+                for index, email in enumerate(email_contents)
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                index = futures[future]
+                email = email_contents[index]
+                email_responses[index] = {
+                    "id": email['id'],
+                    "subject": email['subject'],
+                    "sender": email['sender'],
+                    "response": future.result()
+                }
+                app.update_progress(
+                    70 + 25 * done // len(email_contents),
+                    f"AIによる返信提案を生成中... ({done}/{len(email_contents)})"
+                )
+        finally:
+            # キャンセルや例外で抜けた場合は、まだ始まっていない返信の生成を取り消す
+            executor.shutdown(wait=False, cancel_futures=True)
         
         app.update_progress(100, "完了")
         
         # 結果を整形
-        result = f"### 未読メール: {len(messages)}件\n\n"
+        result = f"### 未読メール: {len(email_contents)}件\n"
+        result += f"（{sync_note}）\n\n"
         
         for i, resp in enumerate(email_responses):
             result += f"## メール {i+1}\n"
@@ -267,11 +3140,367 @@ def process_email(app):
         
         return result
     
-    except Exception as e:
-        app.update_progress(100, "エラーが発生しました")
-        return f"エラーが発生しました: {str(e)}"
+    except Exception as e:
+        app.update_progress(100, "エラーが発生しました")
+        return f"エラーが発生しました: {str(e)}"
+
+# タスク索引
+class TaskStore(SQLiteStore):
+    """タスクリストIDと既存タスクのタイトルを保存し、重複登録を防ぐ"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            id TEXT PRIMARY KEY,
+            tasklist_id TEXT,
+            title TEXT,
+            title_key TEXT,
+            status TEXT,
+            updated TEXT
+        );
+        CREATE INDEX IF NOT EXISTS tasks_title ON tasks (tasklist_id, title_key);
+    """
+    
+    def __init__(self, path=TASK_STORE_PATH):
+        super().__init__(path)
+    
+    @staticmethod
+    def title_key(title):
+        """表記ゆれ（全角半角・大文字小文字・空白）を吸収した比較用のタイトル"""
+        return " ".join(unicodedata.normalize('NFKC', title or '').lower().split())
+    
+    def apply_tasks(self, tasklist_id, items):
+        """APIから取得・追加したタスクを反映する（削除済みは取り除く）"""
+        with self._lock:
+            conn = self._connect()
+            for item in items:
+                if item.get('deleted'):
+                    conn.execute("DELETE FROM tasks WHERE id = ?", (item['id'],))
+                    continue
+                conn.execute(
+                    "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        item['id'], tasklist_id, item.get('title', ''),
+                        self.title_key(item.get('title', '')), item.get('status'), item.get('updated')
+                    )
+                )
+            conn.commit()
+    
+    def existing_title_keys(self, tasklist_id):
+        """未完了のタスクのタイトルを返す（完了済みと同じタイトルの繰り返しタスクは登録できるようにする）"""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT title_key FROM tasks WHERE tasklist_id = ? AND status = 'needsAction'", (tasklist_id,)
+            ).fetchall()
+        return {row[0] for row in rows}
+    
+    def reset(self):
+        """タスクリストが使えなくなった場合に保存内容を破棄する"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM tasks")
+            conn.execute("DELETE FROM state")
+            conn.commit()
+
+task_store = TaskStore()
+
+# タスクリストの解決
+def resolve_tasklist_id(tasks_service, store):
+    """保存済みのタスクリストIDを返す（未保存なら取得または作成して保存する）"""
+    tasklist_id = store.get_state('tasklist_id')
+    if tasklist_id:
+        return tasklist_id
+    
+    # タスクリストの取得
+    task_lists = tasks_service.tasklists().list(fields='items(id)').execute()
+    
+    if not task_lists or 'items' not in task_lists:
+        # タスクリストがない場合は新規作成
+        tasklist = tasks_service.tasklists().insert(body={
+            'title': TASK_LIST_TITLE
+        }).execute()
+        tasklist_id = tasklist['id']
+    else:
+        # 既存のタスクリストを使用（最初のもの）
+        tasklist_id = task_lists['items'][0]['id']
+    store.set_state('tasklist_id', tasklist_id)
+    return tasklist_id
+
+# 既存タスクの差分同期
+def sync_tasks(tasks_service, store, tasklist_id):
+    """前回の同期以降に更新されたタスクだけを取得して索引に反映する"""
+    updated_min = store.get_state('updated_min')
+    # 同期中の更新を取りこぼさないよう、開始時刻を少し前倒しして記録する
+    sync_started = (datetime.now(timezone.utc) - timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    page_token = None
+    while True:
+        results = tasks_service.tasks().list(
+            tasklist=tasklist_id,
+            updatedMin=updated_min,
+            showCompleted=True,
+            showHidden=True,
+            showDeleted=updated_min is not None,
+            maxResults=TASKS_PAGE_SIZE,
+            pageToken=page_token,
+            fields='items(id,title,status,updated,deleted),nextPageToken'
+        ).execute()
+        store.apply_tasks(tasklist_id, results.get('items', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    store.set_state('updated_min', sync_started)
+
+# タスク本文の作成
+def build_task_body(task):
+    """抽出したタスクをTasks APIの形式に変換する"""
+    # 締め切りの形式を調整
+    due_date = None
+    if 'due' in task and task['due']:
+        try:
+            # YYYY-MM-DD形式に変換
+            parsed_date = datetime.strptime(task['due'], '%Y-%m-%d')
+            due_date = parsed_date.strftime('%Y-%m-%dT00:00:00.000Z')
+        except ValueError:
+            # 日付形式が異なる場合は無視
+            pass
+    
+    # タスクの作成
+    task_body = {
+        'title': task['title'],
+        'notes': task.get('notes', '')
+    }
+    
+    if due_date:
+        task_body['due'] = due_date
+    
+    return task_body
+
+# タスク追加の準備
+def prepare_task_insertion(tasks_service, store):
+    """タスクリストIDを解決して既存タスクを同期し、(タスクリストID, 既存タイトルの集合) を返す"""
+    tasklist_id = resolve_tasklist_id(tasks_service, store)
+    try:
+        sync_tasks(tasks_service, store, tasklist_id)
+    except google_errors.HttpError as e:
+        if e.resp.status != 404:
+            raise
+        # 保存していたタスクリストが削除されていた場合は解決し直す
+        store.reset()
+        tasklist_id = resolve_tasklist_id(tasks_service, store)
+        sync_tasks(tasks_service, store, tasklist_id)
+    return tasklist_id, store.existing_title_keys(tasklist_id)
+
+# タスクのバッチ追加
+def batch_insert_tasks(tasks_service, store, tasklist_id, tasks):
+    """タスクをバッチリクエストで追加し、追加できたタスクを返す"""
+    results = {}
+    
+    def callback(request_id, response, exception):
+        if exception is not None:
+            print(f"タスク追加エラー（{tasks[int(request_id)]['title']}）: {exception}")
+        else:
+            results[int(request_id)] = response
+    
+    for start in range(0, len(tasks), TASKS_BATCH_SIZE):
+        batch = tasks_service.new_batch_http_request(callback=callback)
+        for index in range(start, min(start + TASKS_BATCH_SIZE, len(tasks))):
+            batch.add(
+                tasks_service.tasks().insert(
+                    tasklist=tasklist_id,
+                    body=build_task_body(tasks[index]),
+                    fields='id,title,status,updated'
+                ),
+                request_id=str(index)
+            )
+        batch.execute()
+    
+    store.apply_tasks(tasklist_id, list(results.values()))
+    added_tasks = []
+    for index, task in enumerate(tasks):
+        if index not in results:
+            continue
+        added_tasks.append({
+            'title': task['title'],
+            'notes': task.get('notes', ''),
+            'due': task.get('due') or '未設定',
+            'priority': task.get('priority', '中'),
+            'id': results[index]['id']
+        })
+    return added_tasks
+
+# タスクの一括追加
+def insert_tasks(tasks_service, store, tasks):
+    """重複を除いたタスクをバッチリクエストで追加し、(追加したタスク, 重複で除外したタスク) を返す"""
+    inserter = TaskInserter(tasks_service, store)
+    inserter.start()
+    for task in tasks:
+        inserter.put(task)
+    return inserter.close()
+
+# 逐次タスク追加
+class TaskInserter:
+    """抽出されたタスクを受け取り次第、重複を除いてまとめてGoogleタスクに追加する"""
+    _CLOSE = object()
+    
+    def __init__(self, tasks_service, store):
+        self.tasks_service = tasks_service
+        self.store = store
+        self.added = []
+        self.skipped = []
+        self.error = None
+        self._aborted = False
+        self._seen = set()  # この実行で受け取ったタスク（タイトルと期限）
+        self._queue = queue.Queue()
+        self._parent = tracer.current()
+        self._thread = threading.Thread(target=self._run, name='task-inserter', daemon=True)
+    
+    def start(self):
+        """準備（タスクリストの解決と既存タスクの同期）を裏で開始する"""
+        self._thread.start()
+    
+    def put(self, task):
+        self._queue.put(task)
+    
+    def close(self):
+        """残りのタスクを追加し終えるまで待ち、(追加したタスク, 重複で除外したタスク) を返す"""
+        self._queue.put(self._CLOSE)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.added, self.skipped
+    
+    def abort(self):
+        """追加待ちのタスクを捨てて終了させる（終了は待たない。close()の後に呼んでも何もしない）"""
+        self._aborted = True
+        self._queue.put(self._CLOSE)
+    
+    def _run(self):
+        with tracer.span('tasks.insert', parent=self._parent) as span:
+            self._insert()
+            span.set(added=len(self.added), skipped=len(self.skipped))
+    
+    def _insert(self):
+        try:
+            tasklist_id, existing = prepare_task_insertion(self.tasks_service, self.store)
+        except Exception as e:
+            self.error = e
+            return
+        closed = False
+        while not closed:
+            # 届いている分をまとめて1回のバッチで送る
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self._aborted:
+                return
+            closed = self._CLOSE in items
+            to_insert = []
+            for task in items:
+                if task is self._CLOSE:
+                    continue
+                # フォールバックで生成し直した同じタスクは、重複としても数えずに捨てる
+                run_key = (self.store.title_key(task['title']), task.get('due') or '')
+                if run_key in self._seen:
+                    continue
+                self._seen.add(run_key)
+                key = self.store.title_key(task['title'])
+                if key in existing:
+                    self.skipped.append(task)
+                    continue
+                existing.add(key)
+                to_insert.append(task)
+            if not to_insert:
+                continue
+            try:
+                self.added.extend(batch_insert_tasks(self.tasks_service, self.store, tasklist_id, to_insert))
+            except Exception as e:
+                self.error = e
+                return
+
+# タスクの検証
+def validate_task(item):
+    """抽出結果の1件をスキーマに沿って検証・正規化する（不正ならNone）"""
+    if not isinstance(item, dict):
+        return None
+    title = item.get('title')
+    if not isinstance(title, str) or not title.strip():
+        return None
+    notes = item.get('notes')
+    due = item.get('due')
+    if not isinstance(due, str) or not re.fullmatch(r'\d{4}-\d{2}-\d{2}', due.strip()):
+        due = ""
+    priority = item.get('priority')
+    return {
+        'title': title.strip(),
+        'notes': notes.strip() if isinstance(notes, str) else "",
+        'due': due.strip(),
+        'priority': priority if priority in TASK_PRIORITIES else "中"
+    }
+
+# ストリーミング応答からのタスク抽出
+class TaskStreamParser:
+    """生成途中のJSONから、配列要素のオブジェクトを閉じた順に取り出す"""
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        """解析状態を初期化する（応答を最初から受け直す場合に使用）"""
+        self._stack = []
+        self._in_string = False
+        self._escaped = False
+        self._capture = None
+        self._capture_depth = 0
+    
+    def feed(self, text):
+        """受け取った文字列を解析し、完成したタスクのリストを返す"""
+        tasks = []
+        for ch in text:
+            if self._capture is not None:
+                self._capture.append(ch)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == '\\':
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                if ch == '{' and self._capture is None and self._stack and self._stack[-1] == '[':
+                    # 配列の要素になっているオブジェクトの開始
+                    self._capture = [ch]
+                    self._capture_depth = len(self._stack)
+                self._stack.append(ch)
+            elif ch in '}]':
+                if self._stack:
+                    self._stack.pop()
+                if ch == '}' and self._capture is not None and len(self._stack) == self._capture_depth:
+                    try:
+                        task = validate_task(json.loads("".join(self._capture)))
+                    except json.JSONDecodeError:
+                        task = None
+                    if task is not None:
+                        tasks.append(task)
+                    self._capture = None
+        return tasks
+
+# 完成した応答からのタスク抽出
+def parse_task_list(text):
+    """応答全体をJSONとして解析し、検証済みのタスクを返す（解析できなければNone）"""
+    try:
+        data = json.loads(text)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    items = data.get('tasks') if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return None
+    return [task for task in map(validate_task, items) if task is not None]
 
 # タスク追加
+@tracer.traced('workflow', workflow='task_add')
 def add_task_from_content(content, app):
     """テキスト内容からタスクを抽出し、Googleタスクに追加する"""
     app.update_progress(10, "内容を分析中...")
@@ -282,110 +3511,80 @@ def add_task_from_content(content, app):
         以下のテキストからタスクを抽出してください。各タスクには以下の情報を含めてください：
         1. タスクのタイトル（簡潔に）
         2. タスクの詳細説明
-        3. 推定される締め切り（テキストから推測できる場合）
+        3. 推定される締め切り（テキストから推測できる場合はYYYY-MM-DD形式、できない場合は空文字）
         4. 優先度（高/中/低）
         
-        JSON形式で返してください。例：
-        [
-          {{
-            "title": "会議の準備",
-            "notes": "プレゼン資料を作成し、参加者に送付する",
-            "due": "2023-12-15",
-            "priority": "高"
-          }}
-        ]
+        次の形式のJSONで返してください。例：
+        {{
+          "tasks": [
+            {{
+              "title": "会議の準備",
+              "notes": "プレゼン資料を作成し、参加者に送付する",
+              "due": "2023-12-15",
+              "priority": "高"
+            }}
+          ]
+        }}
         
         テキスト:
         {content}
         """
         
-        app.update_progress(30, "AIによるタスク抽出中...")
-        
-        tasks_json_text = get_ai_response(prompt)
-        
-        # JSON部分を抽出（AIの回答にテキストが含まれている場合に対応）
-        json_match = re.search(r'\[\s*\{.*\}\s*\]', tasks_json_text, re.DOTALL)
-        if json_match:
-            tasks_json_text = json_match.group(0)
-        
-        try:
-            tasks = json.loads(tasks_json_text)
-        except json.JSONDecodeError:
-            # JSON解析に失敗した場合、より柔軟な方法で再試行
-            try:
-                # 一般的なJSON形式のエラーを修正
-                fixed_json = re.sub(r'(\w+):', r'"\1":', tasks_json_text)
-                fixed_json = re.sub(r'\'', r'"', fixed_json)
-                tasks = json.loads(fixed_json)
-            except json.JSONDecodeError:
-                app.update_progress(100, "エラーが発生しました")
-                return "タスクの抽出に失敗しました。テキスト形式を確認してください。"
-        
-        if not tasks:
-            app.update_progress(100, "完了")
-            return "タスクが見つかりませんでした。別のテキストで試してください。"
-        
-        app.update_progress(60, "Googleタスクに接続中...")
-        
-        # Googleタスクサービスの取得
+        # タスクリストの解決と既存タスクの同期は、抽出と並行して進める
         tasks_service = get_google_service('tasks', 'v1')
+        inserter = TaskInserter(tasks_service, task_store)
+        inserter.start()
         
-        # タスクリストの取得
-        task_lists = tasks_service.tasklists().list().execute()
-        
-        if not task_lists or 'items' not in task_lists:
-            # タスクリストがない場合は新規作成
-            tasklist = tasks_service.tasklists().insert(body={
-                'title': 'AIアシスタント'
-            }).execute()
-            tasklist_id = tasklist['id']
-        else:
-            # 既存のタスクリストを使用（最初のもの）
-            tasklist_id = task_lists['items'][0]['id']
-        
-        app.update_progress(80, "タスクを追加中...")
-        
-        # タスクの追加
-        added_tasks = []
-        
-        for task in tasks:
-            # 締め切りの形式を調整
-            due_date = None
-            if 'due' in task and task['due']:
-                try:
-                    # YYYY-MM-DD形式に変換
-                    parsed_date = datetime.strptime(task['due'], '%Y-%m-%d')
-                    due_date = parsed_date.strftime('%Y-%m-%dT00:00:00.000Z')
-                except ValueError:
-                    # 日付形式が異なる場合は無視
-                    pass
+        try:
+            app.update_progress(30, "AIによるタスク抽出中...")
             
-            # タスクの作成
-            task_body = {
-                'title': task['title'],
-                'notes': task.get('notes', '')
-            }
+            parser = TaskStreamParser()
+            extracted = []
             
-            if due_date:
-                task_body['due'] = due_date
+            def on_chunk(text):
+                if text == FALLBACK_NOTICE:
+                    # ローカルLLMで最初から生成し直すため、解析もやり直す（追加済みの分はTaskInserterが重複を捨てる）
+                    parser.reset()
+                    extracted.clear()
+                    return
+                for task in parser.feed(text):
+                    # 生成が終わるのを待たずに、完成したタスクから追加していく
+                    extracted.append(task)
+                    inserter.put(task)
+                    app.update_progress(min(30 + 5 * len(extracted), 80), f"タスクを追加中... ({len(extracted)}件抽出)")
             
-            result = tasks_service.tasks().insert(
-                tasklist=tasklist_id,
-                body=task_body
-            ).execute()
+            tasks_json_text = get_ai_response(
+                prompt, workflow='task_extract', on_chunk=on_chunk, json_schema=TASK_LIST_SCHEMA)
+            
+            if not extracted:
+                # ストリーミング中に取り出せなかった場合は応答全体を解析する
+                tasks = parse_task_list(tasks_json_text)
+                if tasks is None:
+                    inserter.close()
+                    app.update_progress(100, "エラーが発生しました")
+                    return "タスクの抽出に失敗しました。テキスト形式を確認してください。"
+                for task in tasks:
+                    extracted.append(task)
+                    inserter.put(task)
+            
+            app.update_progress(85, "タスクを追加中...")
             
-            added_tasks.append({
-                'title': task['title'],
-                'notes': task.get('notes', ''),
-                'due': task.get('due', '未設定'),
-                'priority': task.get('priority', '中'),
-                'id': result['id']
-            })
+            added_tasks, skipped_tasks = inserter.close()
+        finally:
+            # キャンセルや例外で抜けた場合も追加待ちのタスクを捨て、追加スレッドを終わらせる
+            inserter.abort()
+        
+        if not extracted:
+            app.update_progress(100, "完了")
+            return "タスクが見つかりませんでした。別のテキストで試してください。"
         
         app.update_progress(100, "完了")
         
         # 結果を整形
         result = f"### 追加されたタスク: {len(added_tasks)}件\n\n"
+        if skipped_tasks:
+            titles = "、".join(task['title'] for task in skipped_tasks)
+            result += f"（登録済みのためスキップ: {len(skipped_tasks)}件 - {titles}）\n\n"
         
         for i, task in enumerate(added_tasks):
             result += f"## タスク {i+1}: {task['title']}\n"
@@ -399,40 +3598,176 @@ def add_task_from_content(content, app):
         app.update_progress(100, "エラーが発生しました")
         return f"エラーが発生しました: {str(e)}"
 
+# 処理ステージ
+class Stage:
+    """依存関係・制限時間・失敗時の代替値を持つ処理単位"""
+    def __init__(self, name, label, func, deps=(), timeout=None, fallback=None):
+        self.name = name
+        self.label = label
+        self.func = func  # 依存ステージの結果を名前付き引数で受け取る
+        self.deps = tuple(deps)
+        self.timeout = timeout
+        self.fallback = fallback  # 失敗時に fallback(error) の結果で代替する（Noneなら中断）
+
+class StageTimeout(Exception):
+    """ステージが制限時間内に終わらなかった"""
+
+class StageCancelled(BaseException):
+    """打ち切られたステージの処理を止める（ステージ内の except Exception で握りつぶされないようBaseExceptionを継承）"""
+
+# 打ち切られたステージの検知
+def check_stage_cancelled(cancelled):
+    """ステージが打ち切られていればStageCancelledを送出する（LLM呼び出しとUI更新の前に呼ぶ）"""
+    if cancelled.is_set():
+        raise StageCancelled()
+
+def guard_stage_output(cancelled, func):
+    """打ち切られたステージからのUI更新を止め、呼ばれた時点で処理ごと中断させる"""
+    def guarded(*args):
+        check_stage_cancelled(cancelled)
+        return func(*args)
+    return guarded
+
+# ステージの並行実行
+def run_stages(stages, on_stage_done=None):
+    """依存関係に従ってステージを実行し、結果・所要時間・エラーの辞書を返す（独立したステージは並行して実行し、打ち切りを知らせるEventをcancelledとして渡す）"""
+    pending = {stage.name: stage for stage in stages}
+    results = {}
+    timings = {}
+    errors = {}
+    running = {}  # future -> (stage, 開始時刻)
+    cancel_events = {stage.name: threading.Event() for stage in stages}
+    executor = ThreadPoolExecutor(max_workers=len(stages), thread_name_prefix='stage')
+    parent = tracer.current()
+    
+    def run_stage(stage, kwargs):
+        # 別スレッドで実行されるため、呼び出し元の区間を親として明示する
+        with tracer.span('stage', parent=parent, stage=stage.name) as span:
+            try:
+                return stage.func(cancelled=cancel_events[stage.name], **kwargs)
+            except StageCancelled:
+                # 打ち切り後の結果は使われないため、静かに終える
+                span.set(abandoned=True)
+                return None
+    
+    def finish(stage, value=None, error=None, started=None):
+        timings[stage.name] = time.monotonic() - started
+        if error is not None:
+            if stage.fallback is None:
+                raise error
+            print(f"ステージ「{stage.label}」失敗（代替値を使用）: {error}")
+            errors[stage.name] = error
+            value = stage.fallback(error)
+        results[stage.name] = value
+        if on_stage_done is not None:
+            on_stage_done(stage, len(results), len(stages))
+    
+    try:
+        while pending or running:
+            # 依存が揃ったステージを開始する
+            for name, stage in list(pending.items()):
+                if all(dep in results for dep in stage.deps):
+                    del pending[name]
+                    kwargs = {dep: results[dep] for dep in stage.deps}
+                    running[executor.submit(run_stage, stage, kwargs)] = (stage, time.monotonic())
+            if not running:
+                raise RuntimeError(f"依存関係を解決できないステージがあります: {', '.join(pending)}")
+            
+            now = time.monotonic()
+            deadlines = [
+                started + stage.timeout - now
+                for stage, started in running.values() if stage.timeout is not None
+            ]
+            done, _ = wait(
+                list(running),
+                timeout=max(0, min(deadlines)) if deadlines else None,
+                return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                stage, started = running.pop(future)
+                try:
+                    value = future.result()
+                except Exception as e:
+                    finish(stage, error=e, started=started)
+                else:
+                    finish(stage, value, started=started)
+            
+            # 制限時間を過ぎたステージは結果を待たずに代替値で進める
+            now = time.monotonic()
+            for future, (stage, started) in list(running.items()):
+                if stage.timeout is not None and now - started >= stage.timeout:
+                    del running[future]
+                    future.cancel()
+                    # 実行中のステージはこれ以降のLLM呼び出しとUI更新で止まる
+                    cancel_events[stage.name].set()
+                    finish(stage, error=StageTimeout(f"{stage.timeout}秒を超えました"), started=started)
+    finally:
+        # キャンセルや例外で抜けた場合も、実行中のステージを止める
+        for stage, _ in running.values():
+            cancel_events[stage.name].set()
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results, timings, errors
+
+# ステージ所要時間の表示
+def format_stage_timings(stages, timings, errors):
+    """各ステージの所要時間を1行にまとめる"""
+    parts = []
+    for stage in stages:
+        if stage.name not in timings:
+            continue
+        note = "（代替）" if stage.name in errors else ""
+        parts.append(f"{stage.label} {timings[stage.name]:.1f}秒{note}")
+    return "処理時間: " + " / ".join(parts)
+
 # Webレポート生成
+@tracer.traced('workflow', workflow='report')
 def generate_web_report(topic, app):
     """指定されたトピックに関するWebレポートを生成する"""
     app.update_progress(10, "情報収集を開始...")
     
     try:
-        if not is_online():
-            app.update_progress(20, "オフラインモード: ローカルデータのみ使用...")
-            
-            # ドライブからの情報収集
-            drive_service = get_google_service('drive', 'v3')
-            
-            results = drive_service.files().list(
-                q=f"fullText contains '{topic}' and trashed=false",
-                spaces='drive',
-                fields="files(id, name, mimeType, description)",
-                pageSize=5
-            ).execute()
-            
-            items = results.get('files', [])
+        online = is_online()
+        header = f"### 「{topic}」に関するレポート\n\n"
+        
+        def web_search_stage(cancelled):
+            # OpenAIのWeb検索機能を使用
+            web_search_prompt = f"""
+            「{topic}」について詳細な情報を収集してください。以下の点に注目してください：
+            1. 最新の動向や統計
+            2. 主要な課題や機会
+            3. 業界の専門家の見解
+            4. 将来の展望
             
-            files_info = []
-            for item in items:
-                file_info = {
-                    "名前": item['name'],
-                    "タイプ": item['mimeType'],
-                    "説明": item.get('description', '説明なし')
-                }
-                files_info.append(file_info)
+            これらの情報を元に、包括的なレポートを作成するための情報を集めています。
+            """
             
+            web_search_system = "あなたはWeb検索機能を持つAIアシスタントです。最新の情報を収集して提供してください。"
+            model = workflow_model('openai', 'web_report')
+            check_stage_cancelled(cancelled)
+            return cached_llm_call(
+                'openai', model, web_search_prompt, web_search_system,
+                lambda: llm_router.chat('openai', model, web_search_prompt, web_search_system),
+                'web_report'
+            )
+        
+        def drive_stage(cancelled):
+            # ドライブからの情報収集（オフライン時はローカル索引のみ）
+            items = search_drive(topic, 5)
+            drive = format_files_for_prompt(items, ('mimeType', 'description', 'snippet'))
+            check_stage_cancelled(cancelled)
+            # 本文の意味検索で見つかった抜粋も加える（1件1行なので予算超過時は末尾から削られる）
+            passages = format_passages_for_prompt(embedding_index.search(topic, 8))
+            if passages:
+                drive = f"{drive}\n\n関連する文書の抜粋:\n{passages}"
+            return drive
+        
+        def offline_report_stage(drive, cancelled):
+            model = workflow_model('ollama', 'web_report')
+            drive = fit_lines_to_budget(drive, prompt_budget('web_report', model), model)
             prompt = f"""
             以下は「{topic}」に関するGoogleドライブ内のファイル情報です：
             
-            {json.dumps(files_info, ensure_ascii=False, indent=2)}
+            {drive}
             
             これらの情報を元に、「{topic}」に関する5ページ程度のレポートを作成してください。
             レポートには以下のセクションを含めてください：
@@ -446,71 +3781,34 @@ def generate_web_report(topic, app):
             注：このレポートはオフラインモードで生成されており、最新のWeb情報は含まれていません。
             """
             
-            app.update_progress(50, "レポートを生成中...")
-            
-            report = get_local_llm_response(prompt)
-            
-        else:
-            app.update_progress(20, "Web情報を検索中...")
-            
-            # OpenAIのWeb検索機能を使用
-            web_search_prompt = f"""
-            「{topic}」について詳細な情報を収集してください。以下の点に注目してください：
-            1. 最新の動向や統計
-            2. 主要な課題や機会
-            3. 業界の専門家の見解
-            4. 将来の展望
-            
-            これらの情報を元に、包括的なレポートを作成するための情報を集めています。
-            """
-            
-            try:
-                web_search_response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": "あなたはWeb検索機能を持つAIアシスタントです。最新の情報を収集して提供してください。"},
-                        {"role": "user", "content": web_search_prompt}
-                    ]
-                )
-                web_info = web_search_response.choices[0].message.content
-            except Exception as e:
-                print(f"Web検索エラー: {e}")
-                web_info = "Web検索に失敗しました。ローカルデータのみを使用します。"
-            
-            app.update_progress(40, "ドライブ情報を収集中...")
-            
-            # ドライブからの情報収集
-            drive_service = get_google_service('drive', 'v3')
-            
-            results = drive_service.files().list(
-                q=f"fullText contains '{topic}' and trashed=false",
-                spaces='drive',
-                fields="files(id, name, mimeType, description)",
-                pageSize=5
-            ).execute()
-            
-            items = results.get('files', [])
-            
-            files_info = []
-            for item in items:
-                file_info = {
-                    "名前": item['name'],
-                    "タイプ": item['mimeType'],
-                    "説明": item.get('description', '説明なし')
-                }
-                files_info.append(file_info)
-            
-            app.update_progress(60, "レポートを生成中...")
+            check_stage_cancelled(cancelled)
+            app.begin_stream(header)
+            return get_local_llm_response(
+                prompt, workflow='web_report', on_chunk=guard_stage_output(cancelled, app.append_result))
+        
+        def online_report_stage(web_search, drive, cancelled):
+            # 入力予算をWeb検索結果とドライブ情報に配分し、超えた分は要約・切り詰めで収める
+            model = current_model('web_report')
+            budgets = allocate_budget(
+                call_budget('web_report'),
+                {'web_search': count_tokens(web_search, model), 'drive': count_tokens(drive, model)},
+                REPORT_SOURCE_WEIGHTS
+            )
+            web_search = fit_to_budget(
+                web_search, budgets['web_search'], model, 'web_report',
+                check_cancelled=lambda: check_stage_cancelled(cancelled)
+            )
+            drive = fit_lines_to_budget(drive, budgets['drive'], model)
             
             # レポート生成
             report_prompt = f"""
             以下は「{topic}」に関する情報です：
             
             ## Web検索結果:
-            {web_info}
+            {web_search}
             
             ## Googleドライブ内の関連ファイル:
-            {json.dumps(files_info, ensure_ascii=False, indent=2)}
+            {drive}
             
             これらの情報を元に、「{topic}」に関する5ページ程度の包括的なレポートを作成してください。
             レポートには以下のセクションを含めてください：
@@ -525,16 +3823,246 @@ def generate_web_report(topic, app):
             各セクションは見出しを付け、内容は具体的かつ実用的にしてください。
             """
             
-            report = get_ai_response(report_prompt)
+            check_stage_cancelled(cancelled)
+            app.begin_stream(header)
+            return get_ai_response(
+                report_prompt, workflow='web_report', on_chunk=guard_stage_output(cancelled, app.append_result))
+        
+        def report_fallback(error):
+            if isinstance(error, StageTimeout):
+                return f"レポートの生成が制限時間（{REPORT_STAGE_TIMEOUTS['report']}秒）内に終わりませんでした。時間をおいて再度お試しください。"
+            return f"レポートを生成できませんでした: {error}"
+        
+        drive = Stage(
+            'drive', "ドライブ検索", drive_stage,
+            timeout=REPORT_STAGE_TIMEOUTS['drive'],
+            fallback=lambda e: "ドライブ情報を取得できませんでした。"
+        )
+        if online:
+            app.update_progress(20, "Web情報とドライブ情報を収集中...")
+            stages = [
+                Stage(
+                    'web_search', "Web検索", web_search_stage,
+                    timeout=REPORT_STAGE_TIMEOUTS['web_search'],
+                    fallback=lambda e: "Web検索に失敗しました。ローカルデータのみを使用します。"
+                ),
+                drive,
+                Stage('report', "レポート生成", online_report_stage, deps=('web_search', 'drive'),
+                      timeout=REPORT_STAGE_TIMEOUTS['report'], fallback=report_fallback),
+            ]
+        else:
+            app.update_progress(20, "オフラインモード: ローカルデータのみ使用...")
+            stages = [
+                drive,
+                Stage('report', "レポート生成", offline_report_stage, deps=('drive',),
+                      timeout=REPORT_STAGE_TIMEOUTS['report'], fallback=report_fallback),
+            ]
+        
+        def on_stage_done(stage, completed, total):
+            if completed < total:
+                next_label = "レポートを生成中..." if completed == total - 1 else "情報収集中..."
+                app.update_progress(20 + 70 * completed // total, f"{stage.label}完了 / {next_label}")
+        
+        results, timings, errors = run_stages(stages, on_stage_done)
         
         app.update_progress(100, "完了")
         
-        return f"### 「{topic}」に関するレポート\n\n{report}"
+        return f"{header}{results['report']}\n\n---\n{format_stage_timings(stages, timings, errors)}"
     
     except Exception as e:
         app.update_progress(100, "エラーが発生しました")
         return f"エラーが発生しました: {str(e)}"
 
+# ジョブのキャンセル
+class JobCancelled(BaseException):
+    """ジョブがキャンセルされた（ワークフロー内の except Exception で握りつぶされないようBaseExceptionを継承）"""
+
+# ジョブ
+class Job:
+    """スケジューラで実行する1件の処理（ワークフローには進捗通知先として渡す）"""
+    def __init__(self, scheduler, job_id, kind, label, func, args, priority):
+        self.scheduler = scheduler
+        self.id = job_id
+        self.kind = kind
+        self.label = label
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.status = 'pending'  # pending / running / done / failed / cancelled
+        self.progress = 0
+        self.status_text = "待機中..."
+        self.result = None
+        self._cancel_requested = threading.Event()
+        self._finished = threading.Event()
+    
+    @property
+    def key(self):
+        return (self.kind, self.args)
+    
+    @property
+    def finished(self):
+        return self._finished.is_set()
+    
+    def check_cancelled(self):
+        """キャンセルが要求されていればJobCancelledを送出する"""
+        if self._cancel_requested.is_set():
+            raise JobCancelled()
+    
+    def update_progress(self, value, status_text):
+        """進捗を更新する（ワークフローから呼ばれる）"""
+        self.check_cancelled()
+        self.progress = value
+        self.status_text = status_text
+        self.scheduler._notify(self, 'progress')
+    
+    def begin_stream(self, header=""):
+        """ストリーミング表示の開始を通知する"""
+        self.check_cancelled()
+        self.scheduler._notify(self, 'stream_begin', header)
+    
+    def append_result(self, chunk):
+        """生成途中のテキストを通知する"""
+        self.check_cancelled()
+        self.scheduler._notify(self, 'stream_chunk', chunk)
+    
+    def cancel(self):
+        """キャンセルを要求する（実行中の場合は次の進捗通知で中断する）"""
+        self._cancel_requested.set()
+        self.scheduler._cancel_pending(self)
+    
+    def wait(self, timeout=None):
+        """ジョブの終了を待ち、結果を返す"""
+        self._finished.wait(timeout)
+        return self.result
+
+# ジョブスケジューラ
+class JobScheduler:
+    """優先度付きキューと上限付きワーカーでジョブを並行実行する"""
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self._queue = queue.PriorityQueue()
+        self._ids = itertools.count(1)
+        self._seq = itertools.count()
+        self._active = {}  # (種類, 引数) -> 待機中または実行中のジョブ
+        self._listeners = []
+        self._threads = []
+        self._lock = threading.Lock()
+    
+    def add_listener(self, callback):
+        """ジョブの状態変化時に callback(job, event, payload) を呼び出すよう登録する"""
+        self._listeners.append(callback)
+    
+    def _notify(self, job, event, payload=None):
+        for listener in self._listeners:
+            try:
+                listener(job, event, payload)
+            except Exception as e:
+                print(f"ジョブ通知エラー: {e}")
+    
+    def submit(self, kind, label, func, args=(), priority=None):
+        """ジョブを登録する（同じ内容のジョブが待機中・実行中ならそれを返す）"""
+        if priority is None:
+            priority = JOB_PRIORITIES.get(kind, 1)
+        with self._lock:
+            existing = self._active.get((kind, args))
+            if existing is not None and not existing._cancel_requested.is_set():
+                return existing
+            job = Job(self, next(self._ids), kind, label, func, args, priority)
+            self._active[job.key] = job
+            self._queue.put((priority, next(self._seq), job))
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker, name=f'job-worker-{len(self._threads) + 1}', daemon=True)
+                self._threads.append(thread)
+                thread.start()
+        self._notify(job, 'queued')
+        return job
+    
+    def _cancel_pending(self, job):
+        with self._lock:
+            if job.status != 'pending':
+                return
+            # キューからは取り出し時に読み飛ばす
+            self._finish(job, 'cancelled', None)
+        self._notify(job, 'finished')
+    
+    def _finish(self, job, status, result):
+        job.status = status
+        job.result = result
+        if self._active.get(job.key) is job:
+            del self._active[job.key]
+        job._finished.set()
+    
+    def _worker(self):
+        while True:
+            _, _, job = self._queue.get()
+            with self._lock:
+                if job.status != 'pending':
+                    continue
+                job.status = 'running'
+            self._notify(job, 'started')
+            try:
+                result = job.func(*job.args, job)
+                status = 'done'
+            except JobCancelled:
+                result, status = None, 'cancelled'
+            except Exception as e:
+                result, status = f"エラーが発生しました: {str(e)}", 'failed'
+            with self._lock:
+                self._finish(job, status, result)
+            self._notify(job, 'finished')
+    
+    def jobs(self):
+        """待機中・実行中のジョブを返す"""
+        with self._lock:
+            return list(self._active.values())
+
+job_scheduler = JobScheduler()
+
+# GUI更新チャネル
+class UIUpdateChannel:
+    """ワーカースレッドからのGUI更新を受け付け、メインスレッドで1フレームごとにまとめて反映する"""
+    def __init__(self, root, interval_ms=UI_FRAME_INTERVAL_MS):
+        self.root = root
+        self.interval_ms = interval_ms
+        self._queue = queue.SimpleQueue()
+        self._handlers = {}
+    
+    def register(self, kind, handler, mode='latest'):
+        """更新の種類ごとに反映方法を登録する（'latest'は最新値のみ、'text'はset/appendを1回分にまとめて渡す）"""
+        self._handlers[kind] = (handler, mode)
+    
+    def post(self, kind, key=None, value=None, op='set'):
+        """更新を登録する（どのスレッドからでも呼び出せる）"""
+        self._queue.put((kind, key, op, value))
+    
+    def start(self):
+        self.root.after(self.interval_ms, self._drain)
+    
+    def _drain(self):
+        pending = {}
+        while True:
+            try:
+                kind, key, op, value = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            mode = self._handlers[kind][1]
+            slot = (kind, key)
+            if mode == 'text':
+                previous = pending.get(slot)
+                if op == 'append' and previous is not None:
+                    # 置き換え・追記のどちらでも、後続の追記は同じ1回分に連結する
+                    pending[slot] = (previous[0], previous[1] + value)
+                else:
+                    pending[slot] = (op, value)
+            else:
+                pending[slot] = value
+        for (kind, key), value in pending.items():
+            try:
+                self._handlers[kind][0](key, value)
+            except Exception as e:
+                print(f"GUI更新エラー: {e}")
+        self.root.after(self.interval_ms, self._drain)
+
 # GUI設定
 class AIAssistantApp:
     def __init__(self, root):
@@ -600,17 +4128,22 @@ class AIAssistantApp:
         )
         self.report_button.pack(side=tk.LEFT, padx=5, expand=True)
         
-        # 進捗バー
+        # ジョブ一覧（ジョブごとの進捗とキャンセル）
         self.progress_frame = ctk.CTkFrame(self.main_frame)
         self.progress_frame.pack(fill=tk.X, padx=10, pady=5)
         
-        self.progress_bar = ctk.CTkProgressBar(self.progress_frame)
-        self.progress_bar.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
-        self.progress_bar.set(0)
-        
         self.status_label = ctk.CTkLabel(self.progress_frame, text="待機中...")
         self.status_label.pack(side=tk.LEFT, padx=5)
         
+        self.connection_label = ctk.CTkLabel(self.progress_frame, text="接続確認中...")
+        self.connection_label.pack(side=tk.RIGHT, padx=5)
+        
+        self.job_frame = ctk.CTkScrollableFrame(self.main_frame, height=110)
+        self.job_frame.pack(fill=tk.X, padx=10, pady=5)
+        self.job_rows = {}
+        self.finished_job_ids = []
+        self.unseen_job_ids = set()  # 結果欄に表示していない終了済みジョブ
+        
         # 結果表示エリア
         self.result_frame = ctk.CTkFrame(self.main_frame)
         self.result_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
@@ -621,19 +4154,122 @@ class AIAssistantApp:
         self.result_text = ctk.CTkTextbox(self.result_frame, wrap=tk.WORD)
         self.result_text.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         
-        # 初期状態設定
-        self.update_progress(0, "待機中...")
+        # ワーカースレッドからの更新はチャネル経由でメインスレッドに反映する
+        self.ui = UIUpdateChannel(self.root)
+        self.ui.register('result', self._apply_result, mode='text')
+        self.ui.register('job', self._render_job)
+        self.ui.register('connection', lambda key, text: self.connection_label.configure(text=text))
+        self.ui.start()
+        self._stream_lock = threading.Lock()
+        self._stream_job_id = None  # 結果欄に表示中のジョブ
+        
+        # 接続状態とジョブの変化を表示に反映
+        connectivity.add_listener(self.on_connectivity_change)
+        job_scheduler.add_listener(self.on_job_event)
     
-    def update_progress(self, value, status_text):
-        """進捗バーと状態テキストを更新する"""
-        self.progress_bar.set(value / 100)
-        self.status_label.configure(text=status_text)
-        self.root.update_idletasks()
+    def on_connectivity_change(self, online):
+        """接続状態の変化を表示する（監視スレッドから呼ばれる）"""
+        text = "オンライン" if online else "オフライン（ローカルLLM使用）"
+        self.ui.post('connection', value=text)
     
     def set_result(self, text):
         """結果テキストを設定する"""
-        self.result_text.delete("0.0", tk.END)
-        self.result_text.insert("0.0", text)
+        self.ui.post('result', value=text, op='set')
+    
+    def begin_stream(self, header=""):
+        """ストリーミング表示を開始する（結果欄をヘッダーのみにする）"""
+        self.set_result(header)
+    
+    def append_result(self, chunk):
+        """生成途中のテキストを追記する（次のフレームでまとめて描画する）"""
+        self.ui.post('result', value=chunk, op='append')
+    
+    def _apply_result(self, key, update):
+        op, text = update
+        if op == 'set':
+            self.result_text.delete("0.0", tk.END)
+            self.result_text.insert("0.0", text)
+        else:
+            self.result_text.insert(tk.END, text)
+            self.result_text.see(tk.END)
+    
+    def on_job_event(self, job, event, payload):
+        """ジョブの状態変化を表示に反映する（ワーカースレッドから呼ばれる）"""
+        if event == 'stream_begin':
+            with self._stream_lock:
+                self._stream_job_id = job.id
+            self.set_result(payload)
+        elif event == 'stream_chunk':
+            # 結果欄には最後にストリーミングを始めたジョブの出力だけを流す
+            with self._stream_lock:
+                if self._stream_job_id != job.id:
+                    return
+            self.append_result(payload)
+        elif event == 'finished':
+            # 他のジョブが結果欄に出力中なら奪わず、結果は行の「表示」で確認できるようにする
+            with self._stream_lock:
+                show = self._stream_job_id in (None, job.id)
+                if self._stream_job_id == job.id:
+                    self._stream_job_id = None
+            if job.status in ('done', 'failed'):
+                if show:
+                    self.set_result(job.result)
+                else:
+                    self.unseen_job_ids.add(job.id)
+        self.ui.post('job', job.id, job)
+    
+    def _render_job(self, job_id, job):
+        row = self.job_rows.get(job.id)
+        if row is None:
+            frame = ctk.CTkFrame(self.job_frame)
+            frame.pack(fill=tk.X, pady=2)
+            label = ctk.CTkLabel(frame, text=job.label, width=220, anchor=tk.W)
+            label.pack(side=tk.LEFT, padx=5)
+            bar = ctk.CTkProgressBar(frame, width=160)
+            bar.pack(side=tk.LEFT, padx=5)
+            status = ctk.CTkLabel(frame, text="", anchor=tk.W)
+            status.pack(side=tk.LEFT, padx=5, fill=tk.X, expand=True)
+            show_button = ctk.CTkButton(frame, text="表示", width=50, command=lambda: self.show_job_result(job))
+            show_button.pack(side=tk.RIGHT, padx=2)
+            cancel_button = ctk.CTkButton(frame, text="中止", width=50, command=job.cancel)
+            cancel_button.pack(side=tk.RIGHT, padx=2)
+            row = self.job_rows[job.id] = {'frame': frame, 'bar': bar, 'status': status, 'cancel': cancel_button}
+        
+        status_texts = {'cancelled': "キャンセルされました", 'failed': "エラーが発生しました"}
+        row['bar'].set(1 if job.finished else job.progress / 100)
+        status_text = status_texts.get(job.status, job.status_text)
+        if job.id in self.unseen_job_ids:
+            status_text += "（未表示）"
+        row['status'].configure(text=status_text)
+        if job.finished:
+            row['cancel'].configure(state=tk.DISABLED)
+            if job.id not in self.finished_job_ids:
+                self.finished_job_ids.append(job.id)
+            # 古い終了済みジョブを一覧から除く
+            while len(self.finished_job_ids) > JOB_HISTORY_LIMIT:
+                old_id = self.finished_job_ids.pop(0)
+                self.unseen_job_ids.discard(old_id)
+                old = self.job_rows.pop(old_id, None)
+                if old is not None:
+                    old['frame'].destroy()
+        
+        active = job_scheduler.jobs()
+        running = sum(1 for j in active if j.status == 'running')
+        self.status_label.configure(
+            text=f"実行中: {running}件 / 待機中: {len(active) - running}件" if active else "待機中...")
+    
+    def show_job_result(self, job):
+        """終了したジョブの結果を結果欄に表示する"""
+        if job.result is not None:
+            with self._stream_lock:
+                self._stream_job_id = job.id
+            self.unseen_job_ids.discard(job.id)
+            self.set_result(job.result)
+            self.ui.post('job', job.id, job)
+    
+    def submit_job(self, kind, label, func, *args):
+        """ワークフローをジョブとして登録する"""
+        job_scheduler.submit(kind, label, func, args)
     
     def on_drive_search(self):
         """ドライブ検索ボタンのイベントハンドラ"""
@@ -642,31 +4278,11 @@ class AIAssistantApp:
             messagebox.showwarning("入力エラー", "検索クエリを入力してください。")
             return
         
-        # ボタンを無効化
-        self.disable_buttons()
-        
-        # 別スレッドで処理を実行
-        threading.Thread(target=self.run_drive_search, args=(query,), daemon=True).start()
-    
-    def run_drive_search(self, query):
-        """ドライブ検索を実行する"""
-        result = drive_search_and_suggest(query, self)
-        self.set_result(result)
-        self.enable_buttons()
+        self.submit_job('drive_search', f"ドライブ検索: {query[:20]}", drive_search_and_suggest, query)
     
     def on_email_process(self):
         """メール処理ボタンのイベントハンドラ"""
-        # ボタンを無効化
-        self.disable_buttons()
-        
-        # 別スレッドで処理を実行
-        threading.Thread(target=self.run_email_process, daemon=True).start()
-    
-    def run_email_process(self):
-        """メール処理を実行する"""
-        result = process_email(self)
-        self.set_result(result)
-        self.enable_buttons()
+        self.submit_job('email', "メール処理", process_email)
     
     def on_task_add(self):
         """タスク追加ボタンのイベントハンドラ"""
@@ -675,17 +4291,7 @@ class AIAssistantApp:
             messagebox.showwarning("入力エラー", "タスクを抽出するテキストを入力してください。")
             return
         
-        # ボタンを無効化
-        self.disable_buttons()
-        
-        # 別スレッドで処理を実行
-        threading.Thread(target=self.run_task_add, args=(content,), daemon=True).start()
-    
-    def run_task_add(self, content):
-        """タスク追加を実行する"""
-        result = add_task_from_content(content, self)
-        self.set_result(result)
-        self.enable_buttons()
+        self.submit_job('task_add', f"タスク追加: {content[:20]}", add_task_from_content, content)
     
     def on_report_generate(self):
         """レポート生成ボタンのイベントハンドラ"""
@@ -694,38 +4300,467 @@ class AIAssistantApp:
             messagebox.showwarning("入力エラー", "レポートのトピックを入力してください。")
             return
         
-        # ボタンを無効化
-        self.disable_buttons()
-        
-        # 別スレッドで処理を実行
-        threading.Thread(target=self.run_report_generate, args=(topic,), daemon=True).start()
+        self.submit_job('report', f"レポート: {topic[:20]}", generate_web_report, topic)
+
+# 裏での事前読み込み
+def start_background_warmup():
+    """重いSDKの読み込みとOpenAIクライアントの作成を裏で行い、完了を通知するEventを返す"""
+    done = threading.Event()
+    
+    def run():
+        for module in WARMUP_MODULES:
+            try:
+                module.ensure_loaded()
+            except ImportError as e:
+                print(f"事前読み込みエラー: {e}")
+        try:
+            llm_runtime.backends['openai'].client()
+        except Exception as e:
+            print(f"OpenAIクライアント作成エラー: {e}")
+        startup_profiler.mark('warmup_done')
+        done.set()
+    
+    threading.Thread(target=run, name='warmup', daemon=True).start()
+    return done
+
+# GUI以外から実行できるワークフロー（inputは引数の種類。Noneなら入力なし）
+WORKFLOWS = {
+    'drive_search': {'func': drive_search_and_suggest, 'label': "ドライブ検索", 'input': 'query'},
+    'email': {'func': process_email, 'label': "メール処理", 'input': None},
+    'task_add': {'func': add_task_from_content, 'label': "タスク追加", 'input': 'text'},
+    'report': {'func': generate_web_report, 'label': "レポート", 'input': 'topic'},
+}
+
+# ワークフロー結果の判定
+def result_status(job):
+    """ジョブの状態を返す（ワークフローがエラーを結果の文字列で返した場合もfailedとする）"""
+    if job.status == 'done' and isinstance(job.result, str) and job.result.startswith("エラーが発生しました"):
+        return 'failed'
+    return job.status
+
+# バッチ入力の読み込み
+def read_batch_inputs(path, input_format):
+    """入力ファイルを読み込み、入力のリストを返す（lines: 1行1件、paragraphs: 空行区切り、jsonl: 1行1JSON）"""
+    if path == '-':
+        text = sys.stdin.read()
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    if input_format == 'paragraphs':
+        return [block.strip() for block in re.split(r'\n\s*\n', text) if block.strip()]
+    if input_format == 'jsonl':
+        inputs = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if isinstance(item, dict):
+                item = next((item[key] for key in ('input', 'text', 'query', 'topic') if item.get(key)), None)
+            if isinstance(item, str) and item.strip():
+                inputs.append(item.strip())
+        return inputs
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+# バッチ実行
+def run_batch(args):
+    """ワークフローを入力ごとに並行実行し、終わった順に結果をJSONLで書き出す（終了コードを返す）"""
+    workflow = WORKFLOWS[args.workflow]
+    inputs = list(args.inputs)
+    if args.input:
+        input_format = args.input_format or ('jsonl' if args.input.endswith('.jsonl') else 'lines')
+        inputs.extend(read_batch_inputs(args.input, input_format))
+    if workflow['input'] is None:
+        inputs = [None]
+    elif not inputs:
+        print(f"入力がありません: {workflow['input']}を引数か--inputで指定してください。", file=sys.stderr)
+        return 2
+    
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    # ワークフロー内のprintがJSONLに混ざらないよう、標準出力を標準エラーに向ける
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    
+    scheduler = JobScheduler(workers=max(1, args.concurrency))
+    finished = queue.Queue()
+    started_at = {}
+    
+    def on_event(job, event, payload):
+        if event == 'started':
+            started_at[job.id] = (datetime.now(timezone.utc), time.monotonic())
+        elif event == 'finished':
+            finished.put(job)
+        elif event == 'progress' and not args.quiet:
+            print(f"[{job.id}] {job.label}: {job.status_text}", file=sys.stderr)
+    
+    scheduler.add_listener(on_event)
+    # 同じ入力は1つのジョブにまとめられるため、ジョブごとに入力の位置を控える
+    indices = {}
+    for index, value in enumerate(inputs):
+        job = scheduler.submit(
+            args.workflow,
+            workflow['label'] if value is None else f"{workflow['label']}: {value[:20]}",
+            workflow['func'],
+            () if value is None else (value,)
+        )
+        indices.setdefault(job.id, []).append(index)
+    
+    failures = 0
+    try:
+        for _ in range(len(indices)):
+            job = finished.get()
+            status = result_status(job)
+            started, started_monotonic = started_at.get(job.id, (None, None))
+            for index in indices[job.id]:
+                record = {
+                    'index': index,
+                    'workflow': args.workflow,
+                    'input': inputs[index],
+                    'job_id': job.id,
+                    'status': status,
+                    'started_at': started.isoformat(timespec='seconds') if started else None,
+                    'elapsed_seconds': round(time.monotonic() - started_monotonic, 3) if started else None,
+                    'result': job.result,
+                }
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                if status != 'done':
+                    failures += 1
+            output.flush()
+    finally:
+        sys.stdout = stdout
+        if args.output != '-':
+            output.close()
+    print(f"完了: {len(inputs) - failures}件成功, {failures}件失敗", file=sys.stderr)
+    return 1 if failures else 0
+
+# サーバーで扱うジョブの記録
+class ServerJobRecord:
+    """ジョブと、その進捗・出力のイベント列（途中から購読したクライアントにも最初から送る）"""
+    def __init__(self, job, value):
+        self.job = job
+        self.input = value
+        self.events = []
+        self.subscribers = set()
+    
+    def to_dict(self):
+        job = self.job
+        data = {
+            'job_id': job.id,
+            'workflow': job.kind,
+            'input': self.input,
+            'status': result_status(job),
+            'progress': 100 if job.finished else job.progress,
+            'status_text': job.status_text,
+        }
+        if job.finished:
+            data['result'] = job.result
+        return data
+
+# ローカルAPIサーバー
+class AssistantServer:
+    """ワークフローをHTTPで公開する（同じ入力の実行中ジョブは1つにまとめ、キャッシュや認証情報はプロセス内で共有する）"""
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_JOB_WORKERS):
+        self.host = host
+        self.port = port
+        self.scheduler = JobScheduler(workers=workers)
+        self.scheduler.add_listener(self.on_job_event)
+        self.records = {}  # ジョブID -> ServerJobRecord
+        self._finished_ids = []  # (ジョブID, 終了時刻) を古い順に並べたもの
+        self._loop = None
+    
+    async def serve_forever(self):
+        self._loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        print(f"APIサーバーを起動しました: http://{self.host}:{self.port}", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+    
+    def on_job_event(self, job, event, payload):
+        """ジョブの状態変化をイベントループに渡す（ワーカースレッドから呼ばれる）"""
+        if event == 'progress':
+            data = {'event': 'progress', 'progress': job.progress, 'status_text': job.status_text}
+        elif event == 'stream_begin':
+            data = {'event': 'stream_begin', 'text': payload}
+        elif event == 'stream_chunk':
+            data = {'event': 'chunk', 'text': payload}
+        else:
+            data = {'event': event}
+        try:
+            self._loop.call_soon_threadsafe(self._publish, job.id, data)
+        except RuntimeError:
+            pass  # イベントループの終了後
+    
+    def _publish(self, job_id, data):
+        record = self.records.get(job_id)
+        if record is None:
+            return
+        if data['event'] == 'finished':
+            data['job'] = record.to_dict()
+            # 終了後に購読したクライアントには結果を含む終了イベントだけを送り、途中のイベントは捨てる
+            record.events = [data]
+            self._finished_ids.append((job_id, time.monotonic()))
+            self._expire()
+        else:
+            self._record_event(record, data)
+        for subscriber in record.subscribers:
+            subscriber.put_nowait(data)
+    
+    def _record_event(self, record, data):
+        # 再送用の記録では、連続する出力の断片を1つにまとめ、進捗は最新のものだけを残す（送信済みのイベントは書き換えない）
+        last = record.events[-1] if record.events else None
+        if last is not None and last['event'] == data['event'] == 'chunk':
+            record.events[-1] = {'event': 'chunk', 'text': last['text'] + data['text']}
+        elif last is not None and last['event'] == data['event'] == 'progress':
+            record.events[-1] = data
+        else:
+            record.events.append(data)
+    
+    def _expire(self):
+        # 件数の上限を超えた分と、保持期間を過ぎた終了済みジョブの記録を捨てる
+        now = time.monotonic()
+        while self._finished_ids and (
+                len(self._finished_ids) > SERVER_JOB_HISTORY or now - self._finished_ids[0][1] > SERVER_JOB_RETENTION):
+            self.records.pop(self._finished_ids.pop(0)[0], None)
+    
+    async def follow(self, record):
+        """ジョブのイベントを最初から順に返し、終了イベントで止まる"""
+        subscriber = asyncio.Queue()
+        for data in record.events:
+            subscriber.put_nowait(data)
+        record.subscribers.add(subscriber)
+        try:
+            while True:
+                data = await subscriber.get()
+                yield data
+                if data['event'] == 'finished':
+                    return
+        finally:
+            record.subscribers.discard(subscriber)
+    
+    def submit(self, name, value):
+        """ジョブを登録し、(記録, 既存のジョブにまとめたか) を返す"""
+        workflow = WORKFLOWS[name]
+        args = () if workflow['input'] is None else (value,)
+        label = workflow['label'] if value is None else f"{workflow['label']}: {value[:20]}"
+        job = self.scheduler.submit(name, label, workflow['func'], args)
+        record = self.records.get(job.id)
+        if record is not None:
+            return record, True
+        record = self.records[job.id] = ServerJobRecord(job, value)
+        return record, False
+    
+    async def handle_connection(self, reader, writer):
+        """1つの接続でHTTP/1.1のリクエストを順に処理する"""
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), SERVER_KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                length = int(headers.get('content-length') or 0)
+                if length > SERVER_MAX_BODY_BYTES:
+                    await self.send_json(writer, 413, {'error': "リクエストが大きすぎます。"}, False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                keep_alive = await self.dispatch(writer, method.upper(), target, body, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        except Exception as e:
+            print(f"APIサーバーエラー: {e}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass  # 相手が先に切断した場合
+            except Exception as e:
+                print(f"APIサーバーの接続終了エラー: {e}")
     
-    def run_report_generate(self, topic):
-        """レポート生成を実行する"""
-        result = generate_web_report(topic, self)
-        self.set_result(result)
-        self.enable_buttons()
+    async def dispatch(self, writer, method, target, body, keep_alive):
+        """リクエストを振り分け、接続を維持するかを返す"""
+        self._expire()
+        parts = urlsplit(target)
+        path = [part for part in parts.path.split('/') if part]
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            return await self.send_json(writer, 400, {'error': "JSONを解析できません。"}, keep_alive)
+        if not isinstance(payload, dict):
+            return await self.send_json(writer, 400, {'error': "JSONオブジェクトを送ってください。"}, keep_alive)
+        stream = str(payload.get('stream', query.get('stream', ''))).lower() in ('1', 'true')
+        
+        if path == ['health'] and method == 'GET':
+            active = self.scheduler.jobs()
+            return await self.send_json(writer, 200, {
+                'status': 'ok',
+                'online': connectivity.is_online(),
+                'running': sum(1 for job in active if job.status == 'running'),
+                'pending': sum(1 for job in active if job.status == 'pending'),
+                'llm': llm_router.snapshot(),
+                'local_models': llm_runtime.backends['ollama'].snapshot(),
+                'google': service_registry.get_stats(),
+                'response_cache': response_cache.get_stats(),
+            }, keep_alive)
+        if path == ['workflows'] and method == 'GET':
+            workflows = [{'name': name, 'label': w['label'], 'input': w['input']} for name, w in WORKFLOWS.items()]
+            return await self.send_json(writer, 200, {'workflows': workflows}, keep_alive)
+        if path == ['jobs'] and method == 'GET':
+            jobs = [record.to_dict() for record in self.records.values()]
+            return await self.send_json(writer, 200, {'jobs': jobs}, keep_alive)
+        
+        # POST /jobs はジョブIDをすぐに返し、POST /workflows/<名前> は結果まで待つ
+        if method == 'POST' and (path == ['jobs'] or (len(path) == 2 and path[0] == 'workflows')):
+            name = payload.get('workflow') if path == ['jobs'] else path[1]
+            if name not in WORKFLOWS:
+                return await self.send_json(writer, 404, {'error': f"不明なワークフローです: {name}"}, keep_alive)
+            value = payload.get('input')
+            if WORKFLOWS[name]['input'] is None:
+                value = None
+            elif not isinstance(value, str) or not value.strip():
+                return await self.send_json(writer, 400, {'error': f"inputに{WORKFLOWS[name]['input']}を指定してください。"}, keep_alive)
+            else:
+                value = value.strip()
+            record, coalesced = self.submit(name, value)
+            if stream:
+                return await self.send_stream(writer, record, keep_alive)
+            if path == ['jobs'] and not payload.get('wait'):
+                data = dict(record.to_dict(), coalesced=coalesced)
+                return await self.send_json(writer, 202, data, keep_alive)
+            async for _ in self.follow(record):
+                pass
+            return await self.send_json(writer, 200, dict(record.to_dict(), coalesced=coalesced), keep_alive)
+        
+        if path[:1] == ['jobs'] and len(path) in (2, 3):
+            record = self.records.get(int(path[1])) if path[1].isdigit() else None
+            if record is None:
+                return await self.send_json(writer, 404, {'error': "ジョブが見つかりません。"}, keep_alive)
+            if len(path) == 3 and path[2] == 'events' and method == 'GET':
+                return await self.send_stream(writer, record, keep_alive)
+            if len(path) == 2 and method == 'GET':
+                return await self.send_json(writer, 200, record.to_dict(), keep_alive)
+            if len(path) == 2 and method == 'DELETE':
+                record.job.cancel()
+                return await self.send_json(writer, 202, record.to_dict(), keep_alive)
+        return await self.send_json(writer, 404, {'error': "見つかりません。"}, keep_alive)
     
-    def disable_buttons(self):
-        """ボタンを無効化する"""
-        self.drive_button.configure(state=tk.DISABLED)
-        self.email_button.configure(state=tk.DISABLED)
-        self.task_button.configure(state=tk.DISABLED)
-        self.report_button.configure(state=tk.DISABLED)
+    async def send_json(self, writer, status, data, keep_alive):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        head = (
+            f"HTTP/1.1 {status} {SERVER_STATUS_TEXTS.get(status, '')}\r\n"
+            "Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+        return keep_alive
     
-    def enable_buttons(self):
-        """ボタンを有効化する"""
-        self.drive_button.configure(state=tk.NORMAL)
-        self.email_button.configure(state=tk.NORMAL)
-        self.task_button.configure(state=tk.NORMAL)
-        self.report_button.configure(state=tk.NORMAL)
+    async def send_stream(self, writer, record, keep_alive):
+        """ジョブのイベントを1行1JSONでチャンク転送する"""
+        head = (
+            "HTTP/1.1 200 OK\r\n"
+            "Content-Type: application/x-ndjson; charset=utf-8\r\n"
+            "Transfer-Encoding: chunked\r\n"
+            "Cache-Control: no-cache\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1'))
+        async for data in self.follow(record):
+            line = (json.dumps(dict(data, job_id=record.job.id), ensure_ascii=False) + "\n").encode('utf-8')
+            writer.write(f"{len(line):x}\r\n".encode('latin-1') + line + b"\r\n")
+            # 受け手が遅い場合はここで待ち、出力を溜め込まない
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return keep_alive
+
+# APIサーバーの実行
+def run_server(args):
+    """ローカルAPIサーバーを起動し、終了するまで処理を続ける"""
+    start_background_warmup()
+    connectivity.start()
+    start_local_model_manager()
+    if os.path.exists(service_registry.token_path):
+        drive_index.ensure_fresh()
+    server = AssistantServer(args.host, args.port, max(1, args.workers))
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print("APIサーバーを停止しました。", file=sys.stderr)
+    return 0
 
 # メイン実行
-def setup_gui():
+def setup_gui(profile_startup=False):
     """GUIをセットアップして実行する"""
     root = ctk.CTk()
     app = AIAssistantApp(root)
+    startup_profiler.mark('window_created')
+    
+    def on_first_paint():
+        startup_profiler.mark('first_paint')
+        # 画面が表示されてからSDKの読み込みや同期を始める
+        warmup_done = start_background_warmup()
+        connectivity.start()
+        start_local_model_manager()
+        # 認証済みであれば、ドライブ索引の同期を裏で始めておく
+        if os.path.exists(service_registry.token_path):
+            drive_index.ensure_fresh()
+        if profile_startup:
+            finish_profile(warmup_done)
+    
+    def finish_profile(warmup_done):
+        # 計測モードでは事前読み込みの完了後に結果を出力して終了する
+        if not warmup_done.is_set():
+            root.after(50, finish_profile, warmup_done)
+            return
+        startup_profiler.report(os.path.join(CACHE_DIR, 'startup_profile.json'))
+        root.destroy()
+    
+    root.after_idle(lambda: root.after(0, on_first_paint))
     root.mainloop()
 
+# コマンドライン引数
+def build_arg_parser():
+    """引数なしでGUIを起動し、runサブコマンドでワークフローをGUIなしで実行し、serveサブコマンドでAPIサーバーを起動する"""
+    parser = argparse.ArgumentParser(description="AI業務アシスタント")
+    parser.add_argument('--profile-startup', action='store_true', help="起動時間を計測して終了する")
+    subparsers = parser.add_subparsers(dest='command')
+    run = subparsers.add_parser('run', help="GUIを使わずにワークフローを実行する（結果はJSONL）")
+    run.add_argument('workflow', choices=list(WORKFLOWS), help="実行するワークフロー")
+    run.add_argument('inputs', nargs='*', help="検索クエリ・タスク抽出するテキスト・レポートのトピック")
+    run.add_argument('-i', '--input', help="入力ファイル（-で標準入力）")
+    run.add_argument('--input-format', choices=('lines', 'paragraphs', 'jsonl'),
+                     help="入力ファイルの形式（既定は拡張子が.jsonlならjsonl、それ以外はlines）")
+    run.add_argument('-c', '--concurrency', type=int, default=JOB_WORKERS, help="同時に実行する数")
+    run.add_argument('-o', '--output', default='-', help="結果の出力先（既定は標準出力）")
+    run.add_argument('-q', '--quiet', action='store_true', help="進捗を表示しない")
+    serve = subparsers.add_parser('serve', help="ワークフローをHTTPで公開するローカルAPIサーバーを起動する")
+    serve.add_argument('--host', default=SERVER_HOST, help="待ち受けるアドレス")
+    serve.add_argument('--port', type=int, default=SERVER_PORT, help="待ち受けるポート")
+    serve.add_argument('-w', '--workers', type=int, default=SERVER_JOB_WORKERS, help="同時に実行するジョブ数")
+    return parser
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.command == 'run':
+        sys.exit(run_batch(args))
+    if args.command == 'serve':
+        sys.exit(run_server(args))
+    setup_gui(profile_startup=args.profile_startup)
+
+startup_profiler.mark('module_loaded')
+
 if __name__ == "__main__":
-    setup_gui()
\ No newline at end of file
+    main()
\ No newline at end of file
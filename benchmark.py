@@ -0,0 +1,824 @@
+# AI業務アシスタントのオフラインベンチマーク
+#
+# OpenAI・Google API（ドライブ/Gmail/タスク）・Ollamaをローカルの偽サーバーで代替し、
+# 4つのワークフローをGUIなしで繰り返し実行して、遅延（p50/p95）・API往復回数・メモリを計測する。
+#
+# 使い方:
+#   python benchmark.py --iterations 20 --latency-ms 80 --output result.json
+#   python benchmark.py --compare result.json
+import argparse
+import base64
+import email.parser
+import gc
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import pickle
+import random
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from google.auth.credentials import Credentials
+
+try:
+    import resource
+except ImportError:
+    # Windowsでは最大RSSを表示しない
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 計測対象のワークフロー
+WORKFLOW_NAMES = ('drive_search', 'email', 'task', 'report')
+# オフラインではGoogleタスクに追加できないため、タスク追加は対象外にする
+OFFLINE_WORKFLOW_NAMES = ('drive_search', 'email', 'report')
+
+# 偽データの語彙（検索語はFTSの対象になるよう3文字以上にする）
+DRIVE_TOPICS = ("予算計画", "会議資料", "議事録", "売上報告", "採用計画", "契約書", "提案書", "顧客分析")
+DRIVE_MIME_TYPES = (
+    'application/vnd.google-apps.document',
+    'application/vnd.google-apps.spreadsheet',
+    'text/plain',
+    'application/pdf',
+)
+FILLER_TEXT = "ご依頼の内容を確認しました。関連する資料と今後の対応方針を整理し、優先度の高い項目から順にご提案します。"
+TASK_CONTENT = """
+来週の定例会議までに売上報告の資料をまとめ、部長に共有してください。
+また、採用計画の見直しについて人事部と打ち合わせの日程を調整し、
+契約書の更新期限が月末なので法務部に確認をお願いします。
+"""
+
+# 偽サーバーの応答生成
+class FakeBackend:
+    """OpenAI・Ollama・Google APIの応答を生成し、種類ごとのリクエスト数と送信量を集計する"""
+    def __init__(self, options):
+        self.options = options
+        self.rng = random.Random(options['seed'])
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.base_time = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.files = [self._make_file(index) for index in range(options['files'])]
+        self.files_by_id = {item['id']: item for item in self.files}
+        self.messages = {}
+        self.unread = []
+        self.history = []
+        self.history_id = 1000
+        self.tasks = [
+            {'id': f"task{index:05d}", 'title': f"既存タスク{index}", 'status': 'needsAction',
+             'updated': self._timestamp(index)}
+            for index in range(options['existing_tasks'])
+        ]
+    
+    def _timestamp(self, offset_minutes):
+        return (self.base_time + timedelta(minutes=offset_minutes)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    
+    def _text(self, seed, size):
+        # 指定バイト数程度の本文を作る（UTF-8で日本語1文字は3バイト）
+        text = f"{seed}についての資料です。" + FILLER_TEXT
+        return (text * (size // len(text.encode('utf-8')) + 1))[:max(1, size // 3)]
+    
+    def _make_file(self, index):
+        topic = DRIVE_TOPICS[index % len(DRIVE_TOPICS)]
+        mime_type = DRIVE_MIME_TYPES[index % len(DRIVE_MIME_TYPES)]
+        item = {
+            'id': f"file{index:05d}",
+            'name': f"{topic}_{index:04d}",
+            'mimeType': mime_type,
+            'webViewLink': f"https://drive.google.com/file/d/file{index:05d}/view",
+            'description': f"{topic}に関するファイル",
+            'createdTime': self._timestamp(index),
+            'modifiedTime': self._timestamp(index + 60),
+            'trashed': False,
+        }
+        if not mime_type.startswith('application/vnd.google-apps.'):
+            item['size'] = str(self.options['body_kb'] * 1024)
+        return item
+    
+    def count(self, category, requests=1, sent=0):
+        with self.lock:
+            entry = self.stats.setdefault(category, {'requests': 0, 'bytes': 0})
+            entry['requests'] += requests
+            entry['bytes'] += sent
+    
+    def _delay(self, milliseconds):
+        if milliseconds > 0:
+            with self.lock:
+                jitter = self.rng.uniform(0, self.options['jitter_ms'])
+            time.sleep((milliseconds + jitter) / 1000)
+    
+    def _fails(self):
+        if self.options['error_rate'] <= 0:
+            return False
+        with self.lock:
+            return self.rng.random() < self.options['error_rate']
+    
+    def handle(self, method, path, headers, body):
+        """リクエストを振り分け、(カテゴリ, ステータス, ヘッダー, 本文) を返す（本文は生成器の場合あり）"""
+        parts = urlsplit(path)
+        route = parts.path
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        
+        if route.startswith('/_bench/'):
+            return ('control',) + self._control(method, route, query)
+        if route == '/generate_204':
+            return 'control', 204, {}, b''
+        if route.startswith('/discovery/v1/apis/'):
+            return ('control',) + self._discovery(route)
+        
+        if route in ('/v1/chat/completions', '/v1/embeddings'):
+            category = 'openai'
+        elif route in ('/api/chat', '/api/generate', '/api/embed'):
+            category = 'ollama'
+        else:
+            category = 'google'
+        self.count(category)
+        self._delay(self.options['latency_ms'])
+        
+        if category == 'openai':
+            if self._fails():
+                return category, 500, {'Content-Type': 'application/json'}, json.dumps(
+                    {'error': {'message': "偽サーバーのエラー", 'type': 'server_error'}}).encode('utf-8')
+            if route == '/v1/embeddings':
+                return (category,) + self._openai_embeddings(json.loads(body))
+            return (category,) + self._openai(json.loads(body))
+        if category == 'ollama':
+            if self._fails():
+                return category, 500, {'Content-Type': 'application/json'}, b'{"error": "fake error"}'
+            if route == '/api/generate':
+                return (category,) + self._ollama_load(json.loads(body))
+            if route == '/api/embed':
+                return (category,) + self._ollama_embed(json.loads(body))
+            return (category,) + self._ollama(json.loads(body))
+        if self._fails():
+            return (category,) + self._google_error(503, 'UNAVAILABLE')
+        if route.startswith('/batch'):
+            return (category,) + self._batch(headers, body)
+        self.count('google_calls')
+        status, payload = self._google(method, route, query, body)
+        return (category,) + self._google_response(status, payload)
+    
+    # 計測用の制御エンドポイント
+    def _control(self, method, route, query):
+        if route == '/_bench/stats':
+            with self.lock:
+                payload = json.dumps(self.stats)
+            return 200, {'Content-Type': 'application/json'}, payload.encode('utf-8')
+        if route == '/_bench/gmail/deliver' and method == 'POST':
+            self.deliver(int(query.get('count', 1)), query.get('replace') == '1')
+            return 204, {}, b''
+        return 404, {}, b''
+    
+    def _discovery(self, route):
+        # ライブラリ同梱のDiscoveryドキュメントをそのまま返す
+        from googleapiclient.discovery_cache import get_static_doc
+        match = re.fullmatch(r'/discovery/v1/apis/([^/]+)/([^/]+)/rest', route)
+        content = get_static_doc(*match.groups()) if match else None
+        if content is None:
+            return 404, {}, b''
+        return 200, {'Content-Type': 'application/json'}, content.encode('utf-8')
+    
+    # LLM応答
+    def _completion_text(self, messages, structured):
+        prompt = messages[-1]['content'] if messages else ""
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:8]
+        if structured:
+            return json.dumps({'tasks': [
+                {'title': f"ベンチマークタスク{digest}-{index}", 'notes': FILLER_TEXT[:40],
+                 'due': "2030-01-15", 'priority': "中"}
+                for index in range(self.options['tasks'])
+            ]}, ensure_ascii=False)
+        return (FILLER_TEXT * (self.options['response_chars'] // len(FILLER_TEXT) + 1))[:self.options['response_chars']]
+    
+    def _pieces(self, text):
+        # 最初のトークンまでの時間を待ってから、一定間隔で少しずつ返す
+        self._delay(self.options['llm_latency_ms'])
+        size = self.options['chunk_chars']
+        for start in range(0, len(text), size):
+            if start:
+                time.sleep(self.options['chunk_ms'] / 1000)
+            yield text[start:start + size]
+    
+    def _openai(self, request):
+        structured = (request.get('response_format') or {}).get('type') == 'json_schema'
+        text = self._completion_text(request.get('messages', []), structured)
+        base = {'id': f"chatcmpl-{uuid.uuid4().hex}", 'created': int(time.time()), 'model': request.get('model')}
+        if not request.get('stream'):
+            self._delay(self.options['llm_latency_ms'])
+            time.sleep(self.options['chunk_ms'] / 1000 * (len(text) // self.options['chunk_chars']))
+            payload = dict(base, object='chat.completion', choices=[{
+                'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'
+            }], usage={'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0})
+            return 200, {'Content-Type': 'application/json'}, json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        
+        def events():
+            for piece in self._pieces(text):
+                chunk = dict(base, object='chat.completion.chunk', choices=[
+                    {'index': 0, 'delta': {'content': piece}, 'finish_reason': None}])
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8')
+            chunk = dict(base, object='chat.completion.chunk', choices=[
+                {'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+            yield f"data: {json.dumps(chunk)}\n\n".encode('utf-8')
+            yield b"data: [DONE]\n\n"
+        
+        return 200, {'Content-Type': 'text/event-stream'}, events()
+    
+    def _ollama(self, request):
+        text = self._completion_text(request.get('messages', []), bool(request.get('format')))
+        base = {'model': request.get('model'), 'created_at': datetime.now(timezone.utc).isoformat()}
+        if not request.get('stream', True):
+            self._delay(self.options['llm_latency_ms'])
+            time.sleep(self.options['chunk_ms'] / 1000 * (len(text) // self.options['chunk_chars']))
+            payload = dict(base, message={'role': 'assistant', 'content': text}, done=True, done_reason='stop')
+            return 200, {'Content-Type': 'application/json'}, json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        
+        def lines():
+            for piece in self._pieces(text):
+                chunk = dict(base, message={'role': 'assistant', 'content': piece}, done=False)
+                yield (json.dumps(chunk, ensure_ascii=False) + "\n").encode('utf-8')
+            chunk = dict(base, message={'role': 'assistant', 'content': ""}, done=True, done_reason='stop')
+            yield (json.dumps(chunk) + "\n").encode('utf-8')
+        
+        return 200, {'Content-Type': 'application/x-ndjson'}, lines()
+    
+    def _ollama_load(self, request):
+        # 空のプロンプトによるモデルの読み込み・解放（keep_alive=0）には生成せずに応答する
+        payload = {
+            'model': request.get('model'), 'created_at': datetime.now(timezone.utc).isoformat(),
+            'response': "", 'done': True, 'done_reason': 'unload' if request.get('keep_alive') == 0 else 'load',
+            'load_duration': 0,
+        }
+        return 200, {'Content-Type': 'application/json'}, json.dumps(payload).encode('utf-8')
+    
+    # 埋め込み（文字バイグラムをハッシュした正規化ベクトル。共通の語が多い文ほど類似度が高くなる）
+    def _embedding(self, text, dimensions):
+        vector = [0.0] * dimensions
+        for start in range(len(text) - 1):
+            digest = hashlib.md5(text[start:start + 2].encode('utf-8')).digest()
+            vector[int.from_bytes(digest[:4], 'little') % dimensions] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+    
+    def _inputs(self, request):
+        inputs = request.get('input', [])
+        return [inputs] if isinstance(inputs, str) else inputs
+    
+    def _openai_embeddings(self, request):
+        inputs = self._inputs(request)
+        dimensions = request.get('dimensions') or 1536
+        vectors = [self._embedding(text, dimensions) for text in inputs]
+        if request.get('encoding_format') == 'base64':
+            # SDKは既定でbase64（float32のリトルエンディアン）を要求する
+            vectors = [base64.b64encode(struct.pack(f'<{dimensions}f', *vector)).decode('ascii') for vector in vectors]
+        payload = {
+            'object': 'list', 'model': request.get('model'),
+            'data': [{'object': 'embedding', 'index': index, 'embedding': vector} for index, vector in enumerate(vectors)],
+            'usage': {'prompt_tokens': sum(len(text) for text in inputs), 'total_tokens': sum(len(text) for text in inputs)},
+        }
+        return 200, {'Content-Type': 'application/json'}, json.dumps(payload).encode('utf-8')
+    
+    def _ollama_embed(self, request):
+        inputs = self._inputs(request)
+        payload = {
+            'model': request.get('model'), 'embeddings': [self._embedding(text, 768) for text in inputs],
+            'prompt_eval_count': sum(len(text) for text in inputs),
+        }
+        return 200, {'Content-Type': 'application/json'}, json.dumps(payload).encode('utf-8')
+    
+    # Google API
+    def _google_error(self, status, reason):
+        payload = {'error': {'code': status, 'message': reason, 'status': reason}}
+        return status, {'Content-Type': 'application/json; charset=UTF-8'}, json.dumps(payload).encode('utf-8')
+    
+    def _google_response(self, status, payload):
+        if status >= 400:
+            return self._google_error(status, payload)
+        if isinstance(payload, bytes):
+            return status, {'Content-Type': 'text/plain; charset=UTF-8'}, payload
+        return status, {'Content-Type': 'application/json; charset=UTF-8'}, json.dumps(
+            payload, ensure_ascii=False).encode('utf-8')
+    
+    def _page(self, items, query, key, default_size):
+        start = int(query.get('pageToken') or 0)
+        size = int(query.get('pageSize') or query.get('maxResults') or default_size)
+        result = {key: items[start:start + size]}
+        if start + size < len(items):
+            result['nextPageToken'] = str(start + size)
+        return result
+    
+    def _google(self, method, route, query, body):
+        """Google APIの1リクエストを処理し、(ステータス, 本文) を返す"""
+        if route.startswith('/drive/v3/'):
+            return self._drive(route[len('/drive/v3/'):], query)
+        if route.startswith('/gmail/v1/users/me/'):
+            return self._gmail(route[len('/gmail/v1/users/me/'):], query)
+        if route.startswith('/tasks/v1/'):
+            return self._tasks(method, route[len('/tasks/v1/'):], query, body)
+        return 404, 'NOT_FOUND'
+    
+    def _drive(self, route, query):
+        if route == 'changes/startPageToken':
+            return 200, {'startPageToken': '1'}
+        if route == 'changes':
+            return 200, {'changes': [], 'newStartPageToken': query.get('pageToken', '1')}
+        if route == 'files':
+            items = self.files
+            match = re.search(r"fullText contains '((?:[^'\\]|\\.)*)'", query.get('q', ''))
+            if match:
+                term = re.sub(r'\\(.)', r'\1', match.group(1))
+                items = [item for item in items if term in item['name'] or term in item['description']]
+            return 200, self._page(items, query, 'files', 100)
+        match = re.fullmatch(r'files/([^/]+)(/export)?', route)
+        if match and match.group(1) in self.files_by_id:
+            item = self.files_by_id[match.group(1)]
+            if match.group(2) or query.get('alt') == 'media':
+                return 200, self._text(item['name'], self.options['body_kb'] * 1024).encode('utf-8')
+            return 200, item
+        return 404, 'NOT_FOUND'
+    
+    def deliver(self, count, replace):
+        """未読メールをcount件届ける（replace指定時はそれまでの未読を既読にする）"""
+        with self.lock:
+            if replace and self.unread:
+                self.history_id += 1
+                self.history.append({'id': str(self.history_id), 'labelsRemoved': [
+                    {'message': {'id': message_id, 'labelIds': ['INBOX']}, 'labelIds': ['UNREAD']}
+                    for message_id in self.unread
+                ]})
+                self.unread = []
+            for _ in range(count):
+                number = len(self.messages)
+                message_id = f"msg{number:08x}"
+                body = self._text(f"案件{number}", self.options['body_kb'] * 1024)
+                self.messages[message_id] = {
+                    'id': message_id,
+                    'threadId': message_id,
+                    'labelIds': ['UNREAD', 'INBOX'],
+                    'internalDate': str(int(time.time() * 1000) + number),
+                    'payload': {
+                        'mimeType': 'text/plain',
+                        'headers': [
+                            {'name': 'Subject', 'value': f"{DRIVE_TOPICS[number % len(DRIVE_TOPICS)]}の件（{number}）"},
+                            {'name': 'From', 'value': f"sender{number}@example.com"},
+                        ],
+                        'body': {'size': len(body.encode('utf-8')),
+                                 'data': base64.urlsafe_b64encode(body.encode('utf-8')).decode('ascii')},
+                    },
+                }
+                self.unread.insert(0, message_id)
+                self.history_id += 1
+                self.history.append({'id': str(self.history_id), 'messagesAdded': [
+                    {'message': {'id': message_id, 'labelIds': ['UNREAD', 'INBOX']}}]})
+    
+    def _gmail(self, route, query):
+        with self.lock:
+            if route == 'profile':
+                return 200, {'historyId': str(self.history_id)}
+            if route == 'messages':
+                result = self._page([{'id': message_id} for message_id in self.unread], query, 'messages', 100)
+                return 200, result
+            if route == 'history':
+                start = int(query.get('startHistoryId', 0))
+                records = [record for record in self.history if int(record['id']) > start]
+                result = self._page(records, query, 'history', 100)
+                result['historyId'] = str(self.history_id)
+                return 200, result
+            match = re.fullmatch(r'messages/([^/]+)', route)
+            if match and match.group(1) in self.messages:
+                return 200, self.messages[match.group(1)]
+        return 404, 'NOT_FOUND'
+    
+    def _tasks(self, method, route, query, body):
+        if route == 'users/@me/lists':
+            if method == 'POST':
+                return 200, {'id': 'bench-list', 'title': json.loads(body).get('title', '')}
+            return 200, {'items': [{'id': 'bench-list', 'title': 'ベンチマーク'}]}
+        if route == 'lists/bench-list/tasks':
+            with self.lock:
+                if method == 'POST':
+                    request = json.loads(body)
+                    task = {'id': f"task{len(self.tasks):05d}", 'title': request.get('title', ''),
+                            'status': 'needsAction', 'updated': self._timestamp(len(self.tasks) + 100000)}
+                    self.tasks.append(task)
+                    return 200, task
+                updated_min = query.get('updatedMin')
+                items = [task for task in self.tasks if updated_min is None or task['updated'] >= updated_min]
+                return 200, self._page(items, query, 'items', 100)
+        return 404, 'NOT_FOUND'
+    
+    def _batch(self, headers, body):
+        # multipart/mixedの各パートをHTTPリクエストとして処理し、同じ形式で返す
+        message = email.parser.BytesParser().parsebytes(
+            b"Content-Type: " + headers['Content-Type'].encode('ascii') + b"\r\n\r\n" + body)
+        boundary = f"batch_{uuid.uuid4().hex}"
+        parts = []
+        for part in message.get_payload():
+            raw = part.get_payload(decode=True).decode('utf-8')
+            request_line, _, rest = raw.partition('\n')
+            method, target = request_line.split(' ')[:2]
+            sections = re.split(r'\r?\n\r?\n', rest, maxsplit=1)
+            inner_body = sections[1].encode('utf-8') if len(sections) > 1 else b''
+            inner = urlsplit(target)
+            inner_query = {key: values[-1] for key, values in parse_qs(inner.query).items()}
+            self.count('google_calls')
+            if self._fails():
+                status, payload = 429, 'RESOURCE_EXHAUSTED'
+            else:
+                status, payload = self._google(method, inner.path, inner_query, inner_body)
+            status, response_headers, content = self._google_response(status, payload)
+            header_lines = "".join(f"{name}: {value}\r\n" for name, value in response_headers.items())
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'].strip('<>')}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\n{header_lines}\r\n"
+                + content.decode('utf-8') + "\r\n"
+            )
+        payload = ("".join(parts) + f"--{boundary}--\r\n").encode('utf-8')
+        return 200, {'Content-Type': f"multipart/mixed; boundary={boundary}"}, payload
+
+# 偽サーバーのHTTPハンドラー
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def _dispatch(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        backend = self.server.backend
+        category, status, headers, payload = backend.handle(method, self.path, self.headers, body)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if isinstance(payload, bytes):
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            if method != 'HEAD':
+                self.wfile.write(payload)
+            backend.count(category, 0, len(payload))
+            return
+        # ストリーミング応答はチャンク転送で逐次送る
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for piece in payload:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(piece), piece))
+            self.wfile.flush()
+            backend.count(category, 0, len(piece))
+        self.wfile.write(b"0\r\n\r\n")
+    
+    def do_GET(self):
+        self._dispatch('GET')
+    
+    def do_HEAD(self):
+        self._dispatch('HEAD')
+    
+    def do_POST(self):
+        self._dispatch('POST')
+    
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+    
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+def serve_fake_services(options, conn):
+    """偽サーバーを起動し、待ち受けポートを親プロセスに通知する（別プロセスで実行）"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeServiceHandler)
+    server.daemon_threads = True
+    server.backend = FakeBackend(options)
+    conn.send(server.server_address[1])
+    conn.close()
+    server.serve_forever()
+
+# 偽サーバーの制御
+class FakeServices:
+    """偽サーバーを別プロセスで起動し、集計値の取得やメールの配信を行う"""
+    def __init__(self, options):
+        # 計測対象のプロセスとGILを奪い合わないよう、別プロセスで動かす
+        context = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(target=serve_fake_services, args=(options, child_conn), daemon=True)
+        self.process.start()
+        self.base_url = f"http://127.0.0.1:{parent_conn.recv()}"
+        self._opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+    
+    def _request(self, path, method='GET'):
+        request = urllib.request.Request(self.base_url + path, method=method)
+        with self._opener.open(request) as response:
+            return response.read()
+    
+    def stats(self):
+        return json.loads(self._request('/_bench/stats'))
+    
+    def deliver_mail(self, count, replace=True):
+        self._request(f"/_bench/gmail/deliver?count={count}&replace={int(replace)}", method='POST')
+    
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+# テスト用の認証情報
+class BenchmarkCredentials(Credentials):
+    """token.pickleに保存する偽の認証情報（期限がなく、更新は不要）"""
+    refresh_token = None
+    
+    def __init__(self):
+        super().__init__()
+        self.token = 'benchmark'
+    
+    def refresh(self, request):
+        pass
+
+# Google APIの転送
+class RedirectingHttp:
+    """googleapis.comへのリクエストを偽サーバーに転送する"""
+    def __init__(self, http, target):
+        self.http = http
+        self.target = target
+    
+    def request(self, uri, method='GET', *args, **kwargs):
+        parts = urlsplit(uri)
+        if parts.hostname and parts.hostname.endswith('googleapis.com'):
+            uri = self.target['google'] + parts.path + (f"?{parts.query}" if parts.query else "")
+        return self.http.request(uri, method, *args, **kwargs)
+    
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+def load_agent(base_url, workdir):
+    """偽サーバーを向くよう環境を整えてからai_agentを読み込み、(モジュール, 転送先) を返す"""
+    os.environ.update({
+        'OPENAI_API_KEY': 'benchmark',
+        'OPENAI_BASE_URL': f"{base_url}/v1",
+        'OLLAMA_HOST': base_url,
+        'NO_PROXY': '127.0.0.1,localhost',
+        'no_proxy': '127.0.0.1,localhost',
+    })
+    # キャッシュや認証情報は作業ディレクトリからの相対パスで保存される
+    os.chdir(workdir)
+    with open('token.pickle', 'wb') as token:
+        pickle.dump(BenchmarkCredentials(), token)
+    sys.path.insert(0, REPO_DIR)
+    import ai_agent
+    
+    target = {'google': base_url}
+    monitored_init = ai_agent.MonitoredHttp.__init__
+    
+    def init(self, timeout=ai_agent.GOOGLE_HTTP_TIMEOUT):
+        monitored_init(self, timeout)
+        self.http = RedirectingHttp(self.http, target)
+    
+    ai_agent.MonitoredHttp.__init__ = init
+    ai_agent.connectivity.probe_url = f"{base_url}/generate_204"
+    return ai_agent, target
+
+def go_offline(agent, target):
+    """接続できない宛先に切り替え、アプリをオフラインの状態にする"""
+    unreachable = "http://127.0.0.1:9"
+    target['google'] = unreachable
+    agent.connectivity.probe_url = f"{unreachable}/generate_204"
+    agent.connectivity.report_failure('benchmark', "オフライン計測")
+
+# ワークフローに渡すappの代わり
+class BenchmarkApp:
+    """進捗表示を受け流し、最初の出力までの時間を記録する"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_output = None
+    
+    def update_progress(self, value, status_text):
+        pass
+    
+    def check_cancelled(self):
+        pass
+    
+    def begin_stream(self, header=""):
+        pass
+    
+    def append_result(self, chunk):
+        if self.first_output is None:
+            self.first_output = time.perf_counter() - self.started
+
+def run_workflow(agent, name, iteration, app, warm):
+    """ワークフローを1回実行して結果の文字列を返す（warm指定時は毎回同じ入力を使う）"""
+    index = 0 if warm else iteration
+    topic = DRIVE_TOPICS[index % len(DRIVE_TOPICS)]
+    if name == 'drive_search':
+        return agent.drive_search_and_suggest(topic, app)
+    if name == 'email':
+        return agent.process_email(app)
+    if name == 'task':
+        content = TASK_CONTENT if warm else f"{TASK_CONTENT}（{iteration}回目の依頼）"
+        return agent.add_task_from_content(content, app)
+    return agent.generate_web_report(topic, app)
+
+def is_failure(agent, result):
+    return (
+        not isinstance(result, str)
+        or result.startswith("エラーが発生しました")
+        or "失敗しました。" in result
+        or agent.LLM_UNAVAILABLE_MESSAGE in result
+    )
+
+def stats_delta(before, after):
+    delta = {}
+    for category, entry in after.items():
+        previous = before.get(category, {'requests': 0, 'bytes': 0})
+        delta[category] = {key: entry[key] - previous[key] for key in ('requests', 'bytes')}
+    return delta
+
+def percentile(values, q):
+    """最近順位法でパーセンタイルを求める"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+# 1ワークフローの計測
+def benchmark_workflow(agent, services, name, options):
+    """ウォームアップ後に繰り返し実行し、遅延・往復回数・メモリの集計を返す"""
+    samples = []
+    first_outputs = []
+    failures = 0
+    totals = {}
+    
+    def run_once(iteration):
+        if not options.warm:
+            # 毎回LLMへの問い合わせが発生するよう、応答キャッシュを空にする
+            agent.response_cache.clear()
+        if name == 'email' and not options.offline and (not options.warm or iteration == 0):
+            services.deliver_mail(options.emails)
+        app = BenchmarkApp()
+        before = services.stats()
+        started = time.perf_counter()
+        try:
+            result = run_workflow(agent, name, iteration, app, options.warm)
+        except Exception as e:
+            print(f"{name} 実行エラー: {e}")
+            result = None
+        elapsed = time.perf_counter() - started
+        return result, elapsed, app.first_output, stats_delta(before, services.stats())
+    
+    for iteration in range(options.warmup + options.iterations):
+        result, elapsed, first_output, delta = run_once(iteration)
+        if iteration < options.warmup:
+            continue
+        samples.append(elapsed)
+        if first_output is not None:
+            first_outputs.append(first_output)
+        if is_failure(agent, result):
+            failures += 1
+        for category, entry in delta.items():
+            total = totals.setdefault(category, {'requests': 0, 'bytes': 0})
+            total['requests'] += entry['requests']
+            total['bytes'] += entry['bytes']
+    
+    # メモリは計測のオーバーヘッドが遅延に影響しないよう、別に1回実行して測る
+    gc.collect()
+    tracemalloc.start()
+    run_once(options.warmup + options.iterations)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    count = len(samples)
+    per_run = {
+        category: {key: value / count for key, value in entry.items()}
+        for category, entry in totals.items()
+        if category != 'control'
+    }
+    return {
+        'iterations': count,
+        'failures': failures,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p95_ms': percentile(samples, 95) * 1000,
+        'max_ms': max(samples) * 1000,
+        'first_output_p50_ms': percentile(first_outputs, 50) * 1000 if first_outputs else None,
+        'per_run': per_run,
+        'peak_kb': peak / 1024,
+        'retained_kb': current / 1024,
+    }
+
+# 結果の表示
+def format_number(value, digits=0):
+    return "-" if value is None else f"{value:.{digits}f}"
+
+def print_results(results, baseline=None):
+    print()
+    print(f"{'workflow':<13}{'n':>4}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'first ms':>10}"
+          f"{'google':>8}{'calls':>7}{'openai':>8}{'ollama':>8}{'recv KB':>9}{'peak KB':>9}")
+    for name, result in results.items():
+        per_run = result['per_run']
+        received = sum(entry['bytes'] for entry in per_run.values()) / 1024
+        print(
+            f"{name:<13}{result['iterations']:>4}{result['failures']:>5}"
+            f"{format_number(result['p50_ms']):>10}{format_number(result['p95_ms']):>10}"
+            f"{format_number(result['max_ms']):>10}{format_number(result['first_output_p50_ms']):>10}"
+            f"{format_number(per_run.get('google', {}).get('requests'), 1):>8}"
+            f"{format_number(per_run.get('google_calls', {}).get('requests'), 1):>7}"
+            f"{format_number(per_run.get('openai', {}).get('requests'), 1):>8}"
+            f"{format_number(per_run.get('ollama', {}).get('requests'), 1):>8}"
+            f"{received:>9.1f}{result['peak_kb']:>9.0f}"
+        )
+    if not baseline:
+        return
+    print()
+    print("前回との比較（負の値は改善）:")
+    for name, result in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p95_ms', 'peak_kb'):
+            if previous.get(key):
+                changes.append(f"{key} {(result[key] - previous[key]) / previous[key] * 100:+.1f}%")
+        print(f"  {name:<13}" + ", ".join(changes))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="偽サーバーを使ってワークフローの性能を計測する")
+    parser.add_argument('--workflows', nargs='+', choices=WORKFLOW_NAMES, help="計測するワークフロー（既定は全て）")
+    parser.add_argument('--iterations', type=int, default=10, help="計測する実行回数")
+    parser.add_argument('--warmup', type=int, default=1, help="計測前に捨てる実行回数")
+    parser.add_argument('--offline', action='store_true', help="オフライン時の動作（ローカル索引とOllama）を計測する")
+    parser.add_argument('--warm', action='store_true', help="毎回同じ入力を使い、キャッシュを残したまま計測する")
+    parser.add_argument('--client-rate-limit', action='store_true',
+                        help="アプリ側のOpenAIレート制限を有効のまま計測する（既定では偽サーバーに合わせて解除する）")
+    parser.add_argument('--latency-ms', type=float, default=60, help="1リクエストあたりの応答遅延")
+    parser.add_argument('--jitter-ms', type=float, default=20, help="応答遅延に加える揺らぎの最大値")
+    parser.add_argument('--llm-latency-ms', type=float, default=300, help="LLMの最初のトークンまでの遅延")
+    parser.add_argument('--chunk-ms', type=float, default=10, help="ストリーミングの各チャンクの間隔")
+    parser.add_argument('--chunk-chars', type=int, default=8, help="ストリーミングの1チャンクの文字数")
+    parser.add_argument('--response-chars', type=int, default=1200, help="LLM応答の文字数")
+    parser.add_argument('--tasks', type=int, default=5, help="タスク抽出で返すタスク数")
+    parser.add_argument('--files', type=int, default=300, help="ドライブのファイル数")
+    parser.add_argument('--emails', type=int, default=10, help="1回の実行で届く未読メール数")
+    parser.add_argument('--existing-tasks', type=int, default=50, help="タスクリストに登録済みのタスク数")
+    parser.add_argument('--body-kb', type=int, default=4, help="メール本文・ファイル本文の大きさ")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="偽サーバーがエラーを返す確率")
+    parser.add_argument('--seed', type=int, default=0, help="遅延の揺らぎとエラー発生の乱数シード")
+    parser.add_argument('--output', help="結果をJSONで保存するパス")
+    parser.add_argument('--compare', help="比較する前回の結果（JSON）")
+    options = parser.parse_args(argv)
+    if options.iterations < 1:
+        parser.error("--iterations には1以上を指定してください")
+    return options
+
+def main(argv=None):
+    options = parse_args(argv)
+    names = options.workflows or (OFFLINE_WORKFLOW_NAMES if options.offline else WORKFLOW_NAMES)
+    output = os.path.abspath(options.output) if options.output else None
+    baseline = None
+    if options.compare:
+        with open(options.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    
+    services = FakeServices(vars(options))
+    workdir = tempfile.mkdtemp(prefix='ai-agent-bench-')
+    try:
+        agent, target = load_agent(services.base_url, workdir)
+        if not options.client_rate_limit:
+            # 実際のAPIの制限に合わせた待ちで、計測したい処理時間が隠れないようにする
+            agent.openai_rate_limiter = agent.RateLimiter(10 ** 6, 10 ** 9)
+        
+        # 索引とメールストアを作っておき、初回同期の時間を計測から外す
+        started = time.perf_counter()
+        agent.drive_index.sync(agent.get_google_service('drive', 'v3'))
+        print(f"ドライブ索引の初回同期: {(time.perf_counter() - started) * 1000:.0f} ms")
+        if options.offline:
+            services.deliver_mail(options.emails)
+            agent.process_email(BenchmarkApp())
+            go_offline(agent, target)
+        
+        results = {}
+        for name in names:
+            print(f"{name} を計測中...")
+            results[name] = benchmark_workflow(agent, services, name, options)
+        
+        print_results(results, baseline)
+        if resource is not None:
+            print(f"\n最大RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+        if output:
+            with open(output, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'created_at': datetime.now().isoformat(timespec='seconds'),
+                    'python': sys.version.split()[0],
+                    'options': vars(options),
+                    'results': results,
+                }, f, ensure_ascii=False, indent=2)
+            print(f"結果を保存しました: {output}")
+    finally:
+        services.stop()
+
+if __name__ == "__main__":
+    main()